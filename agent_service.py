@@ -5,20 +5,30 @@ Adaptado para funcionar como microservicio separado
 """
 import os
 import re
+import asyncio
+import hashlib
 import uuid
-import traceback
 import mimetypes
 import base64
+import functools
+import heapq
+import importlib.util
 import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List, Tuple
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Tuple, Type, Union, Mapping, Sequence, Callable, Awaitable
 import json
-from json import JSONDecodeError
 
-from pydantic import BaseModel, ValidationError, Field
+from pydantic import BaseModel, ValidationError, Field, TypeAdapter
 import httpx
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from config import settings
-from models import ChatMessage, MessageRole, PortfolioReportRequest, PortfolioReportResponse, Report, AlertsAnalysisRequest, FutureProjectionsRequest, PerformanceAnalysisRequest, DailyWeeklySummaryRequest, InlineFile
+from llm_cache import LLMCache, build_llm_cache, build_semantic_cache
+from session_store import build_session_store
+from models import MessageRole, PortfolioReportRequest, PortfolioReportResponse, Report, AlertsAnalysisRequest, FutureProjectionsRequest, PerformanceAnalysisRequest, DailyWeeklySummaryRequest, InlineFile
 
 # Configurar logger
 logger = logging.getLogger(__name__)
@@ -26,6 +36,7 @@ logger = logging.getLogger(__name__)
 try:
     from google import genai
     from google.genai import types
+    from google.genai import errors as genai_errors
     
     # Configurar API key
     api_key = settings.get_api_key()
@@ -35,18 +46,251 @@ try:
     if not os.getenv("GEMINI_API_KEY"):
         os.environ["GEMINI_API_KEY"] = api_key
     
-    # Crear cliente con API key explícita (según tutorial)
-    client = genai.Client(api_key=api_key)
-    
 except Exception as e:
-    print(f"❌ Error configurando Gemini: {e}")
-    client = None
+    logger.error("❌ Error configurando Gemini: %s", e)
+    api_key = None
+
+# Pool de conexiones persistente (keep-alive) y HTTP/2 si `h2` está instalado:
+# las llamadas sucesivas reutilizan el socket TLS en lugar de renegociarlo
+_gemini_transport_args = {
+    "http2": importlib.util.find_spec("h2") is not None,
+    "limits": httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60),
+}
+
+
+class _ReleasingByteStream(httpx.AsyncByteStream):
+    """Cuerpo de respuesta que libera su cupo de concurrencia al cerrarse (una sola vez)."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            release, self._release = self._release, None
+            if release:
+                release()
+
+
+class _BoundedAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte httpx con un máximo de peticiones en vuelo. Con HTTP/2 el pool de conexiones
+    no limita la concurrencia (todo se multiplexa sobre un socket): el semáforo da
+    contrapresión ante ráfagas en lugar de acumular cientos de llamadas simultáneas a Gemini.
+    El cupo se ocupa hasta cerrar el cuerpo de la respuesta (los streams lo retienen mientras duran).
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limit: int):
+        self._transport = transport
+        self._slots = asyncio.Semaphore(limit)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._slots.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._slots.release()
+            raise
+        response.stream = _ReleasingByteStream(response.stream, self._slots.release)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> Optional["genai.Client"]:
+    """
+    Cliente Gemini creado en el primer uso: construir el cliente (httpx, contexto TLS) no
+    se paga en el arranque del proceso sino en la primera llamada que lo necesita.
+    """
+    if not api_key:
+        return None
+    async_client_args: Dict[str, Any] = _gemini_transport_args
+    if settings.max_concurrent_gemini_calls > 0:
+        # Con transporte propio httpx ignora http2/limits del cliente: van en el transporte
+        async_client_args = {
+            "transport": _BoundedAsyncTransport(
+                httpx.AsyncHTTPTransport(**_gemini_transport_args),
+                settings.max_concurrent_gemini_calls,
+            ),
+        }
+    # Crear cliente con API key explícita (según tutorial)
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            client_args=_gemini_transport_args,
+            async_client_args=async_client_args,
+        ),
+    )
+
+
+# json_repair solo se necesita cuando el JSON del modelo viene roto: se importa en el primer uso
+_has_json_repair = importlib.util.find_spec("json_repair") is not None
+
+
+def repair_json(*args: Any, **kwargs: Any) -> Any:
+    from json_repair import repair_json as _repair_json
+    return _repair_json(*args, **kwargs)
+
+
+try:
+    import orjson
+    _has_orjson = True
+except Exception:
+    _has_orjson = False
 
 try:
-    from json_repair import repair_json
-    _has_json_repair = True
+    import ijson
+    _has_ijson = True
 except Exception:
-    _has_json_repair = False
+    _has_ijson = False
+
+try:
+    import ahocorasick
+    _has_ahocorasick = True
+except Exception:
+    _has_ahocorasick = False
+
+try:
+    import re2
+    _has_re2 = True
+except Exception:
+    _has_re2 = False
+
+try:
+    import tiktoken
+    _has_tiktoken = True
+except Exception:
+    _has_tiktoken = False
+
+
+def _json_loads(data: Union[str, bytes, bytearray]) -> Any:
+    """json.loads acelerado con orjson si está disponible (sus errores heredan de JSONDecodeError)."""
+    if _has_orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_default(obj: Any) -> Any:
+    """Tipos no nativos de JSON: modelos pydantic (p. ej. grounding_metadata de google-genai) como dict."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(obj: Any, indent: bool = False) -> str:
+    """
+    Equivalente a json.dumps(obj, ensure_ascii=False) (con indent=2 si `indent`);
+    usa orjson y cae a stdlib con tipos no soportados.
+    """
+    if _has_orjson:
+        # OPT_NON_STR_KEYS: claves int/float se convierten a texto como en json.dumps (sin caer a stdlib)
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, default=_json_default, option=option).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, default=_json_default, indent=2 if indent else None)
+
+
+# Validador de Report reutilizable: validate_json parsea y valida directamente desde el texto
+_REPORT_ADAPTER = TypeAdapter(Report)
+
+
+def _is_json_syntax_error(error: ValidationError) -> bool:
+    """True si la validación falló por JSON mal formado (no por el esquema)."""
+    return any(item.get("type") == "json_invalid" for item in error.errors())
+
+
+@functools.lru_cache(maxsize=1)
+def _local_encoding():
+    """Encoding de tiktoken cargado una sola vez (None si no está disponible o no pudo cargarse)."""
+    if not _has_tiktoken:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("⚠️ No se pudo cargar el tokenizador local: %s", e)
+        return None
+
+
+def _local_token_count(text: str) -> int:
+    """
+    Conteo aproximado de tokens en local (sin llamar a count_tokens de Gemini).
+    cl100k_base no es el tokenizador de Gemini pero sirve para presupuestos; sin tiktoken, ~4 caracteres por token.
+    """
+    encoding = _local_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def _brace_diff(text: str) -> int:
+    """Llaves abiertas menos cerradas ('{' y '}' son ASCII: str.count recorre el buffer en C)."""
+    return text.count('{') - text.count('}')
+
+
+class _IncrementalJSONParser:
+    """
+    Parseo incremental (ijson) de una salida JSON en streaming: el objeto se construye
+    mientras llegan los chunks, en una sola pasada. Si el JSON es inválido se marca como
+    fallido y el llamador recurre al parseo/reparación sobre el texto completo.
+    """
+
+    def __init__(self):
+        self._items = ijson.sendable_list()
+        self._coro = ijson.items_coro(self._items, "", use_float=True)
+        self.failed = False
+
+    def feed(self, text: str) -> None:
+        if self.failed:
+            return
+        try:
+            self._coro.send(text.encode("utf-8"))
+        except Exception:
+            self.failed = True
+
+    def result(self) -> Optional[Any]:
+        if self.failed:
+            return None
+        try:
+            self._coro.close()
+        except Exception:
+            return None
+        return self._items[0] if self._items else None
+
+# Reloj ISO de grano grueso: [texto, instante monotónico de la lectura]
+_cached_iso: List[Any] = ["", 0.0]
+
+
+def now_iso_coarse(ttl: float = 0.1) -> str:
+    """
+    datetime.now().isoformat() reutilizado durante `ttl` segundos. Para marcas de
+    contabilidad (creación de sesiones, estado de tareas) 100 ms de desfase son aceptables;
+    los timestamps de mensajes siguen siendo exactos (el cursor del resumen necesita orden estricto).
+    """
+    now = time.monotonic()
+    if now - _cached_iso[1] >= ttl:
+        _cached_iso[0] = datetime.now().isoformat()
+        _cached_iso[1] = now
+    return _cached_iso[0]
+
+
+def _make_message(role: MessageRole, content: str, timestamp: str) -> Dict[str, str]:
+    """
+    Mensaje de sesión como dict plano (mismas claves que ChatMessage.model_dump()).
+    Los mensajes se crean en el servicio y nunca se revalidan al leerlos: ChatMessage queda
+    para los límites de la API.
+    """
+    return {"role": role.value, "content": content, "timestamp": timestamp}
+
 
 # ==========================================
 # HERRAMIENTAS DEL AGENTE
@@ -60,23 +304,62 @@ def get_current_datetime() -> Dict[str, str]:
     Returns:
         Dict con fecha, hora, timezone y formato ISO
     """
-    now = datetime.now()
-    now_utc = datetime.now(timezone.utc)
+    # Una sola lectura del reloj; el resto se deriva de ella sin strftime
+    now = datetime.now().astimezone()
+    now_utc = now.astimezone(timezone.utc)
+    iso = now.replace(tzinfo=None).isoformat()
+    date_str, time_str = iso[:10], iso[11:19]
+    utc_str = now_utc.isoformat()
     
     return {
-        "date": now.strftime("%Y-%m-%d"),
-        "time": now.strftime("%H:%M:%S"),
-        "datetime": now.strftime("%Y-%m-%d %H:%M:%S"),
+        "date": date_str,
+        "time": time_str,
+        "datetime": f"{date_str} {time_str}",
         "timezone": "local",
-        "iso_format": now.isoformat(),
-        "utc_datetime": now_utc.strftime("%Y-%m-%d %H:%M:%S UTC"),
-        "utc_iso": now_utc.isoformat(),
-        "weekday": now.strftime("%A"),
-        "month": now.strftime("%B"),
-        "year": now.strftime("%Y"),
+        "iso_format": iso,
+        "utc_datetime": f"{utc_str[:10]} {utc_str[11:19]} UTC",
+        "utc_iso": utc_str,
+        "weekday": _WEEKDAYS_EN[now.weekday()],
+        "month": _MONTHS_EN[now.month - 1],
+        "year": date_str[:4],
     }
 
 
+# Nombres fijos (equivalen a %A / %B en locale C, sin pasar por strftime)
+_WEEKDAYS_EN = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+_MONTHS_EN = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+)
+_WEEKDAYS_ES = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+_MONTHS_ES = (
+    "enero", "febrero", "marzo", "abril", "mayo", "junio",
+    "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre",
+)
+
+
+def _format_datetime_answer(result: Dict[str, str]) -> str:
+    """Respuesta directa a partir del resultado de get_current_datetime (sin pedirle al modelo que la redacte)."""
+    now = datetime.fromisoformat(result["iso_format"])
+    return (
+        f"Hoy es {_WEEKDAYS_ES[now.weekday()]} {now.day} de {_MONTHS_ES[now.month - 1]} de {now.year} "
+        f"y son las {now:%H:%M} (hora del servidor; {result['utc_datetime']})."
+    )
+
+
+# Herramientas cuyo resultado se presenta con una plantilla local: si la consulta es solo
+# esa pregunta, se omite la segunda llamada a Gemini que redactaría el resultado
+_EARLY_EXIT_TOOLS: Mapping[str, Callable[[Dict[str, str]], str]] = MappingProxyType({
+    "get_current_datetime": _format_datetime_answer,
+})
+
+def _session_agnostic_tool(func: Callable[..., Dict[str, Any]]) -> Callable[..., Awaitable[Dict[str, Any]]]:
+    """Adapta una función síncrona sin estado a la firma de los handlers de herramientas (session_id, **args)."""
+    async def handler(session_id: Optional[str], **kwargs: Any) -> Dict[str, Any]:
+        return func(**kwargs)
+    return handler
+
+
 # Declaración de la función para Function Calling
 GET_DATETIME_DECLARATION = types.FunctionDeclaration(
     name="get_current_datetime",
@@ -88,39 +371,82 @@ GET_DATETIME_DECLARATION = types.FunctionDeclaration(
     }
 )
 
-# Herramienta de selección de archivos (basada en gemini_supabase/main.py)
-FILE_SELECTION_TOOL = types.Tool(
-    function_declarations=[
-        types.FunctionDeclaration(
-            name="SelectorDeArchivos",
-            description="Herramienta para seleccionar la lista de archivos más relevantes de Supabase.",
-            parameters={
-                "type": "object",
-                "properties": {
-                    "archivos_a_analizar": {
-                        "type": "array",
-                        "description": "Lista de los IDs y nombres de los archivos que el modelo ha determinado que son cruciales para responder la pregunta.",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "id_archivo": {
-                                    "type": "string",
-                                    "description": "El ID único del archivo (ej. 'rep_Q4') que debe ser analizado."
-                                },
-                                "nombre_archivo": {
-                                    "type": "string",
-                                    "description": "El nombre completo del archivo (ej. 'reporte_ventas_Q4.pdf')."
-                                }
-                            },
-                            "required": ["id_archivo", "nombre_archivo"]
-                        }
-                    }
-                },
-                "required": ["archivos_a_analizar"]
-            }
-        )
-    ]
+# Herramientas sin estado: se construyen una vez y se comparten entre requests (no se mutan)
+TOOL_URL_CONTEXT = types.Tool(url_context=types.UrlContext())
+TOOL_GOOGLE_SEARCH = types.Tool(google_search=types.GoogleSearch())
+TOOL_DATETIME = types.Tool(function_declarations=[GET_DATETIME_DECLARATION])
+
+# Memoria de la conversación bajo demanda: el modelo recupera mensajes antiguos solo cuando los
+# necesita, en lugar de inyectarlos en el prompt (el prefijo system prompt + herramientas no cambia)
+RECALL_MEMORY_DECLARATION = types.FunctionDeclaration(
+    name="recall_memory",
+    description="Busca en mensajes anteriores de esta conversación que ya no están en el historial reciente (activos, cifras, preferencias o datos que el usuario mencionó antes). Úsala solo si necesitas un detalle previo que no aparece en el resumen ni en los últimos mensajes.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "query": {"type": "string", "description": "Qué buscar en la conversación previa"}
+        },
+        "required": ["query"]
+    }
 )
+TOOL_RECALL_MEMORY = types.Tool(function_declarations=[RECALL_MEMORY_DECLARATION])
+
+# Configs del chat ya construidas por (system prompt, identidad de las herramientas): solo las
+# herramientas varían entre turnos y son singletons, así que hay pocas combinaciones.
+# La entrada guarda las herramientas, con lo que sus id() no se reutilizan mientras exista.
+_CHAT_CONFIGS: Dict[Tuple[str, Tuple[int, ...]], Tuple[Tuple[Any, ...], Any, Any]] = {}
+_CHAT_CONFIGS_MAX = 32
+
+
+def _chat_configs(system_prompt: str, tools: Optional[List[types.Tool]]) -> Tuple[Any, Any]:
+    """(config completa, config para usar con un caché de contexto) del chat; no deben mutarse."""
+    tools_tuple = tuple(tools or ())
+    key = (system_prompt, tuple(map(id, tools_tuple)))
+    entry = _CHAT_CONFIGS.get(key)
+    if entry is None:
+        config = types.GenerateContentConfig(
+            temperature=0.7,
+            top_p=0.9,
+            max_output_tokens=2048,
+            tools=list(tools_tuple) if tools_tuple else None,
+            system_instruction=system_prompt if system_prompt else None
+        )
+        if len(_CHAT_CONFIGS) >= _CHAT_CONFIGS_MAX:
+            _CHAT_CONFIGS.clear()
+        # cached_content no admite system_instruction/tools en la misma request
+        entry = _CHAT_CONFIGS[key] = (
+            tools_tuple,
+            config,
+            config.model_copy(update={"system_instruction": None, "tools": None}),
+        )
+    return entry[1], entry[2]
+
+
+# Mínimo de tokens de un caché de contexto explícito (Gemini 2.5 Flash: 1024, 2.5 Pro: 4096).
+# Por debajo, caches.create falla siempre: no se intenta y el prefijo viaja inline
+_PROMPT_CACHE_MIN_TOKENS_FLASH = 1024
+_PROMPT_CACHE_MIN_TOKENS_PRO = 4096
+# Conteo local conservador (~4 caracteres por token), sin llamada a count_tokens
+_CHARS_PER_TOKEN = 4
+
+
+def _prompt_cache_eligible(
+    model: str,
+    prefix: Optional[Sequence[types.Content]],
+    system_instruction: Optional[str],
+    tools: Optional[Sequence[types.Tool]],
+) -> bool:
+    """True si el prefijo estático (instrucciones + contents + herramientas) alcanza el mínimo cacheable del modelo."""
+    chars = len(system_instruction or "")
+    chars += sum(len(part.text or "") for content in prefix or () for part in content.parts or ())
+    chars += sum(len(tool.model_dump_json(exclude_none=True)) for tool in tools or ())
+    min_tokens = _PROMPT_CACHE_MIN_TOKENS_PRO if "pro" in model else _PROMPT_CACHE_MIN_TOKENS_FLASH
+    return chars // _CHARS_PER_TOKEN >= min_tokens
+
+
+# (clave de caché del chat, modelo) -> si el prefijo es cacheable; pocas combinaciones y prompts estáticos
+_CHAT_PROMPT_CACHE_ELIGIBLE: Dict[Tuple[str, str], bool] = {}
+
 
 # Prompts del sistema
 FLASH_SYSTEM_PROMPT = """
@@ -184,6 +510,74 @@ Todas tus respuestas deben tener enfoque FINANCIERO:
 - Cita fuentes cuando corresponda
 """
 
+# Prompt maestro del informe de portafolio (estático: candidato a caché de contexto de Gemini)
+PORTFOLIO_INSTRUCTION = (
+    "# PROMPT MAESTRO PARA AGENTE DE ANÁLISIS FINANCIERO\n\n"
+    "## 1. PERSONA Y ROL\n"
+    "Actúa como un Analista Financiero Cuantitativo Senior y Estratega de Carteras de Inversión con más de 20 años en Goldman Sachs. "
+    "Eres meticuloso, objetivo y comunicas hallazgos con rigor institucional. Tu responsabilidad es sintetizar datos cuantitativos, narrativas cualitativas "
+    "y señales visuales en un diagnóstico integral y accionable del portafolio.\n\n"
+
+    "## 2. DIRECTIVA PRINCIPAL\n"
+    "Elabora un INFORME DE ANÁLISIS DE CARTERA COMPLETO, profundo y profesional que será convertido automáticamente a PDF. "
+    "Debes interpretar métricas, tablas y cada imagen disponible (graficos descargados desde Supabase) con criterios cuantitativos, "
+    "contexto macroeconómico y riesgos prospectivos. Contrasta hallazgos individuales y combinados para extraer conclusiones estratégicas.\n\n"
+
+    "## 3. PROTOCOLO DE RESPUESTA\n"
+    "1. RESPONDE ÚNICAMENTE con JSON válido que siga estrictamente el esquema Report.\n"
+    "2. No añadas texto fuera del JSON, ni comentarios, ni bloques markdown.\n"
+    "3. Escapa apropiadamente cada cadena y garantiza que todas las llaves estén cerradas.\n"
+    "4. Usa nombres de archivo de imágenes sin prefijos (ej: 'portfolio_growth.png').\n"
+    "5. Conserva la relación de aspecto 16:9 en todas las imágenes fijando height = width * 9 / 16 (usa width en pulgadas, p.ej. 6.0 => height 3.375).\n"
+    "6. Si algún dato no está disponible, explícitalo en el cuerpo del informe en lugar de inventarlo.\n\n"
+
+    "## 4. ESTRUCTURA DEL INFORME\n"
+    "- fileName: Nombre profesional con extensión .pdf.\n"
+    "- document: { title, author='Horizon Agent', subject }.\n"
+    "- content: Usa la siguiente gramática en orden lógico con secciones numeradas (I., II., III., ...).\n"
+    "  • header1: título principal.\n"
+    "  • header2/header3: secciones y subsecciones jerarquizadas.\n"
+    "  • paragraph: narrativa (styles permitidos: body, italic, bold, centered, disclaimer).\n"
+    "  • spacer: separadores (height en puntos).\n"
+    "  • page_break: saltos de página.\n"
+    "  • table: tablas con headers y rows bien formateadas.\n"
+    "  • list: listas con viñetas enriquecidas (usa **negritas** dentro de los items cuando aporte claridad).\n"
+    "  • key_value_list: métricas clave con descripciones claras.\n"
+    "  • image: cada gráfico disponible; agrega captions interpretativos, width en pulgadas (≈6.0) y height = width * 9 / 16.\n\n"
+
+    "## 5. CONTENIDO ANALÍTICO OBLIGATORIO\n"
+    "Incluye, como mínimo, los siguientes apartados con profundidad institucional:\n"
+    "- Resumen Ejecutivo con contexto macro y eventos recientes.\n"
+    "- Perfil de composición y concentración de la cartera.\n"
+    "- Métricas de rendimiento (anualizadas, acumuladas, ratios de riesgo-retorno).\n"
+    "- Análisis exhaustivo de riesgo: drawdowns, volatilidad en múltiples horizontes, sensibilidad a tasas, colas gruesas.\n"
+    "- Interpretación detallada de cada visualización disponible (qué muestra, insight clave, implicación).\n"
+    "- Comparativa con portafolios optimizados (GMV, Máximo Sharpe, benchmark).\n"
+    "- Análisis de correlaciones y diversificación efectiva.\n"
+    "- Proyecciones/Simulaciones (ej. Monte Carlo) y escenarios de estrés.\n"
+    "- Perspectivas estratégicas: oportunidades, riesgos estructurales, triggers a monitorear.\n"
+    "- Recomendaciones tácticas separadas por tipo de perfil (agresivo, moderado, conservador).\n"
+    "- Recomendaciones operativas (rebalanceo, coberturas, liquidez, stop-loss dinámicos).\n"
+    "- Disclaimer regulatorio al final con style 'disclaimer'.\n\n"
+
+    "## 6. METODOLOGÍA Y PROFUNDIDAD\n"
+    "- Integra los datos numéricos, texto contextual y gráficos EN CONJUNTO, destacando convergencias o contradicciones.\n"
+    "- Aporta interpretaciones cuantitativas (porcentajes, diferencias vs benchmark, contribuciones marginales, elasticidades).\n"
+    "- Emplea terminología financiera profesional (tracking error, beta, skewness, expected shortfall, etc.) cuando aplique.\n"
+    "- Usa párrafos densos y argumentados; evita descripciones superficiales o genéricas.\n"
+    "- Señala riesgos latentes (macro, regulatorios, concentración, liquidez) y vincúlalos con la evidencia.\n"
+    "- Articula recomendaciones con justificación cuantitativa y pasos concretos.\n\n"
+
+    "## 7. SALIDA FINAL\n"
+    "Produce un JSON extenso, profesional y técnicamente sólido que respete el esquema Report y capture la complejidad del portafolio."
+)
+
+# Prefijo de instrucciones del informe, construido una vez (los types.Content no se mutan al enviarlos)
+_PORTFOLIO_INSTRUCTION_PREFIX: Tuple[types.Content, ...] = (
+    types.Content(role="user", parts=[types.Part.from_text(text=PORTFOLIO_INSTRUCTION)]),
+)
+
+
 class ArchivoSeleccionado(BaseModel):
     """Representa un archivo seleccionado para análisis."""
 
@@ -199,32 +593,33 @@ class SelectorDeArchivos(BaseModel):
     )
 
 
-def _build_tool_from_schema(schema: BaseModel) -> types.Tool:
-    parameters_schema = {
-        "type": "object",
-        "properties": {
-            "archivos_a_analizar": {
-                "type": "array",
-                "description": schema.model_fields["archivos_a_analizar"].description,
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "id_archivo": {
-                            "type": "string",
-                            "description": ArchivoSeleccionado.model_fields["id_archivo"].description,
-                        },
-                        "nombre_archivo": {
-                            "type": "string",
-                            "description": ArchivoSeleccionado.model_fields["nombre_archivo"].description,
-                        },
-                    },
-                    "required": ["id_archivo", "nombre_archivo"],
-                },
-            }
-        },
-        "required": ["archivos_a_analizar"],
+def _inline_json_schema(node: Any, defs: Dict[str, Any], is_properties: bool = False) -> Any:
+    """
+    JSON Schema de pydantic en el subconjunto que acepta FunctionDeclaration: referencias
+    ($ref/$defs) resueltas en línea y sin los "title" generados (los nombres de propiedades se conservan).
+    """
+    if isinstance(node, list):
+        return [_inline_json_schema(item, defs) for item in node]
+    if not isinstance(node, dict):
+        return node
+    if is_properties:
+        return {name: _inline_json_schema(value, defs) for name, value in node.items()}
+    if "$ref" in node:
+        return _inline_json_schema(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+    return {
+        key: _inline_json_schema(value, defs, is_properties=key == "properties")
+        for key, value in node.items()
+        if key not in ("title", "$defs")
     }
 
+
+def _build_tool_from_schema(schema: Type[BaseModel]) -> types.Tool:
+    """Tool de function calling derivado del esquema pydantic (se construye una vez, al importar)."""
+    json_schema = schema.model_json_schema()
+    parameters_schema = _inline_json_schema(json_schema, json_schema.get("$defs", {}))
+    # La descripción de la función ya es el docstring del modelo
+    parameters_schema.pop("description", None)
+
     return types.Tool(
         function_declarations=[
             types.FunctionDeclaration(
@@ -239,32 +634,392 @@ def _build_tool_from_schema(schema: BaseModel) -> types.Tool:
 FILE_SELECTION_TOOL = _build_tool_from_schema(SelectorDeArchivos)
 
 
+# ==========================================
+# FALLBACK DE MODELOS
+# ==========================================
+
+# Modelos alternativos (en orden) cuando el preferido está sobrecargado
+_MODEL_FALLBACKS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    "gemini-2.5-pro": ("gemini-2.5-flash", "gemini-2.5-flash-lite"),
+    "gemini-2.5-flash": ("gemini-2.5-flash-lite", "gemini-2.0-flash"),
+})
+
+# Cadena usada por proyecciones, rendimiento y resúmenes (basada en los modelos configurados)
+_ANALYSIS_MODEL_FALLBACKS: Mapping[str, Tuple[str, ...]] = MappingProxyType({
+    settings.model_pro: (settings.model_flash, "gemini-2.5-flash"),
+    settings.model_flash: ("gemini-2.5-flash", "gemini-2.5-flash-lite"),
+})
+
+
+def _model_chain(model: str, fallbacks: Mapping[str, Tuple[str, ...]]) -> Tuple[str, ...]:
+    """Modelo preferido seguido de sus alternativos, sin repetidos."""
+    return tuple(dict.fromkeys((model,) + fallbacks.get(model, ())))
+
+
+def _is_overloaded_error(error: Exception) -> bool:
+    """True si Gemini rechazó la llamada por sobrecarga o cuota (503/429), según el código estructurado."""
+    if not isinstance(error, genai_errors.APIError):
+        return False
+    if error.code in (429, 503) or error.status in ("UNAVAILABLE", "RESOURCE_EXHAUSTED"):
+        return True
+    return "overloaded" in (error.message or "").lower()
+
+
+# Estados finales de un job de la Batch API (informes no interactivos)
+_BATCH_TERMINAL_STATES = frozenset({
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+})
+
+
+# ==========================================
+# HISTORIAL DE CONVERSACIÓN
+# ==========================================
+
+# Mensajes enviados literalmente al modelo (incluye el mensaje actual del usuario)
+_HISTORY_WINDOW = 10
+# Mensajes que deben salir de la ventana antes de regenerar el resumen acumulado
+_SUMMARY_BATCH = 6
+# Presupuesto de tokens (conteo local) para los mensajes previos enviados literalmente
+_HISTORY_TOKEN_BUDGET = 8000
+# Máximo de textos por llamada embed_content
+_EMBED_BATCH_SIZE = 100
+
+
+# Retención: los tokens de los últimos _AUTH_HEADERS_CACHE_SIZE usuarios distintos quedan en memoria
+# del proceso (dentro de sus cabeceras) hasta que otros los desplazan o se apaga el servicio
+# (ChatAgentService.aclose, desde el shutdown del lifespan).
+# El tamaño cubre las peticiones concurrentes, que es donde se reutiliza el objeto; los JWT expiran
+# por su cuenta, pero no deben guardarse más de lo necesario
+_AUTH_HEADERS_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=_AUTH_HEADERS_CACHE_SIZE)
+def _auth_headers(auth_token: str) -> Mapping[str, str]:
+    """Cabeceras del backend por token (inmutables): las llamadas de una misma petición comparten el objeto."""
+    return MappingProxyType({"Authorization": f"Bearer {auth_token}"})
+
+
+# Descargas simultáneas de archivos del usuario por petición
+_DOWNLOAD_CONCURRENCY = 8
+# Respuesta del chat cuando el modelo no devolvió texto
+_NO_RESPONSE_TEXT = "No pude generar una respuesta. Por favor intenta reformular tu pregunta."
+# Mensajes devueltos por recall_memory (y caracteres por mensaje)
+_RECALL_MEMORY_LIMIT = 5
+_RECALL_MEMORY_MAX_CHARS = 1000
+
+SUMMARY_INSTRUCTION = """Actualiza el resumen de una conversación entre un usuario y un asistente financiero.
+Integra el resumen previo (si existe) con los mensajes nuevos. Conserva datos concretos: activos,
+cifras, preferencias y decisiones del usuario. Responde solo con el resumen, en español, en menos de 200 palabras."""
+
+
+# ==========================================
+# CLASIFICACIÓN DE CONSULTAS
+# ==========================================
+
+# Keywords que SIEMPRE activan búsqueda (noticias, precios actuales)
+_ALWAYS_SEARCH_KEYWORDS = (
+    # Noticias
+    "noticia", "noticias", "news", "headline", "titulares",
+    
+    # Precios/Cotizaciones actuales
+    "precio", "cotización", "cotiza", "vale", "cuesta", "price",
+    "cuánto está", "cuánto vale", "a cuánto", "cómo está",
+    "cómo va", "cómo anda", "cómo cerró",
+    
+    # Información en tiempo real
+    "actual", "hoy", "ahora", "latest", "current", "today",
+    "reciente", "última", "últimas", "último", "últimos",
+    "recent", "now", "this week", "esta semana",
+    
+    # Mercados en vivo
+    "mercado hoy", "bolsa hoy", "trading", "session",
+    
+    # Búsqueda explícita
+    "busca", "buscar", "search", "encuentra", "find",
+    "dime", "cuéntame", "qué hay", "qué pasa", "qué pasó"
+)
+
+# Keywords financieros específicos que también activan búsqueda
+_FINANCIAL_SEARCH_KEYWORDS = (
+    # Empresas/Tickers (preguntar por ellos implica querer info actual)
+    "apple", "microsoft", "google", "amazon", "tesla", "nvidia", "meta",
+    "aapl", "msft", "googl", "amzn", "tsla", "nvda",
+    
+    # Índices
+    "s&p 500", "sp500", "nasdaq", "dow jones", "ibex", "dax",
+    
+    # Criptomonedas
+    "bitcoin", "btc", "ethereum", "eth", "crypto",
+    
+    # Commodities
+    "oro", "gold", "petróleo", "oil", "plata", "silver",
+    
+    # Macro
+    "fed", "bce", "banco central", "tasa de interés", "inflación",
+    "pib", "gdp", "empleo"
+)
+
+# Keywords que indican solo fecha/hora sin búsqueda
+_DATETIME_KEYWORDS = (
+    "qué hora es", "qué día es", "fecha actual", "hora actual",
+    "qué fecha es", "hora es ahora", "día de la semana",
+    "cuándo es", "mes actual", "año actual"
+)
+
+# Normalización de keywords y consultas: sin tildes ni diéresis y en minúsculas, para que
+# "que hora es" coincida igual que "qué hora es" (str.translate es un único bucle en C)
+_ACCENT_TABLE = str.maketrans("áéíóúÁÉÍÓÚüÜ", "aeiouAEIOUuU")
+
+
+def _fold_text(text: str) -> str:
+    return text.translate(_ACCENT_TABLE).lower()
+
+
+# Detección de consultas sobre archivos propios del usuario (_is_user_storage_query).
+# Las listas se construyen una vez y cada una se compila en una alternancia: una pasada
+# por lista sobre la consulta en minúsculas, con el mismo resultado que `any(p in q ...)`.
+
+# Patrones posesivos en español
+_STORAGE_POSSESSIVE_PATTERNS = (
+    "mi ", "mis ", "mío", "mía", "míos", "mías",
+    "el mio", "la mia", "los mios", "las mias",
+    "mi archivo", "mis archivos", "mi documento", "mis documentos",
+    "mi gráfico", "mis gráficos", "mi grafico", "mis graficos",
+    "mi imagen", "mis imágenes", "mi imagen", "mis imagenes",
+    "mi reporte", "mis reportes", "mi informe", "mis informes",
+    "mi análisis", "mis análisis", "mi analisis", "mis analisis",
+    "mi portafolio", "mi portfolio", "mi cartera",
+    "mi json", "mis json", "mi pdf", "mis pdf",
+    "mi chart", "mis charts", "mi data", "mis datos",
+)
+
+# Palabras clave de tipos de archivos/visualizaciones
+_STORAGE_FILE_TYPE_KEYWORDS = (
+    # Gráficos y visualizaciones
+    "gráfico", "grafico", "gráficos", "graficos",
+    "chart", "charts", "plot", "plots",
+    "visualización", "visualizacion", "visualizaciones",
+    "diagrama", "diagramas",
+
+    # Tipos de análisis comunes en finanzas
+    "monte carlo", "montecarlo", "simulación", "simulacion",
+    "correlación", "correlacion", "heatmap",
+    "drawdown", "volatilidad", "riesgo",
+    "pie chart", "bar chart", "line chart",
+    "candlestick", "velas",
+    "scatter", "distribución", "distribucion",
+    "histograma", "histogram",
+
+    # Tipos de archivos
+    "json", "pdf", "imagen", "imágenes", "imagenes",
+    "png", "jpg", "jpeg",
+
+    # Documentos de análisis
+    "reporte", "informe", "análisis", "analisis",
+    "resumen", "summary", "documento",
+)
+
+# Verbos de acción sobre archivos personales
+_STORAGE_ACTION_VERBS = (
+    "analiza", "analizar", "analízame", "analizame",
+    "explica", "explicar", "explícame", "explicame",
+    "interpreta", "interpretar", "interprétame", "interpretame",
+    "muestra", "mostrar", "muéstrame", "muestrame",
+    "describe", "describir", "descríbeme", "describeme",
+    "resume", "resumir", "resúmeme", "resumeme",
+    "lee", "leer", "léeme", "leeme",
+    "revisa", "revisar", "revísame", "revisame",
+    "extrae", "extraer", "extráeme", "extraeme",
+    "qué significa", "que significa",
+    "qué dice", "que dice",
+    "qué muestra", "que muestra",
+    "cómo interpreto", "como interpreto",
+    "cómo leo", "como leo",
+)
+
+# Patrones específicos adicionales
+_STORAGE_SPECIFIC_PATTERNS = (
+    "basado en mis",
+    "según mis",
+    "con base en mis",
+    "de acuerdo a mis",
+    "usando mis",
+    "a partir de mis",
+    "desde mis archivos",
+    "en mi storage",
+    "en mi bucket",
+    "de mi carpeta",
+    "mi último", "mi ultima",
+    "mi reciente", "mi más reciente",
+    "que tengo guardado", "que tengo almacenado",
+    "que he subido", "que subí",
+)
+
+
+def _substring_re(patterns: Tuple[str, ...]) -> "re.Pattern[str]":
+    """Alternancia que encuentra cualquiera de los substrings literales (sin repetidos)."""
+    return re.compile("|".join(re.escape(p) for p in dict.fromkeys(patterns)))
+
+
+_STORAGE_POSSESSIVE_RE = _substring_re(_STORAGE_POSSESSIVE_PATTERNS)
+_STORAGE_FILE_TYPE_RE = _substring_re(_STORAGE_FILE_TYPE_KEYWORDS)
+_STORAGE_ACTION_RE = _substring_re(_STORAGE_ACTION_VERBS)
+_STORAGE_SPECIFIC_RE = _substring_re(_STORAGE_SPECIFIC_PATTERNS)
+
+
+# Términos significativos (3+ caracteres) para la búsqueda en la memoria de la sesión
+_TERM_RE = re.compile(r"\w{3,}")
+
+
+# Keywords ya normalizadas y sin repetidos (las variantes con y sin tilde colapsan en una)
+_WEB_KEYWORDS_FOLDED = tuple(dict.fromkeys(_fold_text(k) for k in _ALWAYS_SEARCH_KEYWORDS + _FINANCIAL_SEARCH_KEYWORDS))
+_DATETIME_KEYWORDS_FOLDED = tuple(dict.fromkeys(_fold_text(k) for k in _DATETIME_KEYWORDS))
+
+# Una sola pasada sobre la consulta normalizada en lugar de un `in` por keyword
+_WEB_SEARCH_RE = re.compile("|".join(re.escape(k) for k in _WEB_KEYWORDS_FOLDED))
+_DATETIME_RE = re.compile("|".join(re.escape(k) for k in _DATETIME_KEYWORDS_FOLDED))
+
+# Ninguna consulta más corta que la keyword más corta ("ok", "si") puede contener una
+_MIN_KEYWORD_LEN = min(map(len, _WEB_KEYWORDS_FOLDED + _DATETIME_KEYWORDS_FOLDED))
+
+
+def _build_keyword_automaton() -> Any:
+    """Autómata Aho-Corasick con todas las keywords, cada una etiquetada con su categoría ("web" / "dt")."""
+    automaton = ahocorasick.Automaton()
+    for keyword in _DATETIME_KEYWORDS_FOLDED:
+        automaton.add_word(keyword, "dt")
+    # Las de búsqueda se insertan después: ante una keyword repetida gana "web"
+    for keyword in _WEB_KEYWORDS_FOLDED:
+        automaton.add_word(keyword, "web")
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton() if _has_ahocorasick else None
+
+
+@functools.lru_cache(maxsize=2048)
+def _classify_query(query: str) -> Optional[str]:
+    """
+    "web" si la consulta necesita búsqueda, "dt" si solo pide fecha/hora, None si ninguna.
+    La consulta se normaliza como las keywords (_fold_text). Con pyahocorasick es una única
+    pasada lineal sobre ella; sin él, dos regex precompiladas.
+    Memoizada: una misma consulta se clasifica una vez por request aunque se consulte varias veces
+    (_choose_model_and_tools y los caminos de chat) y las consultas frecuentes no se re-escanean.
+    """
+    folded = _fold_text(query)
+    if len(folded) < _MIN_KEYWORD_LEN:
+        return None
+    if _KEYWORD_AUTOMATON is not None:
+        category = None
+        for _, kind in _KEYWORD_AUTOMATON.iter(folded):
+            if kind == "web":
+                return "web"
+            category = kind
+        return category
+    if _WEB_SEARCH_RE.search(folded):
+        return "web"
+    if _DATETIME_RE.search(folded):
+        return "dt"
+    return None
+
+# Patrón para detectar URLs en el mensaje del usuario (compilado una vez). Una sola clase de
+# caracteres (reservados + no reservados de RFC 3986 y %) en lugar de una alternación repetida:
+# sin backtracking catastrófico; con google-re2 instalado además el matching es en tiempo lineal
+_URL_PATTERN = r"https?://[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]+"
+_URL_RE = re2.compile(_URL_PATTERN) if _has_re2 else re.compile(_URL_PATTERN)
+
+# Archivos del storage que nunca se envían al modelo (str.endswith acepta la tupla completa)
+_EXCLUDED_FILE_SUFFIXES = ('.html', '-.emptyFolder', '.gitkeep')
+_IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
+@dataclass(slots=True, frozen=True)
+class _StorageFile:
+    """Entrada del listado de storage del backend (acceso por atributo en lugar de claves de dict)."""
+    name: str
+    user_id: str
+    ext: Optional[str] = None
+    path: Optional[str] = None
+    size: Optional[int] = None
+    updated_at: Optional[str] = None
+
+
+@dataclass
+class _StorageFileSet:
+    """Listado del storage agrupado por tipo en una sola pasada (una lista por tipo)."""
+    json_names: List[str] = field(default_factory=list)
+    md_names: List[str] = field(default_factory=list)
+    image_paths: List[str] = field(default_factory=list)
+    pdf_refs: List[Tuple[str, str]] = field(default_factory=list)
+
+
 class ChatAgentService:
     """Servicio independiente del agente de chat"""
     
     def __init__(self):
-        self.client = client
-        self.sessions: Dict[str, Dict] = {}
-        self.active_sessions = 0
-        self.http_client = httpx.AsyncClient(timeout=30.0)
+        self._client = None  # se crea en el primer acceso a self.client
+        self.session_store = build_session_store()
+        # Cliente del backend/storage compartido por todas las peticiones: pool keep-alive
+        # (mismos límites que el de Gemini) y conexión acotada a 5 s para fallar rápido
+        self.http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            **_gemini_transport_args,
+        )
         self._backend_base_url = settings.get_backend_url().rstrip("/")
         self.supabase = None
+        # Cachés de contexto de Gemini: (clave, modelo) -> (nombre del CachedContent | None, expira_en)
+        self._prompt_caches: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}
+        self.llm_cache = build_llm_cache()
+        self.semantic_cache = build_semantic_cache()
+        # Contexto de storage por usuario: user_id -> (firma del listado, contexto, JSON serializado)
+        self._storage_ctx_cache: Dict[str, Tuple[str, Dict[str, Any], str]] = {}
+        # Tareas en segundo plano (resúmenes de historial, guardado en storage); se guarda la referencia para que no se recolecten
+        self._background_tasks: set = set()
+        # Locks por shard para secciones leer-llamar-escribir que cruzan awaits (creación de cachés
+        # de contexto, resumen de una sesión); 16 shards reducen la contención frente a un lock global
+        self._shard_locks: Tuple[asyncio.Lock, ...] = tuple(asyncio.Lock() for _ in range(16))
+        # Respuestas de chat en curso por huella (modelo, prompt, herramientas, historial): peticiones
+        # idénticas simultáneas esperan la misma llamada a Gemini en lugar de repetirla
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Última sesión usada por usuario (solo con reutilización en caliente activada):
+        # user_id -> (session_id, instante monotónico), del uso más antiguo al más reciente
+        self._user_recent_sessions: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # Funciones declaradas al modelo: nombre -> handler async (session_id, **args)
+        self._tool_dispatch: Dict[str, Callable[..., Awaitable[Dict[str, Any]]]] = {
+            "get_current_datetime": _session_agnostic_tool(get_current_datetime),
+            "recall_memory": self._search_session_memory,
+        }
         
-        if not self.client:
+        if not api_key:
             raise Exception("Cliente Gemini no disponible")
         
         self.supabase_bucket = settings.supabase_bucket_name or "portfolio-files"
         
         # ✅ Ya no usamos prefijos hardcodeados, ahora usamos user_id dinámicamente
     
-    def get_health_status(self) -> Dict[str, Any]:
+    @property
+    def client(self) -> "genai.Client":
+        if self._client is None:
+            self._client = _get_client()
+        return self._client
+
+    @client.setter
+    def client(self, value: "genai.Client") -> None:
+        self._client = value
+
+    async def get_health_status(self) -> Dict[str, Any]:
         """Obtener estado del servicio"""
         return {
             "status": "healthy" if self.client else "unhealthy",
             "service": settings.service_name,
             "version": settings.service_version,
             "models_available": [settings.model_flash, settings.model_pro],
-            "active_sessions": self.active_sessions,
+            "active_sessions": await self.session_store.count(),
             "capabilities": [
                 "financial_analysis",
                 "google_search_grounding",  # ✅ Nuevo
@@ -295,32 +1050,155 @@ class ChatAgentService:
             ]
         }
     
-    def create_session(self) -> str:
+    async def create_session(self) -> str:
         """Crear nueva sesión de chat"""
         session_id = str(uuid.uuid4())
-        self.sessions[session_id] = {
-            "id": session_id,
-            "created_at": datetime.now().isoformat(),
-            "messages": [],
-            "model_used": settings.model_flash,
-            "last_activity": datetime.now().isoformat()
-        }
-        self.active_sessions += 1
+        await self.session_store.create(session_id, settings.model_flash, now_iso_coarse())
         return session_id
     
-    def get_session_info(self, session_id: str) -> Optional[Dict[str, Any]]:
+    async def _resolve_session(self, session_id: Optional[str], user_id: Optional[str]) -> str:
+        """
+        Sesión a usar para un mensaje. Sin session_id válido se reutiliza la última sesión del
+        usuario si estuvo activa hace menos de `session_warm_reuse_seconds` (su prefijo sigue en la
+        caché implícita de Gemini); si no, se crea una nueva.
+        """
+        if not session_id or not await self.session_store.exists(session_id):
+            session_id = None
+            window = settings.session_warm_reuse_seconds
+            recent = self._user_recent_sessions.get(user_id) if user_id and window > 0 else None
+            if recent and time.monotonic() - recent[1] <= window and await self.session_store.exists(recent[0]):
+                session_id = recent[0]
+            if session_id is None:
+                session_id = await self.create_session()
+        if user_id and settings.session_warm_reuse_seconds > 0:
+            self._remember_recent_session(user_id, session_id)
+        return session_id
+
+    def _remember_recent_session(self, user_id: str, session_id: str) -> None:
+        """Registra la última sesión del usuario; desaloja las que salieron de la ventana y acota el mapa (LRU)."""
+        now = time.monotonic()
+        recent = self._user_recent_sessions
+        recent[user_id] = (session_id, now)
+        recent.move_to_end(user_id)
+        # Ordenado por último uso: las expiradas están al principio
+        window = settings.session_warm_reuse_seconds
+        while recent:
+            _, (_, used_at) = next(iter(recent.items()))
+            if now - used_at <= window and len(recent) <= settings.session_max_sessions:
+                break
+            recent.popitem(last=False)
+    
+    async def _record_message(self, session_id: str, role: MessageRole, content: str, **fields: Any) -> int:
+        """Agrega un mensaje al historial de la sesión y retorna el número de mensajes retenidos."""
+        now_iso = datetime.now().isoformat()
+        message = _make_message(role, content, now_iso)
+        # El Content para Gemini se construye una sola vez, al registrar el mensaje
+        gemini_content = types.Content(
+            role="user" if role == MessageRole.USER else "model",
+            parts=[types.Part.from_text(text=content)],
+        )
+        return await self.session_store.append_message(
+            session_id, message, content=gemini_content, last_activity=now_iso, **fields
+        )
+    
+    async def _history_contents(self, session_id: str, limit: int) -> List[types.Content]:
+        """
+        Mensajes posteriores al último resumen (al menos los últimos `limit`) como types.Content,
+        excluyendo el último (el mensaje actual del usuario). Entre actualizaciones del resumen el
+        historial solo crece por el final, así que el prefijo enviado a Gemini es idéntico turno a
+        turno y la caché implícita de prompts lo reutiliza (una ventana deslizante lo cambiaba siempre).
+        Reutiliza los Content guardados por el store en memoria; con Redis se reconstruyen desde los dicts.
+        """
+        # Mensajes y resumen se leen en paralelo (dos round-trips independientes con Redis)
+        messages, fields = await asyncio.gather(
+            self.session_store.recent_messages(session_id, settings.session_max_messages),
+            self.session_store.get_fields(session_id, "summary", "summarized_through"),
+        )
+        summarized_through = fields.get("summarized_through") or ""
+        pending = len(messages)
+        while pending > limit and messages[-pending]["timestamp"] <= summarized_through:
+            pending -= 1
+        contents = await self.session_store.recent_contents(session_id, pending)
+        if contents is None:
+            contents = [
+                types.Content(
+                    role="user" if msg["role"] == "user" else "model",
+                    parts=[types.Part.from_text(text=msg["content"])],
+                )
+                for msg in messages[len(messages) - pending:]
+            ]
+        history = contents[:-1]
+        # Presupuesto de tokens: se conservan los mensajes más recientes que quepan (mensajes muy largos
+        # pegados por el usuario no inflan cada turno siguiente)
+        used = 0
+        for index in range(len(history) - 1, -1, -1):
+            used += sum(_local_token_count(part.text or "") for part in history[index].parts)
+            if used > _HISTORY_TOKEN_BUDGET:
+                history = history[index + 1:]
+                break
+        # Los mensajes fuera de la ventana viajan como un único resumen al inicio
+        summary = fields.get("summary")
+        if summary:
+            history.insert(0, types.Content(
+                role="user",
+                parts=[types.Part.from_text(text=f"Resumen de la conversación previa: {summary}")],
+            ))
+        return history
+    
+    def _shard_lock(self, key: str) -> asyncio.Lock:
+        return self._shard_locks[hash(key) & 15]
+    
+    def _spawn_background(self, coro: Awaitable[Any]) -> asyncio.Task:
+        """Ejecuta `coro` fuera del camino de la respuesta (las corrutinas deben manejar sus propios errores)."""
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    def _schedule_summary_refresh(self, session_id: str, message_count: int) -> None:
+        """Lanza en segundo plano la actualización del resumen si ya hay mensajes fuera de la ventana."""
+        if message_count <= _HISTORY_WINDOW:
+            return
+        self._spawn_background(self._refresh_summary(session_id))
+    
+    async def _refresh_summary(self, session_id: str) -> None:
+        """
+        Resume con Flash los mensajes que salieron de la ventana desde el último resumen,
+        solo cuando se acumulan al menos _SUMMARY_BATCH (el resumen se actualiza de forma perezosa).
+        """
+        try:
+            # Un solo resumen a la vez por sesión: dos turnos seguidos no resumen los mismos mensajes
+            async with self._shard_lock(f"summary:{session_id}"):
+                fields = await self.session_store.get_fields(session_id, "summary", "summarized_through")
+                summarized_through = fields.get("summarized_through") or ""
+                messages = await self.session_store.recent_messages(session_id, settings.session_max_messages)
+                pending = [m for m in messages[:-_HISTORY_WINDOW] if m["timestamp"] > summarized_through]
+                if len(pending) < _SUMMARY_BATCH:
+                    return
+                
+                transcript = "\n".join(f"{m['role']}: {m['content']}" for m in pending)
+                prompt = f"RESUMEN_PREVIO=\n{fields.get('summary') or '(ninguno)'}\n\nMENSAJES_NUEVOS=\n{transcript}"
+                response = await self.client.aio.models.generate_content(
+                    model=settings.model_flash,
+                    contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+                    config=types.GenerateContentConfig(
+                        temperature=0.2,
+                        max_output_tokens=512,
+                        system_instruction=SUMMARY_INSTRUCTION,
+                    ),
+                )
+                if response.text:
+                    await self.session_store.update(
+                        session_id,
+                        summary=response.text.strip(),
+                        summarized_through=pending[-1]["timestamp"],
+                    )
+        except Exception as e:
+            logger.warning("⚠️ No se pudo actualizar el resumen de la sesión %s: %s", session_id, e)
+    
+    async def get_session_info(self, session_id: str) -> Optional[Dict[str, Any]]:
         """Obtener información de sesión"""
-        session = self.sessions.get(session_id)
-        if not session:
-            return None
-        
-        return {
-            "session_id": session_id,
-            "created_at": session["created_at"],
-            "message_count": len(session["messages"]),
-            "model_used": session["model_used"],
-            "last_activity": session["last_activity"]
-        }
+        return await self.session_store.get_info(session_id)
     
     def _choose_model_and_tools(self, query: str, file_path: Optional[str] = None, url: Optional[str] = None) -> tuple:
         """
@@ -338,29 +1216,27 @@ class ChatAgentService:
         # Si hay archivo local, usar Pro para análisis profundo
         if file_path:
             # Pro con URL Context (sin function calling)
-            url_context_tool = types.Tool(url_context=types.UrlContext())
-            tools.append(url_context_tool)
+            tools.append(TOOL_URL_CONTEXT)
             tool_names.append("url_context")
             return settings.model_pro, tools, tool_names
         
         # Si hay URL explícita, agregar URL Context (sin function calling)
         if url:
-            url_context_tool = types.Tool(url_context=types.UrlContext())
-            tools.append(url_context_tool)
+            tools.append(TOOL_URL_CONTEXT)
             tool_names.append("url_context")
             return settings.model_flash, tools, tool_names
         
+        category = _classify_query(query)
+
         # Si necesita búsqueda web, agregar Google Search (sin function calling)
-        if self._needs_web_search(query):
-            google_search_tool = types.Tool(google_search=types.GoogleSearch())
-            tools.append(google_search_tool)
+        if category == "web":
+            tools.append(TOOL_GOOGLE_SEARCH)
             tool_names.append("google_search")
             return settings.model_flash, tools, tool_names
         
         # Si necesita información temporal, usar SOLO function calling
-        if self._needs_datetime(query):
-            datetime_tool = types.Tool(function_declarations=[GET_DATETIME_DECLARATION])
-            tools.append(datetime_tool)
+        if category == "dt":
+            tools.append(TOOL_DATETIME)
             tool_names.append("get_current_datetime")
             return settings.model_flash, tools, tool_names
         
@@ -372,82 +1248,24 @@ class ChatAgentService:
         Determinar si la consulta necesita búsqueda web.
         Activar búsqueda para: noticias, precios actuales, información en tiempo real.
         """
-        query_lower = query.lower()
-        
-        # Keywords que SIEMPRE activan búsqueda (noticias, precios actuales)
-        always_search_keywords = [
-            # Noticias
-            "noticia", "noticias", "news", "headline", "titulares",
-            
-            # Precios/Cotizaciones actuales
-            "precio", "cotización", "cotiza", "vale", "cuesta", "price",
-            "cuánto está", "cuánto vale", "a cuánto", "cómo está",
-            "cómo va", "cómo anda", "cómo cerró",
-            
-            # Información en tiempo real
-            "actual", "hoy", "ahora", "latest", "current", "today",
-            "reciente", "última", "últimas", "último", "últimos",
-            "recent", "now", "this week", "esta semana",
-            
-            # Mercados en vivo
-            "mercado hoy", "bolsa hoy", "trading", "session",
-            
-            # Búsqueda explícita
-            "busca", "buscar", "search", "encuentra", "find",
-            "dime", "cuéntame", "qué hay", "qué pasa", "qué pasó"
-        ]
-        
-        # Si tiene cualquiera de estos, activar búsqueda
-        if any(keyword in query_lower for keyword in always_search_keywords):
-            return True
-        
-        # Keywords financieros específicos que también activan búsqueda
-        financial_keywords = [
-            # Empresas/Tickers (preguntar por ellos implica querer info actual)
-            "apple", "microsoft", "google", "amazon", "tesla", "nvidia", "meta",
-            "aapl", "msft", "googl", "amzn", "tsla", "nvda",
-            
-            # Índices
-            "s&p 500", "sp500", "nasdaq", "dow jones", "ibex", "dax",
-            
-            # Criptomonedas
-            "bitcoin", "btc", "ethereum", "eth", "crypto",
-            
-            # Commodities
-            "oro", "gold", "petróleo", "oil", "plata", "silver",
-            
-            # Macro
-            "fed", "bce", "banco central", "tasa de interés", "inflación",
-            "pib", "gdp", "empleo"
-        ]
-        
-        if any(keyword in query_lower for keyword in financial_keywords):
-            return True
-        
-        return False
+        return _classify_query(query) == "web"
     
     def _needs_datetime(self, query: str) -> bool:
         """
         Determinar si la consulta necesita información de fecha/hora.
         Solo retorna True si NO necesita búsqueda web (para evitar conflictos).
         """
-        # No usar datetime si ya necesita web search
-        if self._needs_web_search(query):
-            return False
-        
-        # Keywords que indican solo fecha/hora sin búsqueda
-        datetime_keywords = [
-            "qué hora es", "qué día es", "fecha actual", "hora actual",
-            "qué fecha es", "hora es ahora", "día de la semana",
-            "cuándo es", "mes actual", "año actual"
-        ]
-        query_lower = query.lower()
-        return any(keyword in query_lower for keyword in datetime_keywords)
+        return _classify_query(query) == "dt"
     
-    def _is_user_storage_query(self, query: str) -> bool:
+    def _is_direct_datetime_question(self, query: str) -> bool:
+        """Pregunta corta que solo pide la fecha/hora (p. ej. "¿qué hora es?"): se responde con plantilla."""
+        return len(query.split()) <= 6 and self._needs_datetime(query)
+    
+    def _is_user_storage_query(self, query_lower: str) -> bool:
         """
         Detecta si el usuario está preguntando sobre SUS archivos en Supabase Storage.
         Reconoce patrones posesivos y referencias a archivos del usuario.
+        `query_lower` es el mensaje ya pasado a minúsculas por el llamador (una vez por petición).
         
         Ejemplos que debería detectar:
         - "¿Qué significa mi gráfico de Monte Carlo?"
@@ -458,113 +1276,24 @@ class ChatAgentService:
         - "¿Qué dicen mis datos?"
         - "Muéstrame mi historial de inversiones"
         """
-        query_lower = query.lower()
-        
-        # Patrones posesivos en español
-        possessive_patterns = [
-            "mi ", "mis ", "mío", "mía", "míos", "mías",
-            "el mio", "la mia", "los mios", "las mias",
-            "mi archivo", "mis archivos", "mi documento", "mis documentos",
-            "mi gráfico", "mis gráficos", "mi grafico", "mis graficos",
-            "mi imagen", "mis imágenes", "mi imagen", "mis imagenes",
-            "mi reporte", "mis reportes", "mi informe", "mis informes",
-            "mi análisis", "mis análisis", "mi analisis", "mis analisis",
-            "mi portafolio", "mi portfolio", "mi cartera",
-            "mi json", "mis json", "mi pdf", "mis pdf",
-            "mi chart", "mis charts", "mi data", "mis datos",
-        ]
-        
-        # Palabras clave de tipos de archivos/visualizaciones
-        file_type_keywords = [
-            # Gráficos y visualizaciones
-            "gráfico", "grafico", "gráficos", "graficos",
-            "chart", "charts", "plot", "plots",
-            "visualización", "visualizacion", "visualizaciones",
-            "diagrama", "diagramas",
-            
-            # Tipos de análisis comunes en finanzas
-            "monte carlo", "montecarlo", "simulación", "simulacion",
-            "correlación", "correlacion", "heatmap",
-            "drawdown", "volatilidad", "riesgo",
-            "pie chart", "bar chart", "line chart",
-            "candlestick", "velas",
-            "scatter", "distribución", "distribucion",
-            "histograma", "histogram",
-            
-            # Tipos de archivos
-            "json", "pdf", "imagen", "imágenes", "imagenes",
-            "png", "jpg", "jpeg",
-            
-            # Documentos de análisis
-            "reporte", "informe", "análisis", "analisis",
-            "resumen", "summary", "documento",
-        ]
-        
-        # Verbos de acción sobre archivos personales
-        action_verbs = [
-            "analiza", "analizar", "analízame", "analizame",
-            "explica", "explicar", "explícame", "explicame",
-            "interpreta", "interpretar", "interprétame", "interpretame",
-            "muestra", "mostrar", "muéstrame", "muestrame",
-            "describe", "describir", "descríbeme", "describeme",
-            "resume", "resumir", "resúmeme", "resumeme",
-            "lee", "leer", "léeme", "leeme",
-            "revisa", "revisar", "revísame", "revisame",
-            "extrae", "extraer", "extráeme", "extraeme",
-            "qué significa", "que significa",
-            "qué dice", "que dice",
-            "qué muestra", "que muestra",
-            "cómo interpreto", "como interpreto",
-            "cómo leo", "como leo",
-        ]
-        
-        # Detectar patrón posesivo + tipo de archivo
-        has_possessive = any(pattern in query_lower for pattern in possessive_patterns)
-        has_file_type = any(keyword in query_lower for keyword in file_type_keywords)
-        has_action = any(verb in query_lower for verb in action_verbs)
-        
-        # Si tiene posesivo y tipo de archivo → es consulta de storage
-        if has_possessive and has_file_type:
-            return True
-        
-        # Si tiene posesivo y verbo de acción → probable consulta de storage
-        if has_possessive and has_action:
+        # Posesivo + tipo de archivo → consulta de storage; posesivo + verbo de acción → probable
+        if _STORAGE_POSSESSIVE_RE.search(query_lower) and (
+            _STORAGE_FILE_TYPE_RE.search(query_lower) or _STORAGE_ACTION_RE.search(query_lower)
+        ):
             return True
         
         # Patrones específicos adicionales
-        specific_patterns = [
-            "basado en mis",
-            "según mis",
-            "con base en mis",
-            "de acuerdo a mis",
-            "usando mis",
-            "a partir de mis",
-            "desde mis archivos",
-            "en mi storage",
-            "en mi bucket",
-            "de mi carpeta",
-            "mi último", "mi ultima",
-            "mi reciente", "mi más reciente",
-            "que tengo guardado", "que tengo almacenado",
-            "que he subido", "que subí",
-        ]
-        
-        if any(pattern in query_lower for pattern in specific_patterns):
-            return True
-        
-        return False
+        return _STORAGE_SPECIFIC_RE.search(query_lower) is not None
     
-    def _is_financial_query(self, query: str, has_files: bool = False) -> bool:
+    def _is_financial_query(self, query_lower: str, has_files: bool = False) -> bool:
         """
         Determina si la consulta está relacionada con finanzas.
         Retorna True si es financiera, False si no lo es.
         
         Args:
-            query: El mensaje del usuario
+            query_lower: El mensaje del usuario, ya en minúsculas
             has_files: Si hay archivos adjuntos (PDF, imágenes), ser más permisivo
         """
-        query_lower = query.lower()
-        
         # Keywords que indican consulta FINANCIERA
         financial_keywords = [
             # Términos directos de finanzas (incluyendo variaciones)
@@ -663,52 +1392,355 @@ class ChatAgentService:
             "¿Tienes alguna consulta sobre estos temas?"
         )
     
-    def _extract_urls_from_query(self, query: str) -> List[str]:
-        """Extraer URLs del mensaje del usuario"""
-        # Patrón para detectar URLs
-        url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        urls = re.findall(url_pattern, query)
-        return urls
+    def _extract_urls_from_query(self, query: str) -> List[str]:
+        """Extraer URLs del mensaje del usuario"""
+        return _URL_RE.findall(query)
+    
+    def _add_citations_to_text(self, text: str, grounding_metadata) -> str:
+        """
+        Agregar citaciones en línea al texto basado en groundingMetadata.
+        Implementación basada en el tutorial.md
+        """
+        if not grounding_metadata:
+            return text
+        
+        try:
+            supports = grounding_metadata.grounding_supports
+            chunks = grounding_metadata.grounding_chunks
+            
+            if not supports or not chunks:
+                return text
+            
+            # Ordenar supports por end_index en orden descendente para evitar problemas de desplazamiento
+            sorted_supports = sorted(supports, key=lambda s: s.segment.end_index, reverse=True)
+            
+            for support in sorted_supports:
+                end_index = support.segment.end_index
+                if support.grounding_chunk_indices:
+                    # Crear string de citación como [1](link1), [2](link2)
+                    citation_links = []
+                    for i in support.grounding_chunk_indices:
+                        if i < len(chunks):
+                            uri = chunks[i].web.uri
+                            citation_links.append(f"[{i + 1}]({uri})")
+                    citation_string = " " + ", ".join(citation_links)
+                    text = text[:end_index] + citation_string + text[end_index:]
+            
+            return text
+        except Exception as e:
+            logger.warning("⚠️ Error agregando citaciones: %s", e)
+            return text
+
+    @staticmethod
+    def _grounding_fields(grounding_metadata: Any) -> Dict[str, Any]:
+        """Campos de metadata de respuesta a partir del grounding (consultas de búsqueda y fuentes web)."""
+        fields: Dict[str, Any] = {"grounding_used": True}
+        queries = getattr(grounding_metadata, "web_search_queries", None)
+        if queries is not None:
+            fields["search_queries"] = queries
+        chunks = getattr(grounding_metadata, "grounding_chunks", None)
+        if chunks:
+            # Los chunks sin fuente web (p. ej. contexto recuperado) tienen web=None
+            fields["sources"] = [
+                {"title": web.title, "uri": web.uri}
+                for chunk in chunks if (web := getattr(chunk, "web", None)) is not None
+            ]
+        return fields
+
+    # =====================
+    # Caché de contexto (prompts estáticos)
+    # =====================
+    async def _get_prompt_cache(
+        self,
+        cache_key: str,
+        model: str,
+        prefix: Optional[List[types.Content]] = None,
+        system_instruction: Optional[str] = None,
+        tools: Optional[List[types.Tool]] = None,
+    ) -> Optional[str]:
+        """
+        Devuelve el nombre del CachedContent de Gemini que contiene el prefijo estático
+        (y las herramientas, que forman parte del prefijo cacheable),
+        creándolo la primera vez por (clave, modelo). Retorna None si el caché está
+        deshabilitado, si el prefijo no alcanza el mínimo de tokens del modelo (estimado
+        localmente: no se llega a llamar a caches.create) o si no pudo crearse; en ese caso
+        el llamador envía el prefijo inline y el create se reintenta al expirar el TTL.
+        """
+        if not settings.enable_prompt_cache:
+            return None
+
+        entry = self._prompt_caches.get((cache_key, model))
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        if not _prompt_cache_eligible(model, prefix, system_instruction, tools):
+            # El prefijo de una clave es estático: nunca alcanzará el mínimo, no se vuelve a evaluar
+            self._prompt_caches[(cache_key, model)] = (None, float("inf"))
+            return None
+
+        # Single-flight: peticiones concurrentes esperan al primer create en lugar de duplicar cachés
+        async with self._shard_lock(f"prompt_cache:{cache_key}:{model}"):
+            entry = self._prompt_caches.get((cache_key, model))
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+
+            # Por encima del margen de 60s de abajo: con TTL=60 la vida local sería 0 y cada request
+            # crearía (y dejaría huérfano) un caché nuevo en el servidor
+            ttl = max(int(settings.prompt_cache_ttl_seconds), 120)
+            name: Optional[str] = None
+            try:
+                cached = await self.client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"horizon-{cache_key}",
+                        contents=prefix or None,
+                        system_instruction=system_instruction,
+                        tools=tools or None,
+                        ttl=f"{ttl}s",
+                    ),
+                )
+                name = getattr(cached, "name", None)
+                if name:
+                    logger.info("🗄️ Caché de contexto '%s' creado para %s: %s", cache_key, model, name)
+            except Exception as e:
+                logger.warning("⚠️ No se pudo crear caché de contexto '%s' para %s: %s", cache_key, model, e)
+
+            # Margen de 60s para no referenciar un caché a punto de expirar en el servidor
+            self._prompt_caches[(cache_key, model)] = (name, time.monotonic() + ttl - 60)
+            return name
+
+    def _invalidate_prompt_cache(self, cache_key: str, model: str) -> None:
+        self._prompt_caches.pop((cache_key, model), None)
+
+    @staticmethod
+    def _is_cache_not_found_error(error: Exception) -> bool:
+        """True si Gemini rechazó la llamada porque el CachedContent ya no existe."""
+        if not isinstance(error, genai_errors.ClientError):
+            return False
+        return error.code in (403, 404) and "cache" in str(error).lower()
+
+    async def _generate_text_stream(
+        self,
+        model: str,
+        contents: List[types.Content],
+        config: types.GenerateContentConfig,
+    ) -> Tuple[str, Optional[Any]]:
+        """
+        Consume generate_content_stream y devuelve (texto completo, objeto JSON).
+        Con salida JSON e ijson disponible el objeto se parsea incrementalmente mientras llegan
+        los chunks; si no, o si el JSON es inválido, el objeto es None y se parsea el texto.
+        """
+        chunks: List[str] = []
+        parser = None
+        if _has_ijson and config.response_mime_type == "application/json":
+            parser = _IncrementalJSONParser()
+        stream = await self.client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config,
+        )
+        async for chunk in stream:
+            if chunk.text:
+                chunks.append(chunk.text)
+                if parser:
+                    parser.feed(chunk.text)
+        return "".join(chunks), parser.result() if parser else None
+
+    async def _generate_with_prompt_cache(
+        self,
+        model: str,
+        cache_key: str,
+        contents: List[types.Content],
+        config: types.GenerateContentConfig,
+        prefix: Optional[List[types.Content]] = None,
+        system_instruction: Optional[str] = None,
+        stream: bool = False,
+        tools: Optional[List[types.Tool]] = None,
+    ):
+        """
+        generate_content reutilizando el prefijo estático cacheado en Gemini.
+        Si no hay caché disponible (o expiró en el servidor) se envía el prefijo inline.
+        Con stream=True se usa generate_content_stream y se retorna (texto acumulado, objeto JSON | None).
+        """
+        async def call(call_contents: List[types.Content], call_config: types.GenerateContentConfig):
+            if stream:
+                return await self._generate_text_stream(model, call_contents, call_config)
+            return await self.client.aio.models.generate_content(
+                model=model,
+                contents=call_contents,
+                config=call_config,
+            )
+
+        cache_name = await self._get_prompt_cache(cache_key, model, prefix, system_instruction, tools)
+        if cache_name:
+            try:
+                return await call(contents, config.model_copy(update={"cached_content": cache_name}))
+            except Exception as e:
+                if not self._is_cache_not_found_error(e):
+                    raise
+                logger.warning("⚠️ Caché de contexto '%s' expirado para %s, enviando prompt inline", cache_key, model)
+                self._invalidate_prompt_cache(cache_key, model)
+
+        inline_config = config
+        if system_instruction or tools:
+            inline_config = config.model_copy(update={
+                "system_instruction": system_instruction or None,
+                "tools": tools or None,
+            })
+        return await call(list(prefix or []) + list(contents), inline_config)
+
+    @staticmethod
+    def _chat_prompt_cache_key(system_prompt: str, tools: Optional[List[types.Tool]], model: str) -> Optional[str]:
+        """
+        Clave de caché de contexto del chat: system prompt estático + tipos de herramienta.
+        None si el prompt es dinámico o si prompt + herramientas no alcanzan el mínimo cacheable
+        del modelo (los system prompts actuales no lo alcanzan): el turno usa la config inline
+        sin pasar por el caché de contexto.
+        """
+        if system_prompt == PRO_SYSTEM_PROMPT:
+            base = "pro_system_prompt"
+        elif system_prompt == FLASH_SYSTEM_PROMPT:
+            base = "flash_system_prompt"
+        else:
+            return None
+        # Las herramientas de funciones se distinguen por nombre (datetime y recall_memory no comparten caché)
+        tool_kinds = sorted(
+            kind
+            for tool in tools or []
+            for kind in (
+                [d.name for d in tool.function_declarations]
+                if tool.function_declarations
+                else tool.model_dump(exclude_none=True)
+            )
+        )
+        cache_key = "+".join([base, *tool_kinds])
+        eligible = _CHAT_PROMPT_CACHE_ELIGIBLE.get((cache_key, model))
+        if eligible is None:
+            eligible = _CHAT_PROMPT_CACHE_ELIGIBLE[(cache_key, model)] = _prompt_cache_eligible(
+                model, None, system_prompt, tools
+            )
+        return cache_key if eligible else None
+    
+    async def _embed_text(self, text: str) -> Optional[List[float]]:
+        """Embedding de un texto con el modelo configurado; None si la llamada falla."""
+        return (await self._embed_texts([text]))[0]
     
-    def _add_citations_to_text(self, text: str, grounding_metadata) -> str:
+    async def _embed_texts(self, texts: List[str]) -> List[Optional[List[float]]]:
         """
-        Agregar citaciones en línea al texto basado en groundingMetadata.
-        Implementación basada en el tutorial.md
+        Embeddings de varios textos con una llamada embed_content por lote de _EMBED_BATCH_SIZE
+        (no una por texto). Los lotes que fallan devuelven None en sus posiciones.
         """
-        if not grounding_metadata:
-            return text
-        
-        try:
-            supports = grounding_metadata.grounding_supports
-            chunks = grounding_metadata.grounding_chunks
-            
-            if not supports or not chunks:
-                return text
-            
-            # Ordenar supports por end_index en orden descendente para evitar problemas de desplazamiento
-            sorted_supports = sorted(supports, key=lambda s: s.segment.end_index, reverse=True)
-            
-            for support in sorted_supports:
-                end_index = support.segment.end_index
-                if support.grounding_chunk_indices:
-                    # Crear string de citación como [1](link1), [2](link2)
-                    citation_links = []
-                    for i in support.grounding_chunk_indices:
-                        if i < len(chunks):
-                            uri = chunks[i].web.uri
-                            citation_links.append(f"[{i + 1}]({uri})")
-                    citation_string = " " + ", ".join(citation_links)
-                    text = text[:end_index] + citation_string + text[end_index:]
-            
-            return text
-        except Exception as e:
-            print(f"⚠️ Error agregando citaciones: {e}")
-            return text
+        embeddings: List[Optional[List[float]]] = []
+        for start in range(0, len(texts), _EMBED_BATCH_SIZE):
+            batch = texts[start:start + _EMBED_BATCH_SIZE]
+            try:
+                result = await self.client.aio.models.embed_content(
+                    model=settings.embedding_model,
+                    contents=batch,
+                )
+                values = [list(e.values) for e in result.embeddings or []]
+                if len(values) != len(batch):
+                    raise ValueError(f"se esperaban {len(batch)} embeddings y llegaron {len(values)}")
+                embeddings.extend(values)
+            except Exception as e:
+                logger.warning("⚠️ No se pudo calcular el embedding: %s", e)
+                embeddings.extend([None] * len(batch))
+        return embeddings
     
+    async def _generate_with_fallback(
+        self,
+        model: str,
+        contents: List[types.Content],
+        config: types.GenerateContentConfig,
+        fallbacks: Mapping[str, Tuple[str, ...]] = _MODEL_FALLBACKS,
+        call: Optional[Callable[[str], Awaitable[Any]]] = None,
+        hedge_delay: Optional[float] = None,
+    ) -> Tuple[Any, str]:
+        """
+        Llama al modelo recorriendo la cadena de fallback mientras el error sea de sobrecarga.
+        Cada modelo se reintenta una vez con backoff exponencial + jitter antes de escalar al siguiente.
+        `call(modelo)` permite sustituir la llamada por defecto (p. ej. con caché de contexto).
+        Con `hedge_delay`, si el modelo preferido no respondió tras esos segundos se lanza en paralelo
+        el primer alternativo y se usa la primera respuesta exitosa (la otra se cancela).
+        Retorna (respuesta, modelo que respondió).
+        """
+        async def attempt_model(try_model: str) -> Any:
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(2),
+                wait=wait_exponential_jitter(initial=0.5, max=4),
+                retry=retry_if_exception(_is_overloaded_error),
+                reraise=True,
+            ):
+                with attempt:
+                    if call is not None:
+                        return await call(try_model)
+                    return await self.client.aio.models.generate_content(
+                        model=try_model,
+                        contents=contents,
+                        config=config,
+                    )
+
+        chain = _model_chain(model, fallbacks)
+        if hedge_delay is not None and len(chain) > 1:
+            hedged = await self._hedged_attempt(chain[:2], attempt_model, hedge_delay)
+            if hedged is not None:
+                return hedged
+            chain = chain[2:]
+
+        for try_model in chain:
+            try:
+                return await attempt_model(try_model), try_model
+            except Exception as model_error:
+                if not _is_overloaded_error(model_error):
+                    raise
+                logger.warning("⚠️ Modelo %s sobrecargado, probando siguiente...", try_model)
+        raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
+
+    @staticmethod
+    async def _hedged_attempt(
+        models: Tuple[str, ...],
+        attempt_model: Callable[[str], Awaitable[Any]],
+        hedge_delay: float,
+    ) -> Optional[Tuple[Any, str]]:
+        """
+        Petición con cobertura (hedging) entre el modelo preferido y su primer alternativo.
+        El alternativo solo se lanza si el preferido sigue sin responder tras `hedge_delay` segundos
+        (en el caso común no se paga una segunda llamada). Retorna (respuesta, modelo) de la primera
+        llamada exitosa, None si ambos estaban sobrecargados; otros errores se propagan.
+        """
+        primary, hedge = models
+        tasks: Dict[asyncio.Future, str] = {asyncio.ensure_future(attempt_model(primary)): primary}
+        hedge_launched = False
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            while True:
+                for task in done:
+                    try_model = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        return task.result(), try_model
+                    if not _is_overloaded_error(error):
+                        raise error
+                    logger.warning("⚠️ Modelo %s sobrecargado, probando siguiente...", try_model)
+                if not hedge_launched:
+                    # Preferido lento (se cubre en paralelo) o sobrecargado (el alternativo corre solo)
+                    if tasks:
+                        logger.warning("⏱️ %s sin respuesta tras %ss, lanzando %s en paralelo", primary, hedge_delay, hedge)
+                    tasks[asyncio.ensure_future(attempt_model(hedge))] = hedge
+                    hedge_launched = True
+                if not tasks:
+                    return None
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
     # =====================
     # Informe de análisis de portafolio
     # =====================
-    async def _close(self) -> None:
+    async def aclose(self) -> None:
+        """Libera recursos compartidos al apagar el servicio (lo llama el lifespan de main.py)."""
+        _auth_headers.cache_clear()
         try:
             await self.http_client.aclose()
         except Exception:
@@ -719,12 +1751,12 @@ class ChatAgentService:
         user_id: str,
         auth_token: Optional[str],
         extensions: Optional[List[str]] = None,
-    ) -> List[Dict[str, Any]]:
+    ) -> List[_StorageFile]:
         if not auth_token:
             return []
 
         ext_param = ",".join(extensions) if extensions else None
-        headers = {"Authorization": f"Bearer {auth_token}"}
+        headers = _auth_headers(auth_token)
         url = f"{self._backend_base_url}/api/storage/files"
 
         try:
@@ -738,28 +1770,26 @@ class ChatAgentService:
             files = payload.get("files")
             if not isinstance(files, list):
                 return []
-            normalized: List[Dict[str, Any]] = []
-            for item in files:
-                name = item.get("name")
-                if not name:
-                    continue
-                normalized.append({
-                    "name": name,
-                    "user_id": user_id,
-                    "ext": f".{item.get('ext', '').lower()}" if item.get("ext") else None,
-                    "path": item.get("full_path"),
-                    "size": item.get("size"),
-                    "updated_at": item.get("updated_at"),
-                })
-            return normalized
+            return [
+                _StorageFile(
+                    name=item["name"],
+                    user_id=user_id,
+                    ext=f".{item['ext'].lower()}" if item.get("ext") else None,
+                    path=item.get("full_path"),
+                    size=item.get("size"),
+                    updated_at=item.get("updated_at"),
+                )
+                for item in files
+                if item.get("name")
+            ]
         except httpx.HTTPStatusError as exc:
             status_code = exc.response.status_code
             if status_code == 401:
                 raise HTTPException(status_code=401, detail="Token inválido para acceso a storage") from exc
-            print(f"⚠️ Error HTTP listando archivos de backend: {exc}")
+            logger.warning("⚠️ Error HTTP listando archivos de backend: %s", exc)
             return []
         except Exception as exc:
-            print(f"⚠️ Error listando archivos vía backend: {exc}")
+            logger.warning("⚠️ Error listando archivos vía backend: %s", exc)
             return []
 
     async def _backend_download_file(
@@ -771,7 +1801,7 @@ class ChatAgentService:
         if not auth_token:
             raise PermissionError("Se requiere token de autenticación para descargar archivos")
 
-        headers = {"Authorization": f"Bearer {auth_token}"}
+        headers = _auth_headers(auth_token)
         url = f"{self._backend_base_url}/api/storage/download"
 
         try:
@@ -813,10 +1843,8 @@ class ChatAgentService:
         if not auth_token:
             raise PermissionError("Se requiere token de autenticación para subir archivos")
 
-        headers = {
-            "Authorization": f"Bearer {auth_token}",
-            "Content-Type": "application/json"
-        }
+        # httpx ya envía Content-Type: application/json con json=
+        headers = _auth_headers(auth_token)
         url = f"{self._backend_base_url}/api/storage/save-json"
 
         try:
@@ -839,6 +1867,67 @@ class ChatAgentService:
             logger.error(f"Error al subir archivo {filename}: {exc}")
             raise
 
+    @staticmethod
+    def _parse_text_file(name: str, data: bytes) -> Any:
+        """
+        Contenido de un archivo JSON/MD descargado. Los JSON se parsean directamente desde bytes
+        (sin decodificar antes); solo el Markdown y el JSON inválido ({"_raw": ...}) pasan a str. `data` es
+        siempre el cuerpo de _backend_download_file (bytes). Archivos mayores que
+        settings.storage_max_file_bytes no se incluyen en el contexto.
+        """
+        size = len(data)
+        if size > settings.storage_max_file_bytes:
+            logger.warning("⚠️ %s omitido del contexto (%s bytes > %s)", name, size, settings.storage_max_file_bytes)
+            if name.endswith(".json"):
+                return {"_truncated": True, "_size": size}
+            return f"[archivo omitido por tamaño: {size} bytes]"
+        if name.endswith(".json"):
+            try:
+                return _json_loads(data)
+            except Exception:
+                pass
+        text = data.decode("utf-8", "replace")
+        return {"_raw": text} if name.endswith(".json") else text
+
+    async def _download_files(
+        self, user_id: str, filenames: List[str], auth_token: Optional[str]
+    ) -> List[Any]:
+        """
+        Descarga en paralelo (~max(RTT) en lugar de N×RTT), con a lo sumo _DOWNLOAD_CONCURRENCY
+        peticiones a la vez para no saturar el backend. Retorna, en el orden pedido,
+        (bytes, content_type) o la excepción de cada archivo.
+        """
+        slots = asyncio.Semaphore(_DOWNLOAD_CONCURRENCY)
+
+        async def download(name: str) -> Tuple[bytes, Optional[str]]:
+            async with slots:
+                return await self._backend_download_file(user_id=user_id, filename=name, auth_token=auth_token)
+
+        return await asyncio.gather(*(download(name) for name in filenames), return_exceptions=True)
+
+    async def _download_text_files(
+        self, user_id: str, filenames: List[str], auth_token: Optional[str]
+    ) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Descarga en paralelo archivos JSON/MD del usuario.
+        Retorna (contenidos por nombre en el orden pedido, nombres faltantes o con error).
+        """
+        downloads = await self._download_files(user_id, filenames, auth_token)
+        file_contents: Dict[str, Any] = {}
+        missing_files: List[str] = []
+        for name, result in zip(filenames, downloads):
+            if isinstance(result, FileNotFoundError):
+                missing_files.append(name)
+                logger.warning("⚠️ Archivo %s no encontrado", name)
+                continue
+            if isinstance(result, BaseException):
+                missing_files.append(name)
+                logger.error("❌ Error leyendo %s: %s", name, result)
+                continue
+            file_contents[name] = self._parse_text_file(name, result[0])
+            logger.info("✅ Archivo leído: %s", name)
+        return file_contents, missing_files
+
     async def _gather_storage_context(self, user_id: str, auth_token: Optional[str]) -> Dict[str, Any]:
         """Compila contexto desde el backend: JSON/MD/PDF + imágenes."""
         files = await self._backend_list_files(
@@ -847,61 +1936,43 @@ class ChatAgentService:
             extensions=["json", "md", "png", "jpg", "jpeg", "pdf"],
         )
 
+        # Si el listado no cambió (rutas, fechas y tamaños) se reutiliza el contexto ya armado
+        signature = self._storage_files_signature(files)
+        cached = self._storage_ctx_cache.get(user_id)
+        if cached and cached[0] == signature:
+            return cached[1]
+
         json_docs: Dict[str, Any] = {}
         markdown_docs: Dict[str, str] = {}
-        images: List[Dict[str, Any]] = []
-        pdfs: List[Dict[str, Any]] = []
-
-        for file_info in files:
-            name = file_info.get("name")
-            ext = (file_info.get("ext") or "").lower()
-            if not name or not ext:
-                continue
-
-            # Manejar imágenes
-            if ext in {".png", ".jpg", ".jpeg", ".gif", ".webp"}:
-                images.append({
-                    "bucket": self.supabase_bucket,
-                    "path": file_info.get("path") or f"{user_id}/{name}",
-                })
-                continue
-
-            # Manejar PDFs como referencias
-            if ext == ".pdf":
-                pdfs.append({
-                    "bucket": self.supabase_bucket,
-                    "path": file_info.get("path") or f"{user_id}/{name}",
-                    "name": name,
-                })
-                continue
-
-            if ext not in {".json", ".md"}:
-                continue
-
-            try:
-                file_bytes, content_type = await self._backend_download_file(
-                    user_id=user_id,
-                    filename=name,
-                    auth_token=auth_token,
-                )
-            except Exception as exc:
-                print(f"⚠️ No se pudo descargar {name}: {exc}")
+        fileset = self._bucket_storage_files(files, user_id)
+        # Columnar: el bucket es el mismo para todas las imágenes, se serializa una sola vez
+        images = {"bucket": self.supabase_bucket, "paths": fileset.image_paths}
+        pdfs = [{"bucket": self.supabase_bucket, "path": path, "name": name} for name, path in fileset.pdf_refs]
+
+        # Descargar JSON/MD en paralelo: la latencia total es ~max(RTT) en lugar de N×RTT
+        text_names = fileset.json_names + fileset.md_names
+        downloads = await self._download_files(user_id, text_names, auth_token)
+
+        download_failed = False
+        n_json = len(fileset.json_names)
+        for index, (name, result) in enumerate(zip(text_names, downloads)):
+            if isinstance(result, BaseException):
+                logger.warning("⚠️ No se pudo descargar %s: %s", name, result)
+                download_failed = True
                 continue
 
-            text = file_bytes.decode("utf-8", errors="replace") if isinstance(file_bytes, (bytes, bytearray)) else str(file_bytes)
-
-            if ext == ".json":
-                try:
-                    json_docs[name] = json.loads(text)
-                except Exception:
-                    json_docs[name] = {"_raw": text}
+            file_bytes, content_type = result
+            # Los primeros n_json resultados son JSON, el resto Markdown
+            parsed = self._parse_text_file(name, file_bytes)
+            if index < n_json:
+                json_docs[name] = parsed
             else:
-                markdown_docs[name] = text
+                markdown_docs[name] = parsed
 
-        if not json_docs and not markdown_docs and not images and not pdfs:
+        if not json_docs and not markdown_docs and not fileset.image_paths and not pdfs:
             return {}
 
-        return {
+        storage_ctx = {
             "storage": {
                 "bucket": self.supabase_bucket,
                 "user_id": user_id,
@@ -911,6 +1982,66 @@ class ChatAgentService:
                 "markdown_docs": markdown_docs,
             }
         }
+        # Con descargas fallidas no se cachea: el siguiente informe reintenta
+        if not download_failed:
+            if len(self._storage_ctx_cache) >= 256 and user_id not in self._storage_ctx_cache:
+                self._storage_ctx_cache.pop(next(iter(self._storage_ctx_cache)))
+            self._storage_ctx_cache[user_id] = (signature, storage_ctx, json_dumps(storage_ctx))
+        return storage_ctx
+
+    @staticmethod
+    def _bucket_storage_files(files: List[_StorageFile], user_id: str) -> _StorageFileSet:
+        """Agrupa el listado por extensión en una sola pasada (despacho por dict, sin cadena de ifs)."""
+        fileset = _StorageFileSet()
+        add_json = fileset.json_names.append
+        add_md = fileset.md_names.append
+        add_image = fileset.image_paths.append
+        add_pdf = fileset.pdf_refs.append
+        dispatch: Dict[str, Callable[[str, str], None]] = {
+            ".json": lambda name, path: add_json(name),
+            ".md": lambda name, path: add_md(name),
+            ".pdf": lambda name, path: add_pdf((name, path)),
+        }
+        for suffix in _IMAGE_SUFFIXES:
+            dispatch[suffix] = lambda name, path: add_image(path)
+
+        for file_info in files:
+            handler = dispatch.get(file_info.ext or "")
+            if handler:
+                handler(file_info.name, file_info.path or f"{user_id}/{file_info.name}")
+        return fileset
+
+    @staticmethod
+    def _storage_files_signature(files: List[_StorageFile]) -> str:
+        """Huella del listado de archivos del usuario (ruta, fecha de actualización, tamaño)."""
+        entries = sorted(
+            (f.path or f.name, str(f.updated_at or ""), str(f.size or ""))
+            for f in files
+        )
+        return hashlib.blake2b(json_dumps(entries).encode("utf-8"), digest_size=16).hexdigest()
+
+    def _build_context_json(
+        self,
+        user_id: str,
+        request_ctx: Optional[Dict[str, Any]],
+        storage_ctx: Dict[str, Any],
+    ) -> Optional[str]:
+        """
+        Serializa {**request_ctx, **storage_ctx} para CONTEXT_JSON reutilizando el JSON
+        del storage ya cacheado por _gather_storage_context.
+        """
+        request_ctx = request_ctx if isinstance(request_ctx, dict) else {}
+        cached = self._storage_ctx_cache.get(user_id)
+        storage_json = cached[2] if cached and cached[1] is storage_ctx else None
+
+        if not storage_ctx:
+            return json_dumps(request_ctx) if request_ctx else None
+        if storage_json is None or "storage" in request_ctx:
+            return json_dumps({**request_ctx, **storage_ctx})
+        if not request_ctx:
+            return storage_json
+        # '{...request...}' + '{"storage": ...}' -> un único objeto, igual al dump del merge
+        return json_dumps(request_ctx)[:-1] + "," + storage_json[1:]
 
     async def _process_portfolio_query(
         self,
@@ -920,14 +2051,14 @@ class ChatAgentService:
         conversation_history: List,
         tools: List,
         auth_token: Optional[str],
-        session: Dict[str, Any],
+        session_id: str,
     ) -> Optional[Dict[str, Any]]:
         """
         Procesa consultas de portafolio usando el flujo de selección de archivos + análisis inline.
         Basado en el ejemplo gemini_supabase/main.py
         """
         try:
-            print(f"\n🔍 Detectada consulta de portafolio para usuario {user_id}")
+            logger.debug("🔍 Detectada consulta de portafolio para usuario %s", user_id)
             
             # Paso 1: Listar archivos disponibles del usuario (incluyendo imágenes y PDFs)
             files = await self._backend_list_files(
@@ -937,30 +2068,29 @@ class ChatAgentService:
             )
             
             if not files:
-                print("⚠️ No se encontraron archivos para el usuario")
+                logger.warning("⚠️ No se encontraron archivos para el usuario")
                 return None
             
             # Filtrar archivos no deseados (similar al ejemplo)
-            excluded_extensions = ('.html', '-.emptyFolder', '.gitkeep')
             filtered_files = [
                 f for f in files 
-                if not any(f.get("name", "").endswith(ext) for ext in excluded_extensions)
+                if not f.name.endswith(_EXCLUDED_FILE_SUFFIXES)
             ]
             
             if not filtered_files:
-                print("⚠️ No hay archivos relevantes después del filtrado")
+                logger.warning("⚠️ No hay archivos relevantes después del filtrado")
                 return None
             
-            print(f"📁 Encontrados {len(filtered_files)} archivos relevantes")
+            logger.debug("📁 Encontrados %s archivos relevantes", len(filtered_files))
             
             # Paso 2: Gemini selecciona los archivos necesarios (Function Calling)
             selected_files = await self._select_files_via_gemini(message, filtered_files, model)
             
             if not selected_files:
-                print("⚠️ Gemini no seleccionó archivos para el análisis")
+                logger.warning("⚠️ Gemini no seleccionó archivos para el análisis")
                 return None
             
-            print(f"✅ Gemini seleccionó {len(selected_files)} archivo(s)")
+            logger.debug("✅ Gemini seleccionó %s archivo(s)", len(selected_files))
             
             # Paso 3: Descargar y analizar archivos inline
             response_text = await self._analyze_files_inline(
@@ -972,7 +2102,7 @@ class ChatAgentService:
             )
             
             if not response_text:
-                print("⚠️ No se pudo generar respuesta del análisis")
+                logger.warning("⚠️ No se pudo generar respuesta del análisis")
                 return None
             
             return {
@@ -982,14 +2112,13 @@ class ChatAgentService:
             }
             
         except Exception as exc:
-            print(f"❌ Error en _process_portfolio_query: {exc}")
-            traceback.print_exc()
+            logger.exception("❌ Error en _process_portfolio_query: %s", exc)
             return None
     
     async def _select_files_via_gemini(
         self,
         prompt: str,
-        files_metadata: List[Dict[str, Any]],
+        files_metadata: List[_StorageFile],
         model: str,
     ) -> List[Dict[str, Any]]:
         """
@@ -1005,13 +2134,13 @@ class ChatAgentService:
             formatted_metadata = []
             for f in files_metadata:
                 formatted_metadata.append({
-                    "nombre": f.get("name"),
-                    "id_archivo": f.get("name"),  # Usar nombre como ID
-                    "tipo": f.get("ext", "").lstrip(".").upper(),
-                    "tamaño_MB": round(f.get("size", 0) / (1024 * 1024), 2) if f.get("size") else 0,
+                    "nombre": f.name,
+                    "id_archivo": f.name,  # Usar nombre como ID
+                    "tipo": (f.ext or "").lstrip(".").upper(),
+                    "tamaño_MB": round(f.size / (1024 * 1024), 2) if f.size else 0,
                 })
             
-            metadatos_str = json.dumps(formatted_metadata, indent=2, ensure_ascii=False)
+            metadatos_str = json_dumps(formatted_metadata, indent=True)
             
             # Detectar intención específica del usuario
             prompt_lower = prompt.lower()
@@ -1118,13 +2247,20 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                     MAX_PDF = 1
                 
                 if len(archivos_seleccionados) > MAX_FILES:
-                    print(f"⚠️ Gemini seleccionó {len(archivos_seleccionados)} archivos, limitando a {MAX_FILES}")
+                    logger.warning("⚠️ Gemini seleccionó %s archivos, limitando a %s", len(archivos_seleccionados), MAX_FILES)
                     
-                    # Clasificar archivos por tipo
-                    json_files = [f for f in archivos_seleccionados if f.get('nombre_archivo', '').lower().endswith('.json')]
-                    md_files = [f for f in archivos_seleccionados if f.get('nombre_archivo', '').lower().endswith('.md')]
-                    image_files = [f for f in archivos_seleccionados if f.get('nombre_archivo', '').lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
-                    pdf_files = [f for f in archivos_seleccionados if f.get('nombre_archivo', '').lower().endswith('.pdf')]
+                    # Clasificar archivos por tipo (una sola pasada; el nombre se normaliza una vez)
+                    json_files, md_files, image_files, pdf_files = [], [], [], []
+                    for f in archivos_seleccionados:
+                        name = f.get('nombre_archivo', '').lower()
+                        if name.endswith(_IMAGE_SUFFIXES):
+                            image_files.append(f)
+                        elif name.endswith('.json'):
+                            json_files.append(f)
+                        elif name.endswith('.md'):
+                            md_files.append(f)
+                        elif name.endswith('.pdf'):
+                            pdf_files.append(f)
                     
                     # Combinar con prioridad según el tipo de consulta
                     if is_image_query:
@@ -1153,17 +2289,20 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                         )
                     archivos_seleccionados = archivos_seleccionados[:MAX_FILES]
                 
-                print(f"📋 Gemini seleccionó {len(archivos_seleccionados)} archivo(s) para análisis:")
-                for arch in archivos_seleccionados:
-                    print(f"  - {arch.get('nombre_archivo')}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "📋 Gemini seleccionó %d archivo(s) para análisis: %s",
+                        len(archivos_seleccionados),
+                        ", ".join(str(arch.get('nombre_archivo')) for arch in archivos_seleccionados),
+                    )
                 
                 return archivos_seleccionados
             else:
-                print("⚠️ Gemini no devolvió llamada a función")
+                logger.warning("⚠️ Gemini no devolvió llamada a función")
                 return []
                 
         except Exception as exc:
-            print(f"❌ Error en _select_files_via_gemini: {exc}")
+            logger.exception("❌ Error en _select_files_via_gemini: %s", exc)
             return []
     
     async def _analyze_files_inline(
@@ -1182,18 +2321,15 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
             inline_parts = []
             total_size_bytes = 0
             
-            for item in selected_files:
-                file_name = item.get('nombre_archivo')
-                if not file_name:
-                    continue
-                
+            # Descargar archivos vía backend (en paralelo; se procesan en el orden seleccionado)
+            file_names = [name for item in selected_files if (name := item.get('nombre_archivo'))]
+            downloads = await self._download_files(user_id, file_names, auth_token)
+            
+            for file_name, download in zip(file_names, downloads):
                 try:
-                    # Descargar archivo vía backend
-                    file_bytes, content_type = await self._backend_download_file(
-                        user_id=user_id,
-                        filename=file_name,
-                        auth_token=auth_token,
-                    )
+                    if isinstance(download, BaseException):
+                        raise download
+                    file_bytes, content_type = download
                     
                     # Determinar mime type
                     mime_type, _ = mimetypes.guess_type(file_name)
@@ -1206,14 +2342,15 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                     size_mb = file_size / (1024 * 1024)
                     
                     # Agregar como parte inline
-                    if file_name.lower().endswith('.json'):
+                    name_lower = file_name.lower()
+                    if name_lower.endswith('.json'):
                         json_content = file_bytes.decode('utf-8')
                         inline_parts.append(json_content)
-                        print(f"   ✅ Añadido JSON: {file_name} ({size_mb:.2f} MB)")
-                    elif file_name.lower().endswith('.md'):
+                        logger.debug("   ✅ Añadido JSON: %s (%.2f MB)", file_name, size_mb)
+                    elif name_lower.endswith('.md'):
                         md_content = file_bytes.decode('utf-8')
                         inline_parts.append(md_content)
-                        print(f"   ✅ Añadido MD: {file_name} ({size_mb:.2f} MB)")
+                        logger.debug("   ✅ Añadido MD: %s (%.2f MB)", file_name, size_mb)
                     else:
                         inline_parts.append(
                             types.Part.from_bytes(
@@ -1221,21 +2358,21 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                                 mime_type=mime_type,
                             )
                         )
-                        print(f"   ✅ Añadido imagen: {file_name} ({size_mb:.2f} MB, {mime_type})")
+                        logger.debug("   ✅ Añadido imagen: %s (%.2f MB, %s)", file_name, size_mb, mime_type)
                         
                 except Exception as exc:
-                    print(f"⚠️ Error procesando {file_name}: {exc}")
+                    logger.warning("⚠️ Error procesando %s: %s", file_name, exc)
                     continue
             
             if not inline_parts:
-                print("❌ No se pudo procesar ningún archivo")
+                logger.error("❌ No se pudo procesar ningún archivo")
                 return None
             
             # Agregar el prompt del usuario
             final_contents = inline_parts + [message]
             
             total_size_mb = total_size_bytes / (1024 * 1024)
-            print(f"\n📤 Enviando {len(final_contents)} elementos a Gemini ({total_size_mb:.2f} MB total)...")
+            logger.debug("📤 Enviando %s elementos a Gemini (%.2f MB total)...", len(final_contents), total_size_mb)
             
             # Generar respuesta usando STREAMING para evitar timeout
             try:
@@ -1255,44 +2392,62 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                         full_text += chunk.text
                         # Log cada 5 chunks para no saturar logs
                         if chunk_count % 5 == 0:
-                            print(f"   📝 Recibidos {chunk_count} chunks de Gemini...")
+                            logger.debug("   📝 Recibidos %s chunks de Gemini...", chunk_count)
                 
                 if full_text:
-                    print(f"✅ Análisis completado exitosamente ({chunk_count} chunks, {len(full_text)} caracteres)")
+                    logger.debug("✅ Análisis completado exitosamente (%s chunks, %s caracteres)", chunk_count, len(full_text))
                     return full_text
                 else:
-                    print("⚠️ Respuesta sin texto después del streaming")
+                    logger.warning("⚠️ Respuesta sin texto después del streaming")
                     return None
                     
             except Exception as exc:
                 error_msg = str(exc)
                 if "503" in error_msg or "UNAVAILABLE" in error_msg:
-                    print(f"⚠️ Modelo Gemini no disponible (503). Intenta de nuevo en unos momentos.")
+                    logger.warning("⚠️ Modelo Gemini no disponible (503). Intenta de nuevo en unos momentos.")
                 elif "timeout" in error_msg.lower():
-                    print(f"⚠️ Timeout procesando archivos. Considera reducir el número de imágenes.")
+                    logger.warning("⚠️ Timeout procesando archivos. Considera reducir el número de imágenes.")
                 else:
-                    print(f"❌ Error llamando a Gemini: {error_msg}")
+                    logger.exception("❌ Error llamando a Gemini: %s", error_msg)
                 return None
             
         except Exception as exc:
-            print(f"❌ Error en _analyze_files_inline: {exc}")
-            traceback.print_exc()
+            logger.exception("❌ Error en _analyze_files_inline: %s", exc)
             return None
 
-    def _persist_raw_response(self, model_name: str, raw_text: str) -> Optional[str]:
-        """Guarda la respuesta raw en disco para depuración y retorna la ruta."""
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    @staticmethod
+    def _write_raw_response_file(model_name: str, raw_text: str) -> str:
+        """Escritura bloqueante del archivo de depuración (se ejecuta en un hilo)."""
+        timestamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
         debug_file = f"debug_raw_response_{timestamp}.txt"
+        with open(debug_file, 'w', encoding='utf-8') as f:
+            f.write(f"MODELO: {model_name}\n")
+            f.write(f"TIMESTAMP: {timestamp}\n")
+            f.write("=" * 60 + "\n")
+            f.write(raw_text)
+
+        # Rotación: conservar solo los archivos más recientes
+        existing = sorted(
+            name for name in os.listdir(".")
+            if name.startswith("debug_raw_response_") and name.endswith(".txt")
+        )
+        for old_file in existing[:-settings.debug_raw_responses_max_files]:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+        return debug_file
+
+    async def _persist_raw_response(self, model_name: str, raw_text: str) -> Optional[str]:
+        """Guarda la respuesta raw en disco para depuración (solo con DEBUG_RAW_RESPONSES) y retorna la ruta."""
+        if not settings.debug_raw_responses:
+            return None
         try:
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(f"MODELO: {model_name}\n")
-                f.write(f"TIMESTAMP: {timestamp}\n")
-                f.write("=" * 60 + "\n")
-                f.write(raw_text)
-            print(f"💾 Respuesta raw guardada en: {debug_file}")
+            debug_file = await asyncio.to_thread(self._write_raw_response_file, model_name, raw_text)
+            logger.debug("💾 Respuesta raw guardada en: %s", debug_file)
             return debug_file
         except Exception as save_error:
-            print(f"⚠️ No se pudo guardar la respuesta raw para depuración: {save_error}")
+            logger.warning("⚠️ No se pudo guardar la respuesta raw para depuración: %s", save_error)
             return None
 
     def _extract_json_candidate(self, raw_text: str) -> Optional[str]:
@@ -1302,10 +2457,17 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
 
         text = raw_text.strip()
 
-        # Quitar bloques de código tipo ```json ... ```
-        fence_match = re.search(r"```(?:json)?\s*(\{.*\})\s*```", text, re.DOTALL)
-        if fence_match:
-            return fence_match.group(1).strip()
+        # Quitar bloques de código tipo ```json ... ``` (find/rfind en lugar de una regex DOTALL
+        # sobre toda la respuesta: del primer fence al último)
+        fence_start = text.find("```")
+        fence_end = text.rfind("```")
+        if fence_start != -1 and fence_end > fence_start:
+            inner = text[fence_start + 3:fence_end]
+            if inner.startswith("json"):
+                inner = inner[4:]
+            inner = inner.strip()
+            if inner.startswith("{") and inner.endswith("}"):
+                return inner
 
         first_brace = text.find('{')
         if first_brace == -1:
@@ -1319,24 +2481,53 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
 
     def _parse_report_from_text(self, raw_text: str, model_name: str) -> Optional[Report]:
         """Intenta parsear el JSON del modelo aplicando reparaciones progresivas."""
-        self._persist_raw_response(model_name, raw_text)
-
         candidate = self._extract_json_candidate(raw_text)
         if not candidate:
-            print("⚠️ No se encontró un bloque JSON claro en la respuesta del modelo.")
+            logger.warning("⚠️ No se encontró un bloque JSON claro en la respuesta del modelo.")
             return None
 
-        attempts: List[Dict[str, str]] = []
+        # Camino rápido: JSON válido tal cual o una única pasada de json_repair
+        # (json_repair cubre comas finales, llaves sin cerrar y fences residuales)
+        last_error: Optional[Exception] = None
+        try:
+            report = _REPORT_ADAPTER.validate_json(candidate)
+            logger.debug("✅ JSON parseado correctamente sin reparaciones adicionales")
+            return report
+        except ValidationError as first_error:
+            last_error = first_error
+            if not _is_json_syntax_error(first_error):
+                logger.warning("⚠️ Validación Pydantic falló (respuesta original): %s", first_error)
+                logger.error("❌ No se pudo reparar la respuesta JSON: %s", first_error)
+                return None
+            logger.warning("⚠️ JSON inválido (respuesta original): %s", first_error.errors()[0].get('msg'))
+
+        seen_texts: set[str] = {candidate}
+        if _has_json_repair:
+            try:
+                # El JSON ya falló al parsear: se omite el json.loads interno de json_repair
+                # y se valida directamente el objeto reparado (sin volver a serializarlo)
+                repaired = repair_json(candidate, skip_json_loads=True, return_objects=True)
+                report = _REPORT_ADAPTER.validate_python(repaired)
+                logger.debug("✅ JSON parseado tras ajuste: json_repair (respuesta original)")
+                return report
+            except Exception as repair_error:
+                logger.warning("⚠️ json_repair no logró reparar el JSON (respuesta original): %s", repair_error)
+        else:
+            logger.warning("⚠️ json_repair no está disponible para intentos de reparación automática")
+
+        # Último recurso: variantes manuales sobre el candidato
+        attempts: List[Dict[str, Any]] = []
 
-        def enqueue(text: str, reason: str):
+        def enqueue(text: str, reason: str, brace_diff: Optional[int] = None):
             normalized = text.strip()
-            if not normalized:
+            if not normalized or normalized in seen_texts:
                 return
-            if any(entry["text"] == normalized for entry in attempts):
-                return
-            attempts.append({"text": normalized, "reason": reason})
+            seen_texts.add(normalized)
+            # brace_diff conocido de antemano evita volver a contar llaves sobre el texto completo
+            attempts.append({"text": normalized, "reason": reason, "brace_diff": brace_diff})
 
-        enqueue(candidate, "respuesta original")
+        # Conteo de llaves una sola vez; las variantes derivadas ajustan el diff sin re-escanear
+        brace_diff = _brace_diff(candidate)
 
         # Intentar quitar bloque de cierre de code fence residual
         if candidate.endswith("```"):
@@ -1345,21 +2536,17 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
 
         # Intentar quitar coma final
         if candidate.rstrip().endswith(','):
-            enqueue(candidate.rstrip(', \n\t'), "eliminar coma final")
+            enqueue(candidate.rstrip(', \n\t'), "eliminar coma final", brace_diff)
 
         # Balancear llaves si faltan
-        brace_diff = candidate.count('{') - candidate.count('}')
         if brace_diff > 0:
-            enqueue(candidate + ('}' * brace_diff), f"balancear llaves (+{brace_diff})")
+            enqueue(candidate + ('}' * brace_diff), f"balancear llaves (+{brace_diff})", 0)
         elif brace_diff < 0:
-            trimmed = candidate
-            diff = brace_diff
-            while diff < 0 and trimmed.endswith('}'):
-                trimmed = trimmed[:-1]
-                diff += 1
-            enqueue(trimmed, f"remover llaves sobrantes ({abs(brace_diff)})")
+            # Un solo corte de las '}' finales sobrantes (sin copiar el texto por cada llave)
+            trailing = len(candidate) - len(candidate.rstrip('}'))
+            cut = min(-brace_diff, trailing)
+            enqueue(candidate[:len(candidate) - cut], f"remover llaves sobrantes ({abs(brace_diff)})", brace_diff + cut)
 
-        last_error: Optional[Exception] = None
         idx = 0
 
         while idx < len(attempts):
@@ -1367,136 +2554,127 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
             attempt_text = attempt["text"]
             reason = attempt["reason"]
             try:
-                parsed_json = json.loads(attempt_text)
-                report = Report.model_validate(parsed_json)
+                # Parseo + validación en una sola pasada en pydantic-core (sin dict intermedio)
+                report = _REPORT_ADAPTER.validate_json(attempt_text)
                 if reason == "respuesta original":
-                    print("✅ JSON parseado correctamente sin reparaciones adicionales")
+                    logger.debug("✅ JSON parseado correctamente sin reparaciones adicionales")
                 else:
-                    print(f"✅ JSON parseado tras ajuste: {reason}")
+                    logger.debug("✅ JSON parseado tras ajuste: %s", reason)
                 return report
-            except JSONDecodeError as json_error:
-                last_error = json_error
-                print(f"⚠️ JSONDecodeError ({reason}): {json_error}")
+            except ValidationError as validation_error:
+                last_error = validation_error
+                if not _is_json_syntax_error(validation_error):
+                    logger.warning("⚠️ Validación Pydantic falló (%s): %s", reason, validation_error)
+                    idx += 1
+                    continue
+
+                logger.warning("⚠️ JSON inválido (%s): %s", reason, validation_error.errors()[0].get('msg'))
 
                 if _has_json_repair:
                     try:
-                        repaired = repair_json(attempt_text)
+                        repaired = repair_json(attempt_text, skip_json_loads=True)
                         enqueue(repaired, f"json_repair ({reason})")
                     except Exception as repair_error:
-                        print(f"⚠️ json_repair no logró reparar el JSON ({reason}): {repair_error}")
+                        logger.warning("⚠️ json_repair no logró reparar el JSON (%s): %s", reason, repair_error)
                 else:
-                    print("⚠️ json_repair no está disponible para intentos de reparación automática")
+                    logger.warning("⚠️ json_repair no está disponible para intentos de reparación automática")
 
                 # Intentar ajustes adicionales específicos de este intento
+                brace_diff_attempt = attempt["brace_diff"]
+                if brace_diff_attempt is None:
+                    brace_diff_attempt = _brace_diff(attempt_text)
+
                 if attempt_text.rstrip().endswith(','):
-                    enqueue(attempt_text.rstrip(', \n\t'), f"eliminar coma final ({reason})")
+                    enqueue(attempt_text.rstrip(', \n\t'), f"eliminar coma final ({reason})", brace_diff_attempt)
 
-                brace_diff_attempt = attempt_text.count('{') - attempt_text.count('}')
                 if brace_diff_attempt > 0:
-                    enqueue(attempt_text + ('}' * brace_diff_attempt), f"balancear llaves (+{brace_diff_attempt}) ({reason})")
+                    enqueue(attempt_text + ('}' * brace_diff_attempt), f"balancear llaves (+{brace_diff_attempt}) ({reason})", 0)
 
-                idx += 1
-            except ValidationError as validation_error:
-                last_error = validation_error
-                print(f"⚠️ Validación Pydantic falló ({reason}): {validation_error}")
                 idx += 1
             except Exception as unexpected_error:
                 last_error = unexpected_error
-                print(f"⚠️ Error inesperado intentando parsear JSON ({reason}): {unexpected_error}")
+                logger.warning("⚠️ Error inesperado intentando parsear JSON (%s): %s", reason, unexpected_error)
                 idx += 1
 
         if last_error:
-            print(f"❌ No se pudo reparar la respuesta JSON: {last_error}")
+            logger.error("❌ No se pudo reparar la respuesta JSON: %s", last_error)
         else:
-            print("❌ No se logró parsear la respuesta JSON por motivos desconocidos")
+            logger.error("❌ No se logró parsear la respuesta JSON por motivos desconocidos")
         return None
 
-    async def ejecutar_generacion_informe_portafolio(self, req: PortfolioReportRequest) -> Dict[str, Any]:
-        """Construye prompt y genera un informe de portafolio en JSON usando el esquema Report."""
-        session_id = req.session_id or self.create_session()
+    async def _generate_portfolio_report(
+        self,
+        model: str,
+        instruction_prefix: List[types.Content],
+        contents: List[types.Content],
+        config: types.GenerateContentConfig,
+    ) -> Tuple[Report, str]:
+        """Llama al modelo (con fallback por sobrecarga) y parsea el Report. Retorna (report, modelo usado)."""
+        # Intentar con diferentes modelos si hay sobrecarga. El JSON se recibe en streaming
+        # (resp.parsed no existe en este modo, el parseo lo hace _parse_report_from_text)
+        (raw_text, streamed_obj), successful_model = await self._generate_with_fallback(
+            model,
+            contents,
+            config,
+            _MODEL_FALLBACKS,
+            call=lambda try_model: self._generate_with_prompt_cache(
+                model=try_model,
+                cache_key="portfolio_instruction",
+                prefix=instruction_prefix,
+                contents=contents,
+                config=config,
+                stream=True,
+            ),
+            hedge_delay=settings.report_hedge_delay_seconds,
+        )
+
+        logger.debug("🔍 Analizando respuesta de %s (%s caracteres)...", successful_model, len(raw_text))
+        parsed_report = None
+        if raw_text:
+            # Validación y reparación del JSON (modelo Pydantic anidado, varios MB de texto) en un hilo:
+            # el event loop sigue atendiendo otras sesiones mientras tanto
+            if streamed_obj is not None:
+                # El objeto ya se armó durante el streaming: solo falta validarlo
+                try:
+                    parsed_report = await asyncio.to_thread(_REPORT_ADAPTER.validate_python, streamed_obj)
+                    logger.debug("✅ JSON parseado incrementalmente durante el streaming")
+                except ValidationError as stream_error:
+                    logger.warning("⚠️ Validación Pydantic falló (parseo incremental): %s", stream_error)
+            if parsed_report is None:
+                parsed_report = await asyncio.to_thread(self._parse_report_from_text, raw_text, successful_model)
+
+        if not parsed_report:
+            # Solo las respuestas que no se pudieron parsear se guardan para depuración (en segundo plano)
+            if raw_text:
+                self._spawn_background(self._persist_raw_response(successful_model, raw_text))
+            raise ValueError("No se pudo parsear la salida estructurada del modelo")
+
+        return parsed_report, successful_model
+
+    async def _build_portfolio_report_inputs(
+        self, req: PortfolioReportRequest
+    ) -> Tuple[str, List[types.Content], List[types.Content], types.GenerateContentConfig]:
+        """Modelo, prefijo de instrucciones, contents y config de un informe de portafolio."""
         user_id = req.user_id  # ✅ Obtener user_id del request
-        
+
         # Por defecto, usar PRO para análisis profundo salvo que se indique lo contrario
         if req.model_preference:
             model = settings.model_pro if req.model_preference.lower() == "pro" else settings.model_flash
         else:
             model = settings.model_pro
 
-        instruction = (
-            "# PROMPT MAESTRO PARA AGENTE DE ANÁLISIS FINANCIERO\n\n"
-            "## 1. PERSONA Y ROL\n"
-            "Actúa como un Analista Financiero Cuantitativo Senior y Estratega de Carteras de Inversión con más de 20 años en Goldman Sachs. "
-            "Eres meticuloso, objetivo y comunicas hallazgos con rigor institucional. Tu responsabilidad es sintetizar datos cuantitativos, narrativas cualitativas "
-            "y señales visuales en un diagnóstico integral y accionable del portafolio.\n\n"
-
-            "## 2. DIRECTIVA PRINCIPAL\n"
-            "Elabora un INFORME DE ANÁLISIS DE CARTERA COMPLETO, profundo y profesional que será convertido automáticamente a PDF. "
-            "Debes interpretar métricas, tablas y cada imagen disponible (graficos descargados desde Supabase) con criterios cuantitativos, "
-            "contexto macroeconómico y riesgos prospectivos. Contrasta hallazgos individuales y combinados para extraer conclusiones estratégicas.\n\n"
-
-            "## 3. PROTOCOLO DE RESPUESTA\n"
-            "1. RESPONDE ÚNICAMENTE con JSON válido que siga estrictamente el esquema Report.\n"
-            "2. No añadas texto fuera del JSON, ni comentarios, ni bloques markdown.\n"
-            "3. Escapa apropiadamente cada cadena y garantiza que todas las llaves estén cerradas.\n"
-            "4. Usa nombres de archivo de imágenes sin prefijos (ej: 'portfolio_growth.png').\n"
-            "5. Conserva la relación de aspecto 16:9 en todas las imágenes fijando height = width * 9 / 16 (usa width en pulgadas, p.ej. 6.0 => height 3.375).\n"
-            "6. Si algún dato no está disponible, explícitalo en el cuerpo del informe en lugar de inventarlo.\n\n"
-
-            "## 4. ESTRUCTURA DEL INFORME\n"
-            "- fileName: Nombre profesional con extensión .pdf.\n"
-            "- document: { title, author='Horizon Agent', subject }.\n"
-            "- content: Usa la siguiente gramática en orden lógico con secciones numeradas (I., II., III., ...).\n"
-            "  • header1: título principal.\n"
-            "  • header2/header3: secciones y subsecciones jerarquizadas.\n"
-            "  • paragraph: narrativa (styles permitidos: body, italic, bold, centered, disclaimer).\n"
-            "  • spacer: separadores (height en puntos).\n"
-            "  • page_break: saltos de página.\n"
-            "  • table: tablas con headers y rows bien formateadas.\n"
-            "  • list: listas con viñetas enriquecidas (usa **negritas** dentro de los items cuando aporte claridad).\n"
-            "  • key_value_list: métricas clave con descripciones claras.\n"
-            "  • image: cada gráfico disponible; agrega captions interpretativos, width en pulgadas (≈6.0) y height = width * 9 / 16.\n\n"
-
-            "## 5. CONTENIDO ANALÍTICO OBLIGATORIO\n"
-            "Incluye, como mínimo, los siguientes apartados con profundidad institucional:\n"
-            "- Resumen Ejecutivo con contexto macro y eventos recientes.\n"
-            "- Perfil de composición y concentración de la cartera.\n"
-            "- Métricas de rendimiento (anualizadas, acumuladas, ratios de riesgo-retorno).\n"
-            "- Análisis exhaustivo de riesgo: drawdowns, volatilidad en múltiples horizontes, sensibilidad a tasas, colas gruesas.\n"
-            "- Interpretación detallada de cada visualización disponible (qué muestra, insight clave, implicación).\n"
-            "- Comparativa con portafolios optimizados (GMV, Máximo Sharpe, benchmark).\n"
-            "- Análisis de correlaciones y diversificación efectiva.\n"
-            "- Proyecciones/Simulaciones (ej. Monte Carlo) y escenarios de estrés.\n"
-            "- Perspectivas estratégicas: oportunidades, riesgos estructurales, triggers a monitorear.\n"
-            "- Recomendaciones tácticas separadas por tipo de perfil (agresivo, moderado, conservador).\n"
-            "- Recomendaciones operativas (rebalanceo, coberturas, liquidez, stop-loss dinámicos).\n"
-            "- Disclaimer regulatorio al final con style 'disclaimer'.\n\n"
-
-            "## 6. METODOLOGÍA Y PROFUNDIDAD\n"
-            "- Integra los datos numéricos, texto contextual y gráficos EN CONJUNTO, destacando convergencias o contradicciones.\n"
-            "- Aporta interpretaciones cuantitativas (porcentajes, diferencias vs benchmark, contribuciones marginales, elasticidades).\n"
-            "- Emplea terminología financiera profesional (tracking error, beta, skewness, expected shortfall, etc.) cuando aplique.\n"
-            "- Usa párrafos densos y argumentados; evita descripciones superficiales o genéricas.\n"
-            "- Señala riesgos latentes (macro, regulatorios, concentración, liquidez) y vincúlalos con la evidencia.\n"
-            "- Articula recomendaciones con justificación cuantitativa y pasos concretos.\n\n"
-
-            "## 7. SALIDA FINAL\n"
-            "Produce un JSON extenso, profesional y técnicamente sólido que respete el esquema Report y capture la complejidad del portafolio."
-        )
-
-        contents = [types.Content(role="user", parts=[types.Part.from_text(text=instruction)])]
+        # El prompt maestro viaja como prefijo (cacheable); aquí solo el contenido por request
+        instruction_prefix = list(_PORTFOLIO_INSTRUCTION_PREFIX)
+        contents: List[types.Content] = []
 
         # Contexto desde Supabase Storage (JSON/MD/PNGs) + contexto del request
         # ✅ Usar user_id para obtener archivos específicos del usuario
         storage_ctx = await self._gather_storage_context(user_id, req.auth_token if hasattr(req, "auth_token") else None)
-        merged_ctx: Dict[str, Any] = {}
-        if isinstance(req.context, dict):
-            merged_ctx.update(req.context)
-        if storage_ctx:
-            merged_ctx.update(storage_ctx)
-        if merged_ctx:
+        context_json = self._build_context_json(user_id, req.context, storage_ctx)
+        if context_json:
             contents.append(types.Content(
                 role="user",
-                parts=[types.Part.from_text(text=f"CONTEXT_JSON=\n{json.dumps(merged_ctx, ensure_ascii=False)}")]
+                parts=[types.Part.from_text(text=f"CONTEXT_JSON=\n{context_json}")]
             ))
 
         config = types.GenerateContentConfig(
@@ -1506,64 +2684,35 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
             response_mime_type="application/json",
             response_schema=Report,
         )
+        return model, instruction_prefix, contents, config
 
-        try:
-            # Intentar con diferentes modelos si hay sobrecarga
-            models_to_try = [model]
-            if model == "gemini-2.5-pro":
-                models_to_try.extend(["gemini-2.5-flash", "gemini-2.5-flash-lite"])
-            elif model == "gemini-2.5-flash":
-                models_to_try.extend(["gemini-2.5-flash-lite", "gemini-2.0-flash"])
-            
-            successful_model = None
-            resp = None
-            
-            for try_model in models_to_try:
-                try:
-                    resp = await self.client.aio.models.generate_content(
-                        model=try_model,
-                        contents=contents,
-                        config=config,
-                    )
-                    successful_model = try_model
-                    break
-                except Exception as model_error:
-                    error_str = str(model_error)
-                    if "overloaded" in error_str or "503" in error_str:
-                        print(f"⚠️ Modelo {try_model} sobrecargado, probando siguiente...")
-                        continue
-                    else:
-                        # Error no relacionado con sobrecarga, propagar
-                        raise model_error
-            
-            if not resp or not successful_model:
-                raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
-
-            parsed_report = None
-            
-            # Seguir el patrón del tutorial exactamente
-            print(f"🔍 Analizando respuesta de {successful_model}...")
-            print(f"   Tiene atributo .parsed: {hasattr(resp, 'parsed')}")
-            print(f"   Tiene atributo .text: {hasattr(resp, 'text')}")
-            
-            if hasattr(resp, "parsed"):
-                print(f"   resp.parsed: {resp.parsed}")
-                print(f"   resp.parsed es None: {resp.parsed is None}")
-                print(f"   resp.parsed es truthy: {bool(resp.parsed)}")
-            
-            if hasattr(resp, "text"):
-                print(f"   resp.text: {resp.text[:200] if resp.text else None}...")
-                print(f"   len(resp.text): {len(resp.text) if resp.text else 0}")
-            
-            if hasattr(resp, "parsed") and resp.parsed:
-                parsed_report = resp.parsed
-                print(f"✅ Salida estructurada parseada correctamente con {successful_model}")
-            elif hasattr(resp, "text") and resp.text:
-                print(f"🔧 Intentando parsear manualmente el JSON de {successful_model}")
-                parsed_report = self._parse_report_from_text(resp.text, successful_model)
+    async def ejecutar_generacion_informe_portafolio(self, req: PortfolioReportRequest) -> Dict[str, Any]:
+        """Construye prompt y genera un informe de portafolio en JSON usando el esquema Report."""
+        session_id = req.session_id or await self.create_session()
+        user_id = req.user_id
+        model, instruction_prefix, contents, config = await self._build_portfolio_report_inputs(req)
 
-            if not parsed_report:
-                raise ValueError("No se pudo parsear la salida estructurada del modelo")
+        try:
+            # Caché exacta: mismo modelo + prompt + contexto + config => mismo informe
+            cache_key = None
+            cached_entry = None
+            if self.llm_cache.is_cacheable(config):
+                cache_key = LLMCache.make_key(model, instruction_prefix + contents, config, namespace=user_id or "")
+                cached_entry = await self.llm_cache.get(cache_key)
+
+            if cached_entry:
+                parsed_report = Report.model_validate(cached_entry["report"])
+                successful_model = cached_entry["model_used"]
+                logger.debug("♻️ Informe servido desde caché LLM (%s)", successful_model)
+            else:
+                parsed_report, successful_model = await self._generate_portfolio_report(
+                    model, instruction_prefix, contents, config
+                )
+                if cache_key:
+                    await self.llm_cache.set(cache_key, {
+                        "model_used": successful_model,
+                        "report": parsed_report.model_dump(),
+                    })
 
             response_payload = PortfolioReportResponse(
                 report=parsed_report,
@@ -1577,20 +2726,14 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
 
             # Registrar mensaje en la sesión (opcional)
             try:
-                summary_added = ChatMessage(
-                    role=MessageRole.ASSISTANT,
-                    content="[INFORME_PORTAFOLIO_GENERADO]",
-                    timestamp=datetime.now().isoformat()
-                )
-                self.sessions[session_id]["messages"].append(summary_added.model_dump())
-                self.sessions[session_id]["last_activity"] = datetime.now().isoformat()
+                await self._record_message(session_id, MessageRole.ASSISTANT, "[INFORME_PORTAFOLIO_GENERADO]")
             except Exception:
                 pass
 
             return response_payload
 
         except Exception as e:
-            print(f"❌ Error generando informe de portafolio: {e}")
+            logger.exception("❌ Error generando informe de portafolio: %s", e)
             return {
                 "error": "Error generando informe",
                 "detail": str(e),
@@ -1598,6 +2741,106 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                 "model_used": model,
             }
 
+    async def generate_reports_batch(self, requests: List[PortfolioReportRequest]) -> List[Dict[str, Any]]:
+        """
+        Genera informes de portafolio vía Gemini Batch API (sin usuario esperando: cron, envíos programados).
+        Un job por modelo con las peticiones inline; se sondea hasta que termine y cada respuesta se
+        parsea a PortfolioReportResponse. Retorna un resultado por request, en el mismo orden
+        (los fallidos llevan "error", como ejecutar_generacion_informe_portafolio).
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+        built = await asyncio.gather(*(self._build_portfolio_report_inputs(req) for req in requests))
+
+        # Un batch job es de un solo modelo: agrupar índices por modelo
+        by_model: Dict[str, List[int]] = {}
+        for index, (model, _, _, _) in enumerate(built):
+            by_model.setdefault(model, []).append(index)
+
+        async def run_job(model: str, indices: List[int]) -> None:
+            inlined = [
+                types.InlinedRequest(
+                    contents=built[i][1] + built[i][2],
+                    config=built[i][3],
+                    metadata={"index": str(i)},
+                )
+                for i in indices
+            ]
+            try:
+                job = await self.client.aio.batches.create(
+                    model=model,
+                    src=inlined,
+                    config=types.CreateBatchJobConfig(display_name=f"portfolio-reports-{uuid.uuid4().hex[:8]}"),
+                )
+                logger.debug("📦 Batch %s creado (%s informes, %s)", job.name, len(inlined), model)
+                deadline = time.monotonic() + settings.batch_timeout_seconds
+                while job.state not in _BATCH_TERMINAL_STATES:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"batch {job.name} sin terminar tras {settings.batch_timeout_seconds}s")
+                    await asyncio.sleep(settings.batch_poll_interval_seconds)
+                    job = await self.client.aio.batches.get(name=job.name)
+                if job.state not in (types.JobState.JOB_STATE_SUCCEEDED, types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED):
+                    raise RuntimeError(f"batch {job.name} terminó en {job.state}: {job.error}")
+                responses = (job.dest.inlined_responses if job.dest else None) or []
+            except Exception as e:
+                logger.exception("❌ Error en batch de informes (%s): %s", model, e)
+                for i in indices:
+                    results[i] = {"error": "Error generando informe", "detail": str(e), "model_used": model}
+                return
+
+            # Cada respuesta vuelve a su petición por el metadata "index"; solo si no lo trae se usa la
+            # posición, y únicamente cuando el batch devolvió exactamente una respuesta por petición
+            if len(responses) != len(indices):
+                logger.warning(
+                    "⚠️ Batch de informes (%s): %d respuestas para %d peticiones", model, len(responses), len(indices)
+                )
+            pending = set(indices)
+            for position, inlined_response in enumerate(responses):
+                raw_index = (inlined_response.metadata or {}).get("index")
+                if raw_index is not None:
+                    i = int(raw_index) if raw_index.isdigit() else -1
+                elif len(responses) == len(indices):
+                    i = indices[position]
+                else:
+                    i = -1
+                if i not in pending:
+                    logger.warning("⚠️ Respuesta de batch sin petición asociada (%s, index=%s)", model, raw_index)
+                    continue
+                pending.discard(i)
+                if inlined_response.error or not inlined_response.response:
+                    detail = str(inlined_response.error) if inlined_response.error else "respuesta vacía"
+                    results[i] = {"error": "Error generando informe", "detail": detail, "model_used": model}
+                    continue
+                raw_text = inlined_response.response.text or ""
+                parsed_report = await asyncio.to_thread(self._parse_report_from_text, raw_text, model)
+                if not parsed_report:
+                    if raw_text:
+                        self._spawn_background(self._persist_raw_response(model, raw_text))
+                    results[i] = {
+                        "error": "Error generando informe",
+                        "detail": "No se pudo parsear la salida estructurada del modelo",
+                        "model_used": model,
+                    }
+                    continue
+                req = requests[i]
+                results[i] = PortfolioReportResponse(
+                    report=parsed_report,
+                    session_id=req.session_id or await self.create_session(),
+                    model_used=model,
+                    metadata={
+                        "context_keys": list(req.context.keys()) if isinstance(req.context, dict) else None,
+                        "batch": True,
+                    },
+                ).model_dump()
+
+            for i in pending:
+                results[i] = {"error": "Error generando informe", "detail": "sin respuesta en el batch", "model_used": model}
+
+        await asyncio.gather(*(run_job(model, indices) for model, indices in by_model.items()))
+        return [
+            result or {"error": "Error generando informe", "detail": "sin respuesta en el batch", "model_used": built[i][0]}
+            for i, result in enumerate(results)
+        ]
+
     async def ejecutar_analisis_alertas(
         self,
         req: AlertsAnalysisRequest
@@ -1608,7 +2851,7 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
         """
         import json as json_module
         
-        session_id = req.session_id or self.create_session()
+        session_id = req.session_id or await self.create_session()
         user_id = req.user_id
         
         # Por defecto usar PRO para análisis profundo
@@ -1625,33 +2868,8 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
             "portfolio_informe.md"
         ]
         
-        # Leer los archivos específicos desde Supabase
-        file_contents = {}
-        missing_files = []
-        
-        for filename in required_files:
-            try:
-                file_bytes, content_type = await self._backend_download_file(
-                    user_id=user_id,
-                    filename=filename,
-                    auth_token=req.auth_token,
-                )
-                text = file_bytes.decode("utf-8", errors="replace")
-                
-                if filename.endswith(".json"):
-                    try:
-                        file_contents[filename] = json_module.loads(text)
-                    except:
-                        file_contents[filename] = {"_raw": text}
-                else:
-                    file_contents[filename] = text
-                    
-            except FileNotFoundError:
-                missing_files.append(filename)
-                print(f"⚠️ Archivo {filename} no encontrado")
-            except Exception as e:
-                print(f"⚠️ Error leyendo {filename}: {e}")
-                missing_files.append(filename)
+        # Leer los archivos específicos desde Supabase (en paralelo)
+        file_contents, missing_files = await self._download_text_files(user_id, required_files, req.auth_token)
         
         if len(missing_files) == len(required_files):
             return {
@@ -1769,81 +2987,66 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
         contents = [
             types.Content(
                 role="user",
-                parts=[types.Part.from_text(text=system_prompt)]
-            ),
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(
-                    text=f"ARCHIVOS_ANALISIS=\n{json_module.dumps(files_context, ensure_ascii=False, indent=2)}"
-                )]
-            )
-        ]
-        
-        config = types.GenerateContentConfig(
-            temperature=0.2,  # Baja temperatura para análisis preciso
-            top_p=0.9,
-            max_output_tokens=16384,
-        )
-        
-        try:
-            # Intentar con diferentes modelos si hay sobrecarga
-            models_to_try = [model]
-            if model == "gemini-2.5-pro":
-                models_to_try.extend(["gemini-2.5-flash", "gemini-2.5-flash-lite"])
-            elif model == "gemini-2.5-flash":
-                models_to_try.extend(["gemini-2.5-flash-lite", "gemini-2.0-flash"])
-            
-            successful_model = None
-            resp = None
-            
-            for try_model in models_to_try:
-                try:
-                    resp = await self.client.aio.models.generate_content(
-                        model=try_model,
-                        contents=contents,
-                        config=config,
-                    )
-                    successful_model = try_model
-                    break
-                except Exception as model_error:
-                    error_str = str(model_error)
-                    if "overloaded" in error_str or "503" in error_str:
-                        print(f"⚠️ Modelo {try_model} sobrecargado, probando siguiente...")
-                        continue
-                    else:
-                        raise model_error
-            
-            if not resp or not successful_model:
-                raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
-            
-            # Extraer el texto de la respuesta
-            analysis_text = ""
-            if hasattr(resp, "text") and resp.text:
-                analysis_text = resp.text
-            elif hasattr(resp, "candidates") and resp.candidates:
-                # Verificar que candidates no sea None antes de iterar
-                candidates_list = resp.candidates if resp.candidates else []
-                for candidate in candidates_list:
-                    if hasattr(candidate, "content") and candidate.content:
-                        if hasattr(candidate.content, "parts") and candidate.content.parts:
-                            # Verificar que parts no sea None antes de iterar
-                            parts_list = candidate.content.parts if candidate.content.parts else []
-                            for part in parts_list:
-                                if hasattr(part, "text") and part.text:
-                                    analysis_text += part.text
-            
-            if not analysis_text:
-                raise ValueError("No se pudo extraer el análisis de la respuesta del modelo")
+                parts=[types.Part.from_text(text=system_prompt)]
+            ),
+            types.Content(
+                role="user",
+                parts=[types.Part.from_text(
+                    text=f"ARCHIVOS_ANALISIS=\n{json_module.dumps(files_context, ensure_ascii=False, indent=2)}"
+                )]
+            )
+        ]
+        
+        config = types.GenerateContentConfig(
+            temperature=0.2,  # Baja temperatura para análisis preciso
+            top_p=0.9,
+            max_output_tokens=16384,
+        )
+        
+        try:
+            # Caché exacta: mismos archivos + prompt + config (temperatura baja) => mismo análisis
+            cache_key = None
+            cached_entry = None
+            if self.llm_cache.is_cacheable(config):
+                cache_key = LLMCache.make_key(model, contents, config, namespace=f"alerts:{user_id or ''}")
+                cached_entry = await self.llm_cache.get(cache_key)
+            
+            if cached_entry:
+                analysis_text = cached_entry["analysis"]
+                successful_model = cached_entry["model_used"]
+                logger.debug("♻️ Análisis de alertas servido desde caché LLM (%s)", successful_model)
+            else:
+                # Intentar con diferentes modelos si hay sobrecarga
+                resp, successful_model = await self._generate_with_fallback(model, contents, config, _MODEL_FALLBACKS)
+                
+                # Extraer el texto de la respuesta
+                analysis_text = ""
+                if hasattr(resp, "text") and resp.text:
+                    analysis_text = resp.text
+                elif hasattr(resp, "candidates") and resp.candidates:
+                    # Verificar que candidates no sea None antes de iterar
+                    candidates_list = resp.candidates if resp.candidates else []
+                    for candidate in candidates_list:
+                        if hasattr(candidate, "content") and candidate.content:
+                            if hasattr(candidate.content, "parts") and candidate.content.parts:
+                                # Verificar que parts no sea None antes de iterar
+                                parts_list = candidate.content.parts if candidate.content.parts else []
+                                for part in parts_list:
+                                    if hasattr(part, "text") and part.text:
+                                        analysis_text += part.text
+                
+                if not analysis_text:
+                    raise ValueError("No se pudo extraer el análisis de la respuesta del modelo")
+                
+                if cache_key:
+                    await self.llm_cache.set(cache_key, {
+                        "model_used": successful_model,
+                        "analysis": analysis_text,
+                    })
             
             # Registrar mensaje en la sesión
             try:
-                summary_added = ChatMessage(
-                    role=MessageRole.ASSISTANT,
-                    content="[ANALISIS_ALERTAS_GENERADO]",
-                    timestamp=datetime.now().isoformat()
-                )
-                self.sessions[session_id]["messages"].append(summary_added.model_dump())
-                self.sessions[session_id]["last_activity"] = datetime.now().isoformat()
+                await self._record_message(session_id, MessageRole.ASSISTANT, "[ANALISIS_ALERTAS_GENERADO]")
             except Exception:
                 pass
             
@@ -1858,7 +3061,7 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
             }
             
         except Exception as e:
-            print(f"❌ Error generando análisis de alertas: {e}")
+            logger.exception("❌ Error generando análisis de alertas: %s", e)
             return {
                 "error": "Error generando análisis de alertas",
                 "detail": str(e),
@@ -1876,7 +3079,7 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
         """
         import json as json_module
         
-        session_id = req.session_id or self.create_session()
+        session_id = req.session_id or await self.create_session()
         user_id = req.user_id
         
         # Mapear modelo como en alertas
@@ -1896,34 +3099,7 @@ DEBES utilizar la función 'SelectorDeArchivos' para devolver la lista de archiv
                 "portfolio_analisis.json"
             ]
             
-            file_contents = {}
-            missing_files = []
-            
-            for file_name in file_names:
-                try:
-                    file_bytes, content_type = await self._backend_download_file(
-                        user_id=user_id,
-                        filename=file_name,
-                        auth_token=req.auth_token,
-                    )
-                    text = file_bytes.decode("utf-8", errors="replace")
-                    
-                    if file_name.endswith(".json"):
-                        try:
-                            file_contents[file_name] = json_module.loads(text)
-                        except:
-                            file_contents[file_name] = {"_raw": text}
-                    else:
-                        file_contents[file_name] = text
-                    
-                    logger.info(f"✅ Archivo leído: {file_name}")
-                    
-                except FileNotFoundError:
-                    missing_files.append(file_name)
-                    logger.warning(f"⚠️ Archivo {file_name} no encontrado")
-                except Exception as e:
-                    missing_files.append(file_name)
-                    logger.error(f"❌ Error leyendo {file_name}: {str(e)}")
+            file_contents, missing_files = await self._download_text_files(user_id, file_names, req.auth_token)
             
             if not file_contents:
                 return {
@@ -2017,34 +3193,7 @@ Después de la cadena de pensamiento, genera un objeto MD (y nada más) que cont
             
             # 5. Llamar al modelo Gemini usando self.client (como en alertas)
             # Intentar con diferentes modelos si hay sobrecarga (como en alertas)
-            models_to_try = [model]
-            if model == settings.model_pro:
-                models_to_try.extend([settings.model_flash, "gemini-2.5-flash"])
-            elif model == settings.model_flash:
-                models_to_try.extend(["gemini-2.5-flash", "gemini-2.5-flash-lite"])
-            
-            successful_model = None
-            resp = None
-            
-            for try_model in models_to_try:
-                try:
-                    resp = await self.client.aio.models.generate_content(
-                        model=try_model,
-                        contents=contents,
-                        config=config,
-                    )
-                    successful_model = try_model
-                    break
-                except Exception as model_error:
-                    error_str = str(model_error)
-                    if "overloaded" in error_str or "503" in error_str:
-                        logger.warning(f"⚠️ Modelo {try_model} sobrecargado, probando siguiente...")
-                        continue
-                    else:
-                        raise model_error
-            
-            if not resp or not successful_model:
-                raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
+            resp, successful_model = await self._generate_with_fallback(model, contents, config, _ANALYSIS_MODEL_FALLBACKS)
             
             # Extraer el texto de la respuesta (como en alertas)
             projections_text = ""
@@ -2095,7 +3244,7 @@ Después de la cadena de pensamiento, genera un objeto MD (y nada más) que cont
         """
         import json as json_module
         
-        session_id = req.session_id or self.create_session()
+        session_id = req.session_id or await self.create_session()
         user_id = req.user_id
         
         # Mapear modelo como en alertas y proyecciones
@@ -2113,31 +3262,7 @@ Después de la cadena de pensamiento, genera un objeto MD (y nada más) que cont
                 "portfolio_analisis.json"
             ]
             
-            file_contents = {}
-            missing_files = []
-            
-            for file_name in file_names:
-                try:
-                    file_bytes, content_type = await self._backend_download_file(
-                        user_id=user_id,
-                        filename=file_name,
-                        auth_token=req.auth_token,
-                    )
-                    text = file_bytes.decode("utf-8", errors="replace")
-                    if file_name.endswith(".json"):
-                        try:
-                            file_contents[file_name] = json_module.loads(text)
-                        except:
-                            file_contents[file_name] = {"_raw": text}
-                    else:
-                        file_contents[file_name] = text
-                    logger.info(f"✅ Archivo leído: {file_name}")
-                except FileNotFoundError:
-                    missing_files.append(file_name)
-                    logger.warning(f"⚠️ Archivo {file_name} no encontrado")
-                except Exception as e:
-                    missing_files.append(file_name)
-                    logger.error(f"❌ Error leyendo {file_name}: {str(e)}")
+            file_contents, missing_files = await self._download_text_files(user_id, file_names, req.auth_token)
             
             if not file_contents:
                 return {
@@ -2246,34 +3371,7 @@ El valor total actual de tu portafolio es de **$[Valor_Total]**. A continuación
             config = types.GenerateContentConfig(temperature=0.3, max_output_tokens=4000)
             
             # Modelos a intentar con fallback
-            models_to_try = [model]
-            if model == settings.model_pro:
-                models_to_try.extend([settings.model_flash, "gemini-2.5-flash"])
-            elif model == settings.model_flash:
-                models_to_try.extend(["gemini-2.5-flash", "gemini-2.5-flash-lite"])
-            
-            successful_model = None
-            resp = None
-            
-            for try_model in models_to_try:
-                try:
-                    resp = await self.client.aio.models.generate_content(
-                        model=try_model,
-                        contents=contents,
-                        config=config,
-                    )
-                    successful_model = try_model
-                    break
-                except Exception as model_error:
-                    error_str = str(model_error)
-                    if "overloaded" in error_str or "503" in error_str:
-                        logger.warning(f"⚠️ Modelo {try_model} sobrecargado, probando siguiente...")
-                        continue
-                    else:
-                        raise model_error
-            
-            if not resp or not successful_model:
-                raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
+            resp, successful_model = await self._generate_with_fallback(model, contents, config, _ANALYSIS_MODEL_FALLBACKS)
             
             # Extraer el texto de la respuesta
             analysis_text = ""
@@ -2325,7 +3423,7 @@ El valor total actual de tu portafolio es de **$[Valor_Total]**. A continuación
         import json as json_module
         from datetime import datetime
         
-        session_id = req.session_id or self.create_session()
+        session_id = req.session_id or await self.create_session()
         user_id = req.user_id
         
         # Mapear modelo como en otras funciones
@@ -2347,31 +3445,7 @@ El valor total actual de tu portafolio es de **$[Valor_Total]**. A continuación
                 "vision de mercado.md"
             ]
             
-            file_contents = {}
-            missing_files = []
-            
-            for file_name in file_names:
-                try:
-                    file_bytes, content_type = await self._backend_download_file(
-                        user_id=user_id,
-                        filename=file_name,
-                        auth_token=req.auth_token,
-                    )
-                    text = file_bytes.decode("utf-8", errors="replace")
-                    if file_name.endswith(".json"):
-                        try:
-                            file_contents[file_name] = json_module.loads(text)
-                        except:
-                            file_contents[file_name] = {"_raw": text}
-                    else:
-                        file_contents[file_name] = text
-                    logger.info(f"✅ Archivo leído: {file_name}")
-                except FileNotFoundError:
-                    missing_files.append(file_name)
-                    logger.warning(f"⚠️ Archivo {file_name} no encontrado")
-                except Exception as e:
-                    missing_files.append(file_name)
-                    logger.error(f"❌ Error leyendo {file_name}: {str(e)}")
+            file_contents, missing_files = await self._download_text_files(user_id, file_names, req.auth_token)
             
             if not file_contents:
                 return {
@@ -2513,34 +3587,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             config = types.GenerateContentConfig(temperature=0.3, max_output_tokens=16000)
             
             # Modelos a intentar con fallback
-            models_to_try = [model]
-            if model == settings.model_pro:
-                models_to_try.extend([settings.model_flash, "gemini-2.5-flash"])
-            elif model == settings.model_flash:
-                models_to_try.extend(["gemini-2.5-flash", "gemini-2.5-flash-lite"])
-            
-            successful_model = None
-            resp = None
-            
-            for try_model in models_to_try:
-                try:
-                    resp = await self.client.aio.models.generate_content(
-                        model=try_model,
-                        contents=contents,
-                        config=config,
-                    )
-                    successful_model = try_model
-                    break
-                except Exception as model_error:
-                    error_str = str(model_error)
-                    if "overloaded" in error_str or "503" in error_str:
-                        logger.warning(f"⚠️ Modelo {try_model} sobrecargado, probando siguiente...")
-                        continue
-                    else:
-                        raise model_error
-            
-            if not resp or not successful_model:
-                raise ValueError("Todos los modelos están sobrecargados, intenta más tarde")
+            resp, successful_model = await self._generate_with_fallback(model, contents, config, _ANALYSIS_MODEL_FALLBACKS)
             
             # Log detallado de la respuesta para debugging
             logger.info(f"📝 Respuesta recibida de {successful_model}")
@@ -2607,43 +3654,21 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             
             logger.info(f"✅ Resumen diario/semanal generado exitosamente con modelo {successful_model}")
             
-            # Guardar el resumen en agente.json
-            agente_data = {
-                "resumen_diario_semanal": {
+            # Guardar el resumen en agente.json antes de responder: el resumen ya corre como tarea de
+            # fondo (/start + polling), así que al marcarse "completed" el archivo está actualizado.
+            # Un fallo de guardado no invalida el resumen: se informa en saved_to_storage
+            saved_to_storage = await self._save_agente_section(
+                user_id=user_id,
+                auth_token=req.auth_token,
+                section="resumen_diario_semanal",
+                data={
                     "summary": summary_text,
                     "report_type": report_type,
-                    "generated_at": datetime.now().isoformat(),
+                    "generated_at": now_iso_coarse(),
                     "model_used": successful_model,
                     "files_processed": list(file_contents.keys()),
-                }
-            }
-            
-            try:
-                # Intentar leer el archivo existente para preservar otras secciones
-                try:
-                    existing_bytes, _ = await self._backend_download_file(
-                        user_id=user_id,
-                        filename="agente.json",
-                        auth_token=req.auth_token,
-                    )
-                    existing_data = json_module.loads(existing_bytes.decode("utf-8"))
-                    # Actualizar solo la sección de resumen
-                    existing_data["resumen_diario_semanal"] = agente_data["resumen_diario_semanal"]
-                    agente_data = existing_data
-                except (FileNotFoundError, Exception) as read_err:
-                    logger.info(f"Archivo agente.json no existe o no se pudo leer, se creará nuevo: {read_err}")
-                
-                # Guardar en Supabase
-                upload_result = await self._backend_upload_json(
-                    user_id=user_id,
-                    filename="agente.json",
-                    data=agente_data,
-                    auth_token=req.auth_token,
-                )
-                logger.info(f"✅ Resumen guardado en agente.json para usuario {user_id}: {upload_result}")
-            except Exception as save_error:
-                logger.warning(f"⚠️ No se pudo guardar agente.json: {save_error}")
-                # No fallamos la operación completa si solo falla el guardado
+                },
+            )
             
             return {
                 "summary": summary_text,
@@ -2652,7 +3677,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 "files_processed": list(file_contents.keys()),
                 "missing_files": missing_files if missing_files else None,
                 "report_type": report_type,
-                "saved_to_storage": True
+                "saved_to_storage": saved_to_storage
             }
             
         except Exception as e:
@@ -2664,6 +3689,46 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 "model_used": model,
             }
 
+    async def _save_agente_section(
+        self,
+        user_id: str,
+        auth_token: Optional[str],
+        section: str,
+        data: Dict[str, Any],
+    ) -> bool:
+        """
+        Actualiza una sección de agente.json del usuario preservando las demás; True si se guardó.
+        El leer-combinar-subir se serializa por usuario: dos guardados simultáneos no pisan una sección.
+        """
+        async with self._shard_lock(f"agente:{user_id}"):
+            agente_data: Dict[str, Any] = {section: data}
+            try:
+                # Intentar leer el archivo existente para preservar otras secciones
+                try:
+                    existing_bytes, _ = await self._backend_download_file(
+                        user_id=user_id,
+                        filename="agente.json",
+                        auth_token=auth_token,
+                    )
+                    existing_data = _json_loads(existing_bytes)
+                    existing_data[section] = data
+                    agente_data = existing_data
+                except Exception as read_err:
+                    logger.info("Archivo agente.json no existe o no se pudo leer, se creará nuevo: %s", read_err)
+
+                # Guardar en Supabase
+                upload_result = await self._backend_upload_json(
+                    user_id=user_id,
+                    filename="agente.json",
+                    data=agente_data,
+                    auth_token=auth_token,
+                )
+                logger.info("✅ Sección '%s' guardada en agente.json para usuario %s: %s", section, user_id, upload_result)
+                return True
+            except Exception as save_error:
+                logger.warning("⚠️ No se pudo guardar agente.json: %s", save_error)
+                return False
+    
     async def process_message(
         self, 
         message: str,
@@ -2683,13 +3748,8 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
         """
         
         try:
-            # Crear sesión si no existe
-            if not session_id:
-                session_id = self.create_session()
-            elif session_id not in self.sessions:
-                session_id = self.create_session()
-            
-            session = self.sessions[session_id]
+            # Crear sesión si no existe (o reutilizar la reciente del usuario)
+            session_id = await self._resolve_session(session_id, user_id)
             
             # Detectar URLs en el mensaje si no se proporcionó url explícita
             detected_urls = self._extract_urls_from_query(message)
@@ -2704,37 +3764,28 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             else:
                 model, tools, tool_names = self._choose_model_and_tools(message, file_path, url)
             
-            session["model_used"] = model
-            
             # Agregar mensaje del usuario al historial
-            user_message = ChatMessage(
-                role=MessageRole.USER,
-                content=message,
-                timestamp=datetime.now().isoformat()
-            )
-            session["messages"].append(user_message.model_dump())
+            user_message_count = await self._record_message(session_id, MessageRole.USER, message, model_used=model)
             
             # Preparar prompt del sistema (se usará en system_instruction)
             system_prompt = PRO_SYSTEM_PROMPT if model == settings.model_pro else FLASH_SYSTEM_PROMPT
             
             # Preparar historial de conversación (SIN system prompt - va aparte)
-            conversation_history = []
-            
-            # Agregar historial de mensajes previos (últimos 10)
-            recent_messages = session["messages"][-10:]
-            for msg in recent_messages[:-1]:  # Excluir el último mensaje (ya lo agregamos)
-                conversation_history.append(types.Content(
-                    role="user" if msg["role"] == "user" else "model",
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
+            # Historial de mensajes previos (últimos 10, sin el mensaje actual que se agrega después)
+            conversation_history = await self._history_contents(session_id, _HISTORY_WINDOW)
             
             # Si no hay herramientas pero necesita datetime + search, priorizar search
             # Google Search puede inferir la fecha actual por contexto
             if not tools and self._needs_web_search(message):
-                google_search_tool = types.Tool(google_search=types.GoogleSearch())
-                tools.append(google_search_tool)
+                tools.append(TOOL_GOOGLE_SEARCH)
                 tool_names.append("google_search")
             
+            # Con mensajes fuera de la ventana, el modelo puede recuperarlos con recall_memory
+            # (solo junto a otras funciones: no se mezcla con Google Search / URL Context)
+            if user_message_count > _HISTORY_WINDOW and all(tool.function_declarations for tool in tools):
+                tools.append(TOOL_RECALL_MEMORY)
+                tool_names.append("recall_memory")
+            
             # Agregar mensaje actual
             conversation_history.append(types.Content(
                 role="user",
@@ -2746,7 +3797,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             has_auth = bool(auth_token)
             
             # Detectar si es consulta sobre archivos del usuario (incluyendo patrones posesivos)
-            is_storage_query = self._is_user_storage_query(message)
+            is_storage_query = self._is_user_storage_query(lowered_message)
             
             # Keywords tradicionales de portafolio
             has_portfolio_keyword = any(
@@ -2760,11 +3811,11 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             # 1. Tiene token Y (keyword tradicional O consulta de storage posesiva)
             should_use_storage = has_auth and (has_portfolio_keyword or is_storage_query)
             
-            print(f"🔍 DEBUG: auth_token={has_auth}, portfolio_keyword={has_portfolio_keyword}, storage_query={is_storage_query}, activar_storage={should_use_storage}")
-            print(f"   Mensaje: '{message[:80]}...'")
+            logger.debug("🔍 Enrutado: auth_token=%s, portfolio_keyword=%s, storage_query=%s, activar_storage=%s", has_auth, has_portfolio_keyword, is_storage_query, should_use_storage)
+            logger.debug("   Mensaje: '%s...'", message[:80])
             
             if should_use_storage:
-                print(f"✅ Activando flujo de análisis de archivos de usuario para {user_id}")
+                logger.debug("✅ Activando flujo de análisis de archivos de usuario para %s", user_id)
                 portfolio_response = await self._process_portfolio_query(
                     message=message,
                     user_id=user_id,
@@ -2772,7 +3823,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                     conversation_history=conversation_history, 
                     tools=tools,
                     auth_token=auth_token,
-                    session=session,
+                    session_id=session_id,
                 )
 
             response_data = portfolio_response or await self._generate_response_with_tools(
@@ -2780,43 +3831,32 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 conversation_history=conversation_history,
                 tools=tools,
                 system_prompt=system_prompt,
+                session_id=session_id,
             )
             
             response_text = response_data["text"]
             grounding_metadata = response_data.get("grounding_metadata")
             function_calls_made = response_data.get("function_calls", [])
+            cache_hit = bool(response_data.get("cache_hit"))
             
             # Agregar respuesta al historial
-            assistant_message = ChatMessage(
-                role=MessageRole.ASSISTANT,
-                content=response_text,
-                timestamp=datetime.now().isoformat()
-            )
-            session["messages"].append(assistant_message.model_dump())
-            session["last_activity"] = datetime.now().isoformat()
+            message_count = await self._record_message(session_id, MessageRole.ASSISTANT, response_text)
+            self._schedule_summary_refresh(session_id, message_count)
             
             # Construir metadata enriquecida
             metadata = {
-                    "message_count": len(session["messages"]),
+                    "message_count": message_count,
                     "context_provided": context is not None,
                     "file_analyzed": file_path is not None,
                 "url_analyzed": url is not None or bool(detected_urls),
                 "detected_urls": detected_urls if detected_urls else None,
                 "function_calls_made": function_calls_made if function_calls_made else None,
+                "cache_hit": cache_hit,
             }
             
             # Agregar información de grounding si está disponible
             if grounding_metadata:
-                metadata["grounding_used"] = True
-                if hasattr(grounding_metadata, "web_search_queries"):
-                    metadata["search_queries"] = grounding_metadata.web_search_queries
-                if hasattr(grounding_metadata, "grounding_chunks"):
-                    chunks = grounding_metadata.grounding_chunks
-                    if chunks:
-                        metadata["sources"] = [
-                            {"title": chunk.web.title, "uri": chunk.web.uri} 
-                            for chunk in chunks if hasattr(chunk, "web")
-                        ]
+                metadata.update(self._grounding_fields(grounding_metadata))
             
             return {
                 "response": response_text,
@@ -2828,8 +3868,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             
         except Exception as e:
             error_msg = f"Error procesando mensaje: {str(e)}"
-            print(f"❌ {error_msg}")
-            traceback.print_exc()
+            logger.exception("❌ %s", error_msg)
             
             return {
                 "response": "Lo siento, hubo un error procesando tu mensaje. Por favor intenta nuevamente.",
@@ -2857,13 +3896,8 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
         Yields: dict con {"text": str} para chunks de texto o {"done": True, "metadata": dict} al finalizar
         """
         try:
-            # Crear sesión si no existe
-            if not session_id:
-                session_id = self.create_session()
-            elif session_id not in self.sessions:
-                session_id = self.create_session()
-            
-            session = self.sessions[session_id]
+            # Crear sesión si no existe (o reutilizar la reciente del usuario)
+            session_id = await self._resolve_session(session_id, user_id)
             
             # ✅ Verificar si hay archivos inline
             has_inline_files = inline_files and len(inline_files) > 0
@@ -2884,44 +3918,34 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             else:
                 model, tools, tool_names = self._choose_model_and_tools(message, file_path, url)
             
-            session["model_used"] = model
-            
             # Agregar mensaje del usuario al historial
-            user_message = ChatMessage(
-                role=MessageRole.USER,
-                content=message,
-                timestamp=datetime.now().isoformat()
-            )
-            session["messages"].append(user_message.model_dump())
+            user_message_count = await self._record_message(session_id, MessageRole.USER, message, model_used=model)
             
             # Preparar prompt del sistema (se usará en system_instruction, no en historial)
             system_prompt = PRO_SYSTEM_PROMPT if model == settings.model_pro else FLASH_SYSTEM_PROMPT
             
             # Preparar historial de conversación (SIN el system prompt - va aparte)
-            conversation_history = []
-            
-            # Agregar historial de mensajes previos
-            recent_messages = session["messages"][-10:]
-            for msg in recent_messages[:-1]:
-                conversation_history.append(types.Content(
-                    role="user" if msg["role"] == "user" else "model",
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
+            # Historial de mensajes previos (sin el mensaje actual)
+            conversation_history = await self._history_contents(session_id, _HISTORY_WINDOW)
             
             # Agregar Google Search si es necesario
             if not tools and self._needs_web_search(message):
-                google_search_tool = types.Tool(google_search=types.GoogleSearch())
-                tools.append(google_search_tool)
+                tools.append(TOOL_GOOGLE_SEARCH)
                 tool_names.append("google_search")
             
+            # Memoria bajo demanda, igual que en process_message
+            if user_message_count > _HISTORY_WINDOW and all(tool.function_declarations for tool in tools):
+                tools.append(TOOL_RECALL_MEMORY)
+                tool_names.append("recall_memory")
+            
             # ✅ Si hay archivos inline, procesarlos con el nuevo método
             if has_inline_files:
-                print(f"📎 Procesando {len(inline_files)} archivo(s) inline para análisis multimodal")
+                logger.debug("📎 Procesando %s archivo(s) inline para análisis multimodal", len(inline_files))
                 async for chunk_data in self._process_inline_files_stream(
                     message=message,
                     inline_files=inline_files,
                     model=model,
-                    session=session,
+                    session_id=session_id,
                 ):
                     yield chunk_data
                 return  # Terminar después de procesar archivos inline
@@ -2937,7 +3961,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             has_auth = bool(auth_token)
             
             # Detectar si es consulta sobre archivos del usuario (incluyendo patrones posesivos)
-            is_storage_query = self._is_user_storage_query(message)
+            is_storage_query = self._is_user_storage_query(lowered_message)
             
             # Keywords tradicionales de portafolio
             has_portfolio_keyword = any(
@@ -2953,10 +3977,11 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             full_response_text = ""
             grounding_metadata = None
             function_calls_made = []
+            cache_hit = False
             
             if should_use_storage:
-                print(f"✅ Activando flujo de análisis de archivos STREAMING para usuario {user_id}")
-                print(f"   (portfolio_keyword={has_portfolio_keyword}, storage_query={is_storage_query})")
+                logger.debug("✅ Activando flujo de análisis de archivos STREAMING para usuario %s", user_id)
+                logger.debug("   (portfolio_keyword=%s, storage_query=%s)", has_portfolio_keyword, is_storage_query)
                 # Stream portfolio/storage analysis
                 async for chunk_data in self._process_portfolio_query_stream(
                     message=message,
@@ -2965,44 +3990,53 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                     conversation_history=conversation_history,
                     tools=tools,
                     auth_token=auth_token,
-                    session=session,
+                    session_id=session_id,
                 ):
                     if "text" in chunk_data:
                         full_response_text += chunk_data["text"]
                         yield chunk_data
             else:
                 # Stream normal response
-                async for chunk_data in self._generate_response_with_tools_stream(
-                    model=model,
-                    conversation_history=conversation_history,
-                    tools=tools,
-                    system_prompt=system_prompt,
-                ):
-                    if "text" in chunk_data:
-                        full_response_text += chunk_data["text"]
-                    if "grounding_metadata" in chunk_data:
-                        grounding_metadata = chunk_data["grounding_metadata"]
-                    if "function_calls" in chunk_data:
-                        function_calls_made = chunk_data["function_calls"]
-                    yield chunk_data
+                try:
+                    async for chunk_data in self._generate_response_with_tools_stream(
+                        model=model,
+                        conversation_history=conversation_history,
+                        tools=tools,
+                        system_prompt=system_prompt,
+                        session_id=session_id,
+                    ):
+                        if "text" in chunk_data:
+                            full_response_text += chunk_data["text"]
+                        if "grounding_metadata" in chunk_data:
+                            grounding_metadata = chunk_data["grounding_metadata"]
+                        if "function_calls" in chunk_data:
+                            function_calls_made = chunk_data["function_calls"]
+                        if chunk_data.get("cache_hit"):
+                            cache_hit = True
+                        yield chunk_data
+                except (asyncio.CancelledError, GeneratorExit):
+                    # Cliente desconectado: se deja de generar y se conserva lo que ya recibió
+                    # (en segundo plano: la petición ya se está cancelando)
+                    if full_response_text:
+                        logger.warning("✂️ Stream cancelado en la sesión %s; se guarda la respuesta parcial", session_id)
+                        self._spawn_background(
+                            self._record_message(session_id, MessageRole.ASSISTANT, full_response_text)
+                        )
+                    raise
             
             # Agregar respuesta al historial
-            assistant_message = ChatMessage(
-                role=MessageRole.ASSISTANT,
-                content=full_response_text,
-                timestamp=datetime.now().isoformat()
-            )
-            session["messages"].append(assistant_message.model_dump())
-            session["last_activity"] = datetime.now().isoformat()
+            message_count = await self._record_message(session_id, MessageRole.ASSISTANT, full_response_text)
+            self._schedule_summary_refresh(session_id, message_count)
             
             # Construir metadata
             metadata = {
-                "message_count": len(session["messages"]),
+                "message_count": message_count,
                 "context_provided": context is not None,
                 "file_analyzed": file_path is not None,
                 "url_analyzed": url is not None or bool(detected_urls),
                 "detected_urls": detected_urls if detected_urls else None,
                 "function_calls_made": function_calls_made if function_calls_made else None,
+                "cache_hit": cache_hit,
                 "session_id": session_id,
                 "model_used": model,
                 "tools_used": tool_names,
@@ -3010,32 +4044,137 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             
             # Agregar información de grounding
             if grounding_metadata:
-                metadata["grounding_used"] = True
-                if hasattr(grounding_metadata, "web_search_queries"):
-                    metadata["search_queries"] = grounding_metadata.web_search_queries
-                if hasattr(grounding_metadata, "grounding_chunks"):
-                    chunks = grounding_metadata.grounding_chunks
-                    if chunks:
-                        metadata["sources"] = [
-                            {"title": chunk.web.title, "uri": chunk.web.uri}
-                            for chunk in chunks if hasattr(chunk, "web")
-                        ]
+                metadata.update(self._grounding_fields(grounding_metadata))
             
             # Señal final con metadata
             yield {"done": True, "metadata": metadata}
             
         except Exception as e:
             error_msg = f"Error procesando mensaje: {str(e)}"
-            print(f"❌ {error_msg}")
-            traceback.print_exc()
+            logger.exception("❌ %s", error_msg)
             yield {"error": error_msg, "done": True}
     
+    @staticmethod
+    def _semantic_namespace(model: str, system_prompt: str) -> str:
+        """Namespace de la caché semántica: modelo + hash del system prompt."""
+        return f"{model}:{hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]}"
+    
+    async def _semantic_lookup(
+        self,
+        model: str,
+        system_prompt: str,
+        conversation_history: List[types.Content],
+        tools: List,
+    ) -> Tuple[str, Optional[List[float]], Optional[str]]:
+        """
+        Caché semántica: solo consultas sueltas (sin historial) y sin herramientas, cuya respuesta
+        no depende de datos en vivo ni del contexto de la conversación.
+        Retorna (namespace, embedding de la consulta, texto cacheado si hubo acierto).
+        """
+        if not self.semantic_cache.enabled or tools or len(conversation_history) != 1:
+            return "", None, None
+        query_text = "".join(part.text or "" for part in conversation_history[0].parts)
+        namespace = self._semantic_namespace(model, system_prompt)
+        query_embedding = await self._embed_text(query_text)
+        if query_embedding is None:
+            return namespace, None, None
+        cached_text = self.semantic_cache.lookup(namespace, query_embedding)
+        if cached_text is not None:
+            logger.debug("⚡ Respuesta servida desde la caché semántica")
+        return namespace, query_embedding, cached_text
+    
+    @staticmethod
+    def _inflight_key(
+        model: str, system_prompt: str, tools: List, conversation_history: List[types.Content], scope: str = ""
+    ) -> Optional[str]:
+        """
+        Huella de una petición de chat; None si el historial tiene partes no textuales (no se agrupa).
+        `scope` separa peticiones cuyas herramientas leen estado propio (p. ej. la sesión en recall_memory).
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{model}\0{system_prompt}\0{tools!r}\0{scope}".encode("utf-8"))
+        for content in conversation_history:
+            for part in content.parts or ():
+                if part.text is None:
+                    return None
+                digest.update(f"\0{content.role}\0{part.text}".encode("utf-8"))
+        return digest.hexdigest()
+    
+    async def _search_session_memory(self, session_id: Optional[str], query: str = "") -> Dict[str, Any]:
+        """
+        recall_memory: mensajes de la sesión fuera de la ventana reciente que comparten más términos
+        con `query` (en orden cronológico). Búsqueda léxica local, sin llamadas al modelo.
+        """
+        if not session_id:
+            return {"matches": []}
+        messages = await self.session_store.recent_messages(session_id, settings.session_max_messages)
+        terms = set(_TERM_RE.findall(_fold_text(query)))
+        scored = []
+        for index, msg in enumerate(messages[:-_HISTORY_WINDOW]):
+            score = len(terms.intersection(_TERM_RE.findall(_fold_text(msg["content"]))))
+            if score:
+                scored.append((score, index, msg))
+        best = sorted(heapq.nlargest(_RECALL_MEMORY_LIMIT, scored, key=lambda item: item[:2]), key=lambda item: item[1])
+        return {
+            "matches": [
+                {
+                    "role": msg["role"],
+                    "content": msg["content"][:_RECALL_MEMORY_MAX_CHARS],
+                    "timestamp": msg["timestamp"],
+                }
+                for _, _, msg in best
+            ]
+        }
+    
+    async def _dispatch_tool(self, function_call: Any, session_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Ejecuta una función declarada al modelo vía la tabla _tool_dispatch; None si el nombre
+        no es conocido. Un fallo de la función vuelve al modelo como {"error": ...} sin abortar el turno.
+        """
+        handler = self._tool_dispatch.get(function_call.name)
+        if handler is None:
+            return None
+        try:
+            return await handler(session_id, **(function_call.args or {}))
+        except Exception as e:
+            logger.warning("⚠️ Error ejecutando la función %s: %s", function_call.name, e)
+            return {"error": str(e)}
+    
     async def _generate_response_with_tools(
         self, 
         model: str, 
         conversation_history: List, 
         tools: List,
-        system_prompt: str = ""
+        system_prompt: str = "",
+        session_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Igual que _run_response_with_tools, pero peticiones idénticas simultáneas (reintentos del
+        cliente, ráfagas de la misma pregunta) comparten una sola llamada al modelo (single-flight).
+        """
+        scope = (session_id or "") if TOOL_RECALL_MEMORY in tools else ""
+        key = self._inflight_key(model, system_prompt, tools, conversation_history, scope)
+        if key is None:
+            return await self._run_response_with_tools(model, conversation_history, tools, system_prompt, session_id)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._run_response_with_tools(model, conversation_history, tools, system_prompt, session_id)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.debug("🔗 Petición idéntica en curso: se reutiliza su respuesta")
+        # shield: si un solicitante se desconecta no se cancela la llamada que esperan los demás
+        return await asyncio.shield(task)
+    
+    async def _run_response_with_tools(
+        self, 
+        model: str, 
+        conversation_history: List, 
+        tools: List,
+        system_prompt: str = "",
+        session_id: Optional[str] = None,
     ) -> Dict[str, Any]:
         """
         Generar respuesta usando herramientas (grounding, function calling).
@@ -3045,25 +4184,50 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             Dict con: text, grounding_metadata, function_calls
         """
         try:
-            # Configuración base con system_instruction
-            config = types.GenerateContentConfig(
-                temperature=0.7,
-                top_p=0.9,
-                max_output_tokens=2048,
-                tools=tools if tools else None,
-                system_instruction=system_prompt if system_prompt else None
+            # Configuración base con system_instruction (y su variante para el caché de contexto)
+            config, cache_config = _chat_configs(system_prompt, tools)
+            
+            # Si system prompt + herramientas alcanzan el mínimo cacheable del modelo van en un caché de
+            # contexto y por llamada solo viaja el historial (cached_content no admite system_instruction/tools
+            # en la misma request); si no, cache_key es None y se envían inline
+            cache_key = self._chat_prompt_cache_key(system_prompt, tools, model)
+            
+            # Embedding de la caché semántica y creación/lectura del caché de contexto son
+            # independientes: se solapan en lugar de sumar sus latencias
+            (semantic_namespace, query_embedding, cached_text), _ = await asyncio.gather(
+                self._semantic_lookup(model, system_prompt, conversation_history, tools),
+                self._get_prompt_cache(cache_key, model, None, system_prompt, tools) if cache_key else asyncio.sleep(0),
             )
+            if cached_text is not None:
+                return {"text": cached_text, "grounding_metadata": None, "function_calls": [], "cache_hit": True}
+            
+            async def generate(history: List[types.Content]):
+                if cache_key:
+                    return await self._generate_with_prompt_cache(
+                        model=model,
+                        cache_key=cache_key,
+                        contents=history,
+                        config=cache_config,
+                        system_instruction=system_prompt,
+                        tools=tools,
+                    )
+                return await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=history,
+                    config=config
+                )
             
             # Primera llamada al modelo
-            response = await self.client.aio.models.generate_content(
-                model=model,
-                contents=conversation_history,
-                config=config
-            )
+            response = await generate(conversation_history)
             
             function_calls_made = []
-            max_function_call_rounds = 5  # Límite de seguridad
+            # Sin funciones declaradas (chat general, Google Search, URL Context) no hay ciclo de function calling
+            has_functions = any(tool.function_declarations for tool in tools or ())
+            max_function_call_rounds = 5 if has_functions else 0  # Límite de seguridad
             current_round = 0
+            early_exit_allowed = has_functions and self._is_direct_datetime_question(
+                "".join(part.text or "" for part in conversation_history[-1].parts)
+            )
             
             # Ciclo de function calling
             while current_round < max_function_call_rounds:
@@ -3072,55 +4236,55 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                     break
                 
                 candidate = response.candidates[0]
-                if not hasattr(candidate.content, 'parts'):
+                if not getattr(candidate.content, 'parts', None):
                     break
                 
-                # Buscar function calls en las partes
-                has_function_call = False
-                for part in candidate.content.parts:
-                    if hasattr(part, 'function_call') and part.function_call:
-                        has_function_call = True
-                        function_call = part.function_call
-                        function_name = function_call.name
-                        
-                        print(f"🔧 Ejecutando función: {function_name}")
-                        
-                        # Ejecutar la función
-                        if function_name == "get_current_datetime":
-                            function_result = get_current_datetime()
-                            function_calls_made.append({
-                                "name": function_name,
-                                "result": function_result
-                            })
-                            
-                            # Agregar resultado al historial
-                            conversation_history.append(types.Content(
-                                role="model",
-                                parts=[part]
-                            ))
-                            
-                            conversation_history.append(types.Content(
-                                role="user",
-                                parts=[types.Part.from_function_response(
-                                    name=function_name,
-                                    response=function_result
-                                )]
-                            ))
-                            
-                            # Continuar la conversación
-                            response = await self.client.aio.models.generate_content(
-                                model=model,
-                                contents=conversation_history,
-                                config=config
-                            )
-                            
-                            break  # Salir del loop de parts
-                        else:
-                            print(f"⚠️ Función desconocida: {function_name}")
-                
-                if not has_function_call:
+                # Todas las function calls del turno (Gemini puede pedir varias en paralelo)
+                call_parts = [part for part in candidate.content.parts if getattr(part, 'function_call', None)]
+                if not call_parts:
                     break  # No hay más llamadas a funciones
                 
+                calls = [part.function_call for part in call_parts]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("🔧 Ejecutando funciones: %s", ", ".join(call.name for call in calls))
+                # Se ejecutan a la vez y sus resultados vuelven al modelo en un único turno
+                results = await asyncio.gather(*(self._dispatch_tool(call, session_id) for call in calls))
+                for call, result in zip(calls, results):
+                    if result is None:
+                        logger.warning("⚠️ Función desconocida: %s", call.name)
+                    else:
+                        function_calls_made.append({"name": call.name, "result": result})
+                
+                # Salida temprana: la respuesta se arma localmente, sin segunda llamada al modelo
+                if (
+                    early_exit_allowed
+                    and len(calls) == 1
+                    and results[0] is not None
+                    and calls[0].name in _EARLY_EXIT_TOOLS
+                ):
+                    logger.debug("⚡ Respuesta directa para %s (sin segunda llamada al modelo)", calls[0].name)
+                    return {
+                        "text": _EARLY_EXIT_TOOLS[calls[0].name](results[0]),
+                        "grounding_metadata": None,
+                        "function_calls": function_calls_made,
+                    }
+                
+                # Agregar llamadas y resultados al historial (un turno del modelo y uno de respuestas)
+                conversation_history.append(types.Content(role="model", parts=call_parts))
+                conversation_history.append(types.Content(
+                    role="user",
+                    parts=[
+                        types.Part.from_function_response(
+                            name=call.name,
+                            response=result if result is not None else {"error": f"Función desconocida: {call.name}"},
+                        )
+                        for call, result in zip(calls, results)
+                    ]
+                ))
+                
+                # Continuar la conversación
+                response = await generate(conversation_history)
+                
                 current_round += 1
             
             # Extraer texto y metadata
@@ -3131,28 +4295,24 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 candidate = response.candidates[0]
                 
                 # Obtener texto - con manejo robusto de None
-                if hasattr(response, 'text') and response.text is not None:
-                    response_text = response.text.strip()
-                elif hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+                text = getattr(response, 'text', None)
+                if text is not None:
+                    response_text = text.strip()
+                else:
                     # Intentar extraer texto de las partes
-                    text_parts = []
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            text_parts.append(part.text)
-                    if text_parts:
-                        response_text = " ".join(text_parts).strip()
+                    parts = getattr(getattr(candidate, 'content', None), 'parts', None) or ()
+                    response_text = " ".join(part.text for part in parts if getattr(part, 'text', None)).strip()
                 
-                # Obtener grounding metadata
-                if hasattr(candidate, 'grounding_metadata'):
-                    grounding_metadata = candidate.grounding_metadata
-                    
-                    # Agregar citaciones al texto si hay grounding
-                    if grounding_metadata and response_text:
-                        print("📚 Agregando citaciones al texto...")
-                        response_text = self._add_citations_to_text(response_text, grounding_metadata)
+                # Obtener grounding metadata y agregar citaciones al texto si hay grounding
+                grounding_metadata = getattr(candidate, 'grounding_metadata', None)
+                if grounding_metadata and response_text:
+                    logger.debug("📚 Agregando citaciones al texto...")
+                    response_text = self._add_citations_to_text(response_text, grounding_metadata)
             
             if not response_text:
-                response_text = "No pude generar una respuesta. Por favor intenta reformular tu pregunta."
+                response_text = _NO_RESPONSE_TEXT
+            elif query_embedding is not None and not function_calls_made:
+                self.semantic_cache.add(semantic_namespace, query_embedding, response_text)
             
             return {
                 "text": response_text,
@@ -3161,8 +4321,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             }
                 
         except Exception as e:
-            print(f"❌ Error generando respuesta con herramientas: {e}")
-            traceback.print_exc()
+            logger.exception("❌ Error generando respuesta con herramientas: %s", e)
             return {
                 "text": f"Error generando respuesta: {str(e)}",
                 "grounding_metadata": None,
@@ -3174,43 +4333,120 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
         model: str,
         conversation_history: List,
         tools: List,
-        system_prompt: str = ""
+        system_prompt: str = "",
+        session_id: Optional[str] = None,
     ):
         """
         Versión de streaming de _generate_response_with_tools.
+        Si el modelo pide funciones, se ejecutan al terminar su stream y se abre uno nuevo con los resultados.
         Yields: dict con {"text": str} para chunks o {"grounding_metadata": obj, "function_calls": list} al final
         """
         try:
-            config = types.GenerateContentConfig(
-                temperature=0.7,
-                top_p=0.9,
-                max_output_tokens=2048,
-                tools=tools if tools else None,
-                system_instruction=system_prompt if system_prompt else None
+            config, cache_config = _chat_configs(system_prompt, tools)
+            
+            # Mismo caché de contexto que la versión sin streaming (solo si el prefijo es cacheable),
+            # resuelto en paralelo con el embedding de la caché semántica
+            cache_key = self._chat_prompt_cache_key(system_prompt, tools, model)
+            (semantic_namespace, query_embedding, cached_text), cache_name = await asyncio.gather(
+                self._semantic_lookup(model, system_prompt, conversation_history, tools),
+                self._get_prompt_cache(cache_key, model, None, system_prompt, tools) if cache_key else asyncio.sleep(0),
             )
+            if cached_text is not None:
+                yield {"text": cached_text}
+                yield {"grounding_metadata": None, "function_calls": [], "cache_hit": True}
+                return
             
-            # Usar generate_content_stream para streaming
-            response_stream = await self.client.aio.models.generate_content_stream(
-                model=model,
-                contents=conversation_history,
-                config=config
-            )
+            async def open_stream(history: List[types.Content]):
+                nonlocal cache_name
+                if cache_name:
+                    try:
+                        return await self.client.aio.models.generate_content_stream(
+                            model=model,
+                            contents=history,
+                            config=cache_config.model_copy(update={"cached_content": cache_name}),
+                        )
+                    except Exception as e:
+                        if not self._is_cache_not_found_error(e):
+                            raise
+                        logger.warning("⚠️ Caché de contexto '%s' expirado para %s, enviando prompt inline", cache_key, model)
+                        self._invalidate_prompt_cache(cache_key, model)
+                        cache_name = None
+                # Usar generate_content_stream para streaming
+                return await self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=history,
+                    config=config
+                )
             
             grounding_metadata = None
-            full_text = ""
+            text_chunks: List[str] = []
+            function_calls_made: List[Dict[str, Any]] = []
+            user_query = "".join(part.text or "" for part in conversation_history[-1].parts)
+            early_exit_allowed = self._is_direct_datetime_question(user_query)
+            max_function_call_rounds = 5  # Límite de seguridad
             
-            async for chunk in response_stream:
-                if hasattr(chunk, 'text') and chunk.text:
-                    full_text += chunk.text
-                    yield {"text": chunk.text}
+            for current_round in range(max_function_call_rounds + 1):
+                call_parts: List[types.Part] = []
+                async for chunk in await open_stream(conversation_history):
+                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                        call_parts.extend(
+                            part for part in chunk.candidates[0].content.parts if getattr(part, 'function_call', None)
+                        )
+                    
+                    text = chunk.text
+                    if text:
+                        text_chunks.append(text)
+                        yield {"text": text}
+                    
+                    # Capturar metadata del último chunk
+                    if chunk.candidates:
+                        grounding_metadata = getattr(chunk.candidates[0], 'grounding_metadata', None) or grounding_metadata
+                
+                if not call_parts or current_round == max_function_call_rounds:
+                    break
                 
-                # Capturar metadata del último chunk
-                if chunk.candidates and hasattr(chunk.candidates[0], 'grounding_metadata'):
-                    grounding_metadata = chunk.candidates[0].grounding_metadata
+                calls = [part.function_call for part in call_parts]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("🔧 Ejecutando funciones: %s", ", ".join(call.name for call in calls))
+                results = await asyncio.gather(*(self._dispatch_tool(call, session_id) for call in calls))
+                for call, result in zip(calls, results):
+                    if result is None:
+                        logger.warning("⚠️ Función desconocida: %s", call.name)
+                    else:
+                        function_calls_made.append({"name": call.name, "result": result})
+                
+                # Salida temprana para herramientas con plantilla local (p. ej. "¿qué hora es?")
+                if (
+                    early_exit_allowed
+                    and len(calls) == 1
+                    and results[0] is not None
+                    and calls[0].name in _EARLY_EXIT_TOOLS
+                ):
+                    answer = _EARLY_EXIT_TOOLS[calls[0].name](results[0])
+                    text_chunks.append(answer)
+                    yield {"text": answer}
+                    break
+                
+                # Nuevo stream con las llamadas y sus resultados en el historial
+                conversation_history.append(types.Content(role="model", parts=call_parts))
+                conversation_history.append(types.Content(
+                    role="user",
+                    parts=[
+                        types.Part.from_function_response(
+                            name=call.name,
+                            response=result if result is not None else {"error": f"Función desconocida: {call.name}"},
+                        )
+                        for call, result in zip(calls, results)
+                    ]
+                ))
+            
+            full_text = "".join(text_chunks)
+            if query_embedding is not None and full_text and not function_calls_made:
+                self.semantic_cache.add(semantic_namespace, query_embedding, full_text)
             
             # Agregar citaciones si hay grounding (al final)
             if grounding_metadata and full_text:
-                print("📚 Agregando citaciones al texto...")
+                logger.debug("📚 Agregando citaciones al texto...")
                 cited_text = self._add_citations_to_text(full_text, grounding_metadata)
                 # Enviar solo la diferencia (citaciones)
                 if cited_text != full_text:
@@ -3220,12 +4456,11 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             # Enviar metadata al final
             yield {
                 "grounding_metadata": grounding_metadata,
-                "function_calls": []
+                "function_calls": function_calls_made
             }
             
         except Exception as e:
-            print(f"❌ Error en streaming: {e}")
-            traceback.print_exc()
+            logger.exception("❌ Error en streaming: %s", e)
             yield {"text": f"Error generando respuesta: {str(e)}"}
     
     async def _process_portfolio_query_stream(
@@ -3236,14 +4471,14 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
         conversation_history: List,
         tools: List,
         auth_token: Optional[str],
-        session: Dict[str, Any],
+        session_id: str,
     ):
         """
         Versión de streaming de _process_portfolio_query.
         Yields: dict con {"text": str} para chunks de texto
         """
         try:
-            print(f"\n🔍 Detectada consulta de portafolio para usuario {user_id}")
+            logger.debug("🔍 Detectada consulta de portafolio para usuario %s", user_id)
             
             # Paso 1: Listar archivos (incluyendo imágenes y PDFs)
             files = await self._backend_list_files(
@@ -3257,17 +4492,16 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 return
             
             # Filtrar archivos
-            excluded_extensions = ('.html', '-.emptyFolder', '.gitkeep')
             filtered_files = [
                 f for f in files
-                if not any(f.get("name", "").endswith(ext) for ext in excluded_extensions)
+                if not f.name.endswith(_EXCLUDED_FILE_SUFFIXES)
             ]
             
             if not filtered_files:
                 yield {"text": "No hay archivos relevantes en tu portafolio."}
                 return
             
-            print(f"📁 Encontrados {len(filtered_files)} archivos relevantes")
+            logger.debug("📁 Encontrados %s archivos relevantes", len(filtered_files))
             
             # Paso 2: Seleccionar archivos con Gemini
             selected_files = await self._select_files_via_gemini(message, filtered_files, model)
@@ -3276,23 +4510,20 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 yield {"text": "No pude identificar archivos específicos para tu consulta. ¿Podrías ser más específico?"}
                 return
             
-            print(f"✅ Gemini seleccionó {len(selected_files)} archivo(s)")
+            logger.debug("✅ Gemini seleccionó %s archivo(s)", len(selected_files))
             
-            # Paso 3: Descargar archivos
+            # Paso 3: Descargar archivos (en paralelo; se procesan en el orden seleccionado)
             final_contents = []
             total_size_bytes = 0
             
-            for file_info in selected_files:
-                filename = file_info.get("nombre_archivo")
-                if not filename:
-                    continue
-                
+            filenames = [name for file_info in selected_files if (name := file_info.get("nombre_archivo"))]
+            downloads = await self._download_files(user_id, filenames, auth_token)
+            
+            for filename, download in zip(filenames, downloads):
                 try:
-                    file_bytes, content_type = await self._backend_download_file(
-                        user_id=user_id,
-                        filename=filename,
-                        auth_token=auth_token
-                    )
+                    if isinstance(download, BaseException):
+                        raise download
+                    file_bytes, content_type = download
                     
                     total_size_bytes += len(file_bytes)
                     filename_lower = filename.lower()
@@ -3301,14 +4532,14 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                     if filename_lower.endswith('.json'):
                         json_content = file_bytes.decode('utf-8')
                         final_contents.append(json_content)
-                        print(f"   ✅ Añadido JSON: {filename} ({len(file_bytes)/(1024*1024):.2f} MB)")
+                        logger.debug("   ✅ Añadido JSON: %s (%.2f MB)", filename, len(file_bytes)/(1024*1024))
                     
                     elif filename_lower.endswith('.md'):
                         md_content = file_bytes.decode('utf-8')
                         final_contents.append(md_content)
-                        print(f"   ✅ Añadido MD: {filename} ({len(file_bytes)/(1024*1024):.2f} MB)")
+                        logger.debug("   ✅ Añadido MD: %s (%.2f MB)", filename, len(file_bytes)/(1024*1024))
                     
-                    elif filename_lower.endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
+                    elif filename_lower.endswith(_IMAGE_SUFFIXES):
                         # Imágenes: usar inline data
                         mime_type = content_type or 'image/png'
                         if filename_lower.endswith('.jpg') or filename_lower.endswith('.jpeg'):
@@ -3324,7 +4555,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                                 "data": base64.b64encode(file_bytes).decode('utf-8')
                             }
                         })
-                        print(f"   ✅ Añadida imagen: {filename} ({len(file_bytes)/(1024*1024):.2f} MB)")
+                        logger.debug("   ✅ Añadida imagen: %s (%.2f MB)", filename, len(file_bytes)/(1024*1024))
                     
                     elif filename_lower.endswith('.pdf'):
                         # PDF: usar inline data con base64
@@ -3334,10 +4565,10 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                                 "data": base64.b64encode(file_bytes).decode('utf-8')
                             }
                         })
-                        print(f"   ✅ Añadido PDF: {filename} ({len(file_bytes)/(1024*1024):.2f} MB)")
+                        logger.debug("   ✅ Añadido PDF: %s (%.2f MB)", filename, len(file_bytes)/(1024*1024))
                 
                 except Exception as e:
-                    print(f"⚠️ Error descargando {filename}: {e}")
+                    logger.warning("⚠️ Error descargando %s: %s", filename, e)
                     continue
             
             if not final_contents:
@@ -3348,7 +4579,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             final_contents.append(message)
             
             total_size_mb = total_size_bytes / (1024 * 1024)
-            print(f"\n📤 Enviando {len(final_contents)} elementos a Gemini ({total_size_mb:.2f} MB total)...")
+            logger.debug("📤 Enviando %s elementos a Gemini (%.2f MB total)...", len(final_contents), total_size_mb)
             
             # Paso 4: Enviar a Gemini con streaming
             try:
@@ -3365,19 +4596,18 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                         
                         # Log cada 10 chunks
                         if chunk_count % 10 == 0:
-                            print(f"   📝 Enviados {chunk_count} chunks al cliente...")
+                            logger.debug("   📝 Enviados %s chunks al cliente...", chunk_count)
                 
-                print(f"✅ Análisis streaming completado ({chunk_count} chunks totales)")
+                logger.debug("✅ Análisis streaming completado (%s chunks totales)", chunk_count)
             
             except Exception as e:
                 error_msg = f"Error en el análisis: {str(e)}"
-                print(f"❌ {error_msg}")
+                logger.exception("❌ %s", error_msg)
                 yield {"text": f"\n\nLo siento, ocurrió un error durante el análisis: {error_msg}"}
         
         except Exception as e:
             error_msg = f"Error en consulta de portafolio: {str(e)}"
-            print(f"❌ {error_msg}")
-            traceback.print_exc()
+            logger.exception("❌ %s", error_msg)
             yield {"text": f"Lo siento, ocurrió un error procesando tu consulta de portafolio."}
     
     async def _process_inline_files_stream(
@@ -3385,7 +4615,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
         message: str,
         inline_files: List["InlineFile"],
         model: str,
-        session: Dict[str, Any],
+        session_id: str,
     ):
         """
         Procesa archivos inline (PDF, imágenes) enviados directamente por el usuario.
@@ -3395,7 +4625,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             message: El mensaje/pregunta del usuario sobre los archivos
             inline_files: Lista de archivos con filename, content_type, y data (base64)
             model: Modelo a usar para el análisis
-            session: Sesión actual del chat
+            session_id: ID de la sesión actual del chat
             
         Yields:
             dict con {"text": str} para chunks de texto en streaming
@@ -3424,21 +4654,21 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                     
                     # Verificar tipos soportados
                     supported_types = {
-                        'application/pdf': ['.pdf'],
-                        'image/png': ['.png'],
-                        'image/jpeg': ['.jpg', '.jpeg'],
-                        'image/gif': ['.gif'],
-                        'image/webp': ['.webp'],
-                        'text/plain': ['.txt'],
-                        'text/csv': ['.csv'],
-                        'application/json': ['.json'],
-                        'text/markdown': ['.md'],
+                        'application/pdf': ('.pdf',),
+                        'image/png': ('.png',),
+                        'image/jpeg': ('.jpg', '.jpeg'),
+                        'image/gif': ('.gif',),
+                        'image/webp': ('.webp',),
+                        'text/plain': ('.txt',),
+                        'text/csv': ('.csv',),
+                        'application/json': ('.json',),
+                        'text/markdown': ('.md',),
                     }
                     
                     # Validar que el tipo está soportado
                     is_supported = False
                     for supported_mime, extensions in supported_types.items():
-                        if any(filename_lower.endswith(ext) for ext in extensions):
+                        if filename_lower.endswith(extensions):
                             is_supported = True
                             # Corregir mime_type si no coincide
                             if mime_type not in supported_types:
@@ -3464,10 +4694,10 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                         )
                         processed_files.append({"name": file_info.filename, "type": mime_type, "size_kb": round(file_size/1024, 2)})
                     
-                    print(f"   ✅ Archivo procesado: {file_info.filename} ({file_size/(1024*1024):.2f} MB, {mime_type})")
+                    logger.debug("   ✅ Archivo procesado: %s (%.2f MB, %s)", file_info.filename, file_size/(1024*1024), mime_type)
                     
                 except Exception as e:
-                    print(f"⚠️ Error procesando archivo {file_info.filename}: {e}")
+                    logger.warning("⚠️ Error procesando archivo %s: %s", file_info.filename, e)
                     yield {"text": f"⚠️ Error procesando '{file_info.filename}': {str(e)}\n"}
                     continue
             
@@ -3480,7 +4710,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
             content_parts.append(message)
             
             total_size_mb = total_size / (1024 * 1024)
-            print(f"\n📤 Enviando {len(content_parts)} elementos a Gemini ({total_size_mb:.2f} MB total)...")
+            logger.debug("📤 Enviando %s elementos a Gemini (%.2f MB total)...", len(content_parts), total_size_mb)
             
             # Llamar a Gemini con streaming
             try:
@@ -3500,18 +4730,12 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                         
                         # Log cada 10 chunks
                         if chunk_count % 10 == 0:
-                            print(f"   📝 Enviados {chunk_count} chunks al cliente...")
+                            logger.debug("   📝 Enviados %s chunks al cliente...", chunk_count)
                 
-                print(f"✅ Análisis multimodal streaming completado ({chunk_count} chunks, {len(full_text)} caracteres)")
+                logger.debug("✅ Análisis multimodal streaming completado (%s chunks, %s caracteres)", chunk_count, len(full_text))
                 
                 # Agregar respuesta al historial de la sesión
-                assistant_message = ChatMessage(
-                    role=MessageRole.ASSISTANT,
-                    content=full_text,
-                    timestamp=datetime.now().isoformat()
-                )
-                session["messages"].append(assistant_message.model_dump())
-                session["last_activity"] = datetime.now().isoformat()
+                await self._record_message(session_id, MessageRole.ASSISTANT, full_text)
                 
                 # Enviar metadata final
                 yield {
@@ -3527,7 +4751,7 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 
             except Exception as e:
                 error_msg = str(e)
-                print(f"❌ Error llamando a Gemini: {error_msg}")
+                logger.exception("❌ Error llamando a Gemini: %s", error_msg)
                 
                 if "503" in error_msg or "UNAVAILABLE" in error_msg:
                     yield {"text": "\n⚠️ El modelo Gemini no está disponible temporalmente. Por favor intenta de nuevo en unos momentos."}
@@ -3540,31 +4764,17 @@ Debes estructurar tu respuesta usando exactamente los siguientes encabezados:
                 
         except Exception as e:
             error_msg = f"Error procesando archivos inline: {str(e)}"
-            print(f"❌ {error_msg}")
-            traceback.print_exc()
+            logger.exception("❌ %s", error_msg)
             yield {"text": f"Lo siento, ocurrió un error procesando tus archivos: {str(e)}"}
             yield {"done": True, "metadata": {"error": error_msg}}
     
-    def close_session(self, session_id: str) -> bool:
+    async def close_session(self, session_id: str) -> bool:
         """Cerrar sesión"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            self.active_sessions = max(0, self.active_sessions - 1)
-            return True
-        return False
+        return await self.session_store.delete(session_id)
     
-    def list_sessions(self) -> List[Dict[str, Any]]:
-        """Listar todas las sesiones activas"""
-        return [
-            {
-                "session_id": session_id,
-                "created_at": session["created_at"],
-                "message_count": len(session["messages"]),
-                "model_used": session["model_used"],
-                "last_activity": session["last_activity"]
-            }
-            for session_id, session in self.sessions.items()
-        ]
+    async def list_sessions(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Listar sesiones activas (paginado con offset/limit; sin limit, todas)"""
+        return await self.session_store.list_info(offset, limit)
 
 # Instancia global del servicio
 chat_service = ChatAgentService()
\ No newline at end of file
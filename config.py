@@ -48,7 +48,52 @@ class Settings(BaseSettings):
     model_flash: str = "gemini-2.5-flash"
     model_pro: str = "gemini-2.5-pro"
     default_currency: str = "USD"
-    
+
+    # Caché de contexto de Gemini para prompts estáticos (prompt maestro, system prompts); TTL mínimo efectivo 120s
+    enable_prompt_cache: bool = True
+    prompt_cache_ttl_seconds: int = 3600
+
+    # Caché de respuestas LLM deterministas (en memoria o Redis si hay URL)
+    enable_llm_cache: bool = True
+    llm_cache_ttl_seconds: int = 3600
+    llm_cache_max_entries: int = 1024
+    redis_url: Optional[str] = None
+
+    # Caché semántica del chat (consultas casi idénticas sin herramientas ni historial)
+    enable_semantic_cache: bool = False
+    semantic_cache_threshold: float = 0.92
+    semantic_cache_max_entries: int = 512
+    embedding_model: str = "text-embedding-004"
+
+    # Sesiones de chat: máximo de mensajes retenidos por sesión (los más antiguos se descartan)
+    session_max_messages: int = 50
+    # TTL de sesiones sin actividad (solo backend Redis)
+    session_ttl_seconds: int = 86400
+    # Backend en memoria: inactividad tras la que se desaloja una sesión y tope de sesiones (LRU)
+    session_idle_ttl_seconds: int = 1800
+    session_max_sessions: int = 10_000
+    # Mensajes sin session_id: reutilizar la última sesión del usuario si estuvo activa hace menos
+    # de estos segundos (0 = desactivado, cada mensaje sin session_id abre una sesión nueva)
+    session_warm_reuse_seconds: float = 0
+
+    # Archivos JSON/MD del storage más grandes que esto no se envían como contexto al modelo
+    storage_max_file_bytes: int = 4_000_000
+
+    # Máximo de llamadas simultáneas a Gemini por proceso (contrapresión ante ráfagas; 0 = sin límite)
+    max_concurrent_gemini_calls: int = 64
+
+    # Informes: si el modelo preferido no respondió tras estos segundos se lanza en paralelo el
+    # primer alternativo y gana la primera respuesta (None = desactivado, sin llamadas duplicadas)
+    report_hedge_delay_seconds: Optional[float] = None
+
+    # Batch API de Gemini para informes sin usuario esperando (cron, envíos programados)
+    batch_poll_interval_seconds: int = 30
+    batch_timeout_seconds: int = 86400
+
+    # Depuración: guardar respuestas raw del modelo en disco (con rotación)
+    debug_raw_responses: bool = False
+    debug_raw_responses_max_files: int = 100
+
     # Environment
     environment: str = "development"
     
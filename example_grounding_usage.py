@@ -149,7 +149,7 @@ async def show_capabilities():
     print("CAPACIDADES DEL SERVICIO HORIZON CHAT AGENT")
     print("🌟"*30 + "\n")
     
-    health = chat_service.get_health_status()
+    health = await chat_service.get_health_status()
     
     print("📋 Herramientas disponibles:")
     for tool in health['tools']:
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Caché de respuestas LLM para llamadas deterministas (temperatura baja).
+La clave es sha256(modelo, contents, config); el backend es en memoria (LRU con TTL)
+o Redis si REDIS_URL está configurada.
+Incluye además una caché semántica opcional (similitud coseno entre embeddings de la consulta).
+"""
+import json
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as aioredis
+    _has_redis = True
+except Exception:
+    _has_redis = False
+
+try:
+    import numpy as np
+    _has_numpy = True
+except Exception:
+    _has_numpy = False
+
+
+class CacheBackend(Protocol):
+    """Contrato mínimo de un backend de caché (async get/set de cadenas)."""
+
+    async def get(self, key: str) -> Optional[str]: ...
+
+    async def set(self, key: str, value: str, ttl: Optional[int] = None) -> None: ...
+
+
+class LRUBackend:
+    """Backend en proceso: LRU acotado con expiración por entrada."""
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: Optional[int] = None) -> None:
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class RedisBackend:
+    """Backend compartido entre workers usando Redis."""
+
+    def __init__(self, url: str, ttl: int = 3600, prefix: str = "llm_cache:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._redis.get(self.prefix + key)
+        if value is None:
+            return None
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    async def set(self, key: str, value: str, ttl: Optional[int] = None) -> None:
+        await self._redis.set(self.prefix + key, value, ex=ttl or self.ttl)
+
+
+class LLMCache:
+    """
+    Memoización exacta de respuestas del modelo.
+    Solo se cachean llamadas con temperatura <= max_temperature (salida prácticamente determinista).
+    Los errores del backend nunca interrumpen la generación: se tratan como miss.
+    """
+
+    def __init__(self, backend: CacheBackend, max_temperature: float = 0.2, enabled: bool = True):
+        self.backend = backend
+        self.max_temperature = max_temperature
+        self.enabled = enabled
+
+    def is_cacheable(self, config: Any) -> bool:
+        temperature = getattr(config, "temperature", None)
+        return self.enabled and temperature is not None and temperature <= self.max_temperature
+
+    @staticmethod
+    def make_key(model: str, contents: List[Any], config: Any, namespace: str = "") -> str:
+        """sha256 estable de (namespace, modelo, contents, config)."""
+        payload = {
+            "namespace": namespace,
+            "model": model,
+            "contents": [
+                c.model_dump(exclude_none=True) if hasattr(c, "model_dump") else c
+                for c in contents
+            ],
+            "config": config.model_dump(exclude_none=True) if hasattr(config, "model_dump") else config,
+        }
+        raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        try:
+            raw = await self.backend.get(key)
+            return json.loads(raw) if raw else None
+        except Exception as e:
+            logger.warning("⚠️ Error leyendo caché LLM: %s", e)
+            return None
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: Optional[int] = None) -> None:
+        if not self.enabled:
+            return
+        try:
+            await self.backend.set(key, json.dumps(value, ensure_ascii=False), ttl)
+        except Exception as e:
+            logger.warning("⚠️ Error escribiendo caché LLM: %s", e)
+
+
+class SemanticCache:
+    """
+    Caché semántica en proceso (patrón GPTCache): embeddings L2-normalizados por namespace
+    (modelo + system prompt) y la respuesta asociada. Hay acierto si el coseno con la consulta
+    supera `threshold`. Con numpy la búsqueda es un único producto matriz-vector; sin numpy,
+    un recorrido en Python puro. Desalojo LRU por namespace.
+    """
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 512, ttl: int = 3600, enabled: bool = True):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        # namespace -> OrderedDict(clave -> (expira_en, vector normalizado, respuesta))
+        self._entries: Dict[str, "OrderedDict[str, Tuple[float, List[float], str]]"] = {}
+        # namespace -> (claves, matriz [N, d]) reconstruida solo cuando cambian las entradas
+        self._matrices: Dict[str, Tuple[List[str], Any]] = {}
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> Optional[List[float]]:
+        norm = math.sqrt(sum(v * v for v in vector))
+        if not norm:
+            return None
+        return [v / norm for v in vector]
+
+    def _scores(self, namespace: str, query: List[float]) -> Tuple[List[str], List[float]]:
+        entries = self._entries[namespace]
+        if _has_numpy:
+            cached = self._matrices.get(namespace)
+            if cached is None:
+                keys = list(entries)
+                matrix = np.asarray([entries[k][1] for k in keys], dtype=np.float32)
+                cached = self._matrices[namespace] = (keys, matrix)
+            keys, matrix = cached
+            return keys, (matrix @ np.asarray(query, dtype=np.float32)).tolist()
+        keys = list(entries)
+        return keys, [sum(a * b for a, b in zip(entries[k][1], query)) for k in keys]
+
+    def lookup(self, namespace: str, embedding: List[float]) -> Optional[str]:
+        """Respuesta cacheada más similar a `embedding` si supera el umbral; None si no."""
+        entries = self._entries.get(namespace)
+        if not self.enabled or not entries:
+            return None
+        query = self._normalize(embedding)
+        if query is None:
+            return None
+        keys, scores = self._scores(namespace, query)
+        best = max(range(len(keys)), key=scores.__getitem__)
+        if scores[best] <= self.threshold:
+            return None
+        key = keys[best]
+        expires_at, _, response = entries[key]
+        if expires_at <= time.monotonic():
+            del entries[key]
+            self._matrices.pop(namespace, None)
+            return None
+        entries.move_to_end(key)
+        return response
+
+    def add(self, namespace: str, embedding: List[float], response: str) -> None:
+        self.add_many(namespace, [(embedding, response)])
+
+    def add_many(self, namespace: str, items: List[Tuple[List[float], str]]) -> None:
+        """Inserta varias (embedding, respuesta); la matriz del namespace se reconstruye una sola vez."""
+        if not self.enabled or not items:
+            return
+        entries = self._entries.setdefault(namespace, OrderedDict())
+        expires_at = time.monotonic() + self.ttl
+        for embedding, response in items:
+            vector = self._normalize(embedding)
+            if vector is None:
+                continue
+            key = hashlib.sha256(json.dumps(vector).encode("utf-8")).hexdigest()
+            entries[key] = (expires_at, vector, response)
+            entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        self._matrices.pop(namespace, None)
+
+
+def build_llm_cache() -> LLMCache:
+    """Crea la caché según settings: Redis si hay REDIS_URL y el paquete está instalado, si no LRU en memoria."""
+    ttl = settings.llm_cache_ttl_seconds
+    backend: CacheBackend
+    if settings.redis_url and _has_redis:
+        backend = RedisBackend(settings.redis_url, ttl=ttl)
+    else:
+        if settings.redis_url:
+            logger.warning("⚠️ REDIS_URL configurada pero el paquete 'redis' no está instalado; usando caché en memoria")
+        backend = LRUBackend(maxsize=settings.llm_cache_max_entries, ttl=ttl)
+    return LLMCache(backend, enabled=settings.enable_llm_cache)
+
+
+def build_semantic_cache() -> SemanticCache:
+    """Caché semántica según settings (desactivada por defecto)."""
+    return SemanticCache(
+        threshold=settings.semantic_cache_threshold,
+        maxsize=settings.semantic_cache_max_entries,
+        ttl=settings.llm_cache_ttl_seconds,
+        enabled=settings.enable_semantic_cache,
+    )
@@ -1,14 +1,17 @@
 """
 Aplicación FastAPI para el servicio independiente del agente de chat
 """
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Header
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 import uuid
 import json
 import asyncio
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from typing import List, Dict, Any, AsyncGenerator
 from contextlib import asynccontextmanager
@@ -28,11 +31,34 @@ from models import (
     PerformanceAnalysisRequest, PerformanceAnalysisResponse,
     DailyWeeklySummaryRequest, DailyWeeklySummaryResponse
 )
-from agent_service import chat_service
+from agent_service import chat_service, now_iso_coarse, json_dumps
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+
+def setup_logging() -> None:
+    """
+    Logs de la aplicación a stderr desde un hilo aparte (QueueHandler → QueueListener):
+    los handlers del event loop solo encolan el registro y la escritura en el pipe de
+    logs del contenedor no bloquea las peticiones en curso.
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(settings.log_level.upper())
+    listener.start()
+    # Vaciar la cola al salir del proceso
+    atexit.register(listener.stop)
+
+
+setup_logging()
+
 # Almacenamiento en memoria para estados de tareas
 # Con 1 worker de Gunicorn, todos los requests comparten la misma memoria
 task_statuses: Dict[str, Dict[str, Any]] = {}
@@ -113,14 +139,21 @@ async def lifespan(app: FastAPI):
     scheduler = setup_scheduler()
     scheduler.start()
     logger.info("✅ Scheduler iniciado correctamente")
+    # Sesiones en memoria: barrido periódico de inactivas (Redis las expira por TTL)
+    gc_loop = getattr(chat_service.session_store, "gc_loop", None)
+    session_gc_task = asyncio.create_task(gc_loop()) if gc_loop else None
     
     yield
     
     # Shutdown
+    if session_gc_task:
+        session_gc_task.cancel()
     logger.info("🛑 Deteniendo scheduler...")
     if scheduler and scheduler.running:
         scheduler.shutdown(wait=False)
     logger.info("✅ Scheduler detenido")
+    # Cierra el cliente HTTP compartido del backend y descarta las cabeceras con tokens cacheadas
+    await chat_service.aclose()
 
 
 # Crear aplicación FastAPI con lifespan
@@ -152,6 +185,7 @@ async def root():
             "chat": "/chat",
             "sessions": "/sessions",
             "generar_informe_portafolio": "/acciones/generar_informe_portafolio",
+            "generar_informes_portafolio_batch": "/acciones/generar_informe_portafolio/batch/start",
             "docs": "/docs"
         }
     }
@@ -160,7 +194,7 @@ async def root():
 async def health_check():
     """Health check del servicio"""
     try:
-        status = chat_service.get_health_status()
+        status = await chat_service.get_health_status()
         return HealthResponse(**status)
     except Exception as e:
         raise HTTPException(
@@ -176,7 +210,7 @@ async def process_report_generation_task(task_id: str, request: PortfolioReportR
     try:
         # Actualizar estado a "processing"
         task_statuses[task_id]["status"] = "processing"
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
         
         # Generar reporte
         result = await chat_service.ejecutar_generacion_informe_portafolio(request)
@@ -185,19 +219,47 @@ async def process_report_generation_task(task_id: str, request: PortfolioReportR
             # Error en la generación
             task_statuses[task_id]["status"] = "error"
             task_statuses[task_id]["error"] = result.get("detail") or result.get("error")
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
         else:
             # Éxito
             task_statuses[task_id]["status"] = "completed"
             task_statuses[task_id]["result"] = result
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
-            task_statuses[task_id]["completed_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
     
     except Exception as e:
         # Error inesperado
         task_statuses[task_id]["status"] = "error"
         task_statuses[task_id]["error"] = str(e)
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
+
+
+async def process_report_batch_task(task_id: str, requests: List[PortfolioReportRequest]):
+    """
+    Función auxiliar que genera en background un lote de informes vía Gemini Batch API.
+    El resultado lleva un elemento por request, en el mismo orden; los fallidos llevan "error".
+    """
+    try:
+        task_statuses[task_id]["status"] = "processing"
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
+        
+        results = await chat_service.generate_reports_batch(requests)
+        failed = sum(1 for result in results if result.get("error"))
+        
+        if failed == len(results):
+            # Ningún informe generado
+            task_statuses[task_id]["status"] = "error"
+            task_statuses[task_id]["error"] = results[0].get("detail") or results[0].get("error")
+        else:
+            task_statuses[task_id]["status"] = "completed"
+            task_statuses[task_id]["result"] = {"reports": results, "failed": failed}
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
+    
+    except Exception as e:
+        task_statuses[task_id]["status"] = "error"
+        task_statuses[task_id]["error"] = str(e)
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
 
 
 async def process_alerts_analysis_task(task_id: str, request: AlertsAnalysisRequest):
@@ -208,7 +270,7 @@ async def process_alerts_analysis_task(task_id: str, request: AlertsAnalysisRequ
     try:
         # Actualizar estado a "processing"
         task_statuses[task_id]["status"] = "processing"
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
         
         # Generar análisis de alertas
         result = await chat_service.ejecutar_analisis_alertas(request)
@@ -217,19 +279,19 @@ async def process_alerts_analysis_task(task_id: str, request: AlertsAnalysisRequ
             # Error en la generación
             task_statuses[task_id]["status"] = "error"
             task_statuses[task_id]["error"] = result.get("detail") or result.get("error")
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
         else:
             # Éxito
             task_statuses[task_id]["status"] = "completed"
             task_statuses[task_id]["result"] = result
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
-            task_statuses[task_id]["completed_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
     
     except Exception as e:
         # Error inesperado
         task_statuses[task_id]["status"] = "error"
         task_statuses[task_id]["error"] = str(e)
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
 
 
 async def process_future_projections_task(task_id: str, request: FutureProjectionsRequest):
@@ -240,7 +302,7 @@ async def process_future_projections_task(task_id: str, request: FutureProjectio
     try:
         # Actualizar estado a "processing"
         task_statuses[task_id]["status"] = "processing"
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
         
         # Generar proyecciones
         result = await chat_service.ejecutar_proyecciones_futuras(request)
@@ -249,19 +311,19 @@ async def process_future_projections_task(task_id: str, request: FutureProjectio
             # Error en la generación
             task_statuses[task_id]["status"] = "error"
             task_statuses[task_id]["error"] = result.get("detail") or result.get("error")
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
         else:
             # Éxito
             task_statuses[task_id]["status"] = "completed"
             task_statuses[task_id]["result"] = result
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
-            task_statuses[task_id]["completed_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
     
     except Exception as e:
         # Error inesperado
         task_statuses[task_id]["status"] = "error"
         task_statuses[task_id]["error"] = str(e)
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
 
 
 @app.post("/acciones/generar_informe_portafolio/start")
@@ -280,8 +342,8 @@ async def generar_informe_portafolio_start(
     task_statuses[task_id] = {
         "task_id": task_id,
         "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
         "model_preference": request.model_preference,
     }
     
@@ -301,6 +363,39 @@ async def generar_informe_portafolio_start(
     }
 
 
+@app.post("/acciones/generar_informe_portafolio/batch/start")
+async def generar_informe_portafolio_batch_start(
+    requests: List[PortfolioReportRequest],
+    background_tasks: BackgroundTasks
+):
+    """
+    Inicia la generación de varios informes sin usuario esperando (cron, envíos programados)
+    con la Gemini Batch API: menor coste por informe a cambio de minutos u horas de latencia.
+    El estado se consulta en el mismo endpoint de status que los informes individuales.
+    """
+    if not requests:
+        raise HTTPException(status_code=400, detail="Se requiere al menos una solicitud de informe")
+    
+    task_id = str(uuid.uuid4())
+    task_statuses[task_id] = {
+        "task_id": task_id,
+        "status": "pending",
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
+        "batch_size": len(requests),
+    }
+    
+    background_tasks.add_task(process_report_batch_task, task_id, requests)
+    
+    return {
+        "task_id": task_id,
+        "status": "pending",
+        "message": f"Lote de {len(requests)} informes iniciado. Use /acciones/generar_informe_portafolio/status/{{task_id}} para verificar el progreso.",
+        "poll_url": f"/acciones/generar_informe_portafolio/status/{task_id}",
+        "created_at": task_statuses[task_id]["created_at"]
+    }
+
+
 @app.get("/acciones/generar_informe_portafolio/status/{task_id}")
 async def generar_informe_portafolio_status(task_id: str):
     """
@@ -380,11 +475,11 @@ async def chat(
                     auth_token=bearer_token,
                     inline_files=request.files,  # ✅ Nuevo: pasar archivos inline
                 ):
-                    # Formato SSE: data: {json}\n\n
-                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    # Formato SSE: data: {json}\n\n (orjson; los objetos de grounding se serializan como dict)
+                    yield f"data: {json_dumps(chunk)}\n\n"
                 
                 # Señal de finalización
-                yield f"data: {json.dumps({'done': True})}\n\n"
+                yield 'data: {"done": true}\n\n'
             
             except Exception as e:
                 error_data = {
@@ -436,8 +531,8 @@ async def analisis_alertas_start(
     task_statuses[task_id] = {
         "task_id": task_id,
         "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
         "model_preference": request.model_preference,
     }
     
@@ -518,8 +613,8 @@ async def proyecciones_futuras_start(
     task_statuses[task_id] = {
         "task_id": task_id,
         "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
     }
     
     # Agregar tarea en background
@@ -576,7 +671,7 @@ async def process_performance_analysis_task(task_id: str, request: PerformanceAn
     try:
         # Actualizar estado a "processing"
         task_statuses[task_id]["status"] = "processing"
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
         
         # Generar análisis de rendimiento
         result = await chat_service.ejecutar_analisis_rendimiento(request)
@@ -585,19 +680,19 @@ async def process_performance_analysis_task(task_id: str, request: PerformanceAn
             # Error en la generación
             task_statuses[task_id]["status"] = "error"
             task_statuses[task_id]["error"] = result.get("detail") or result.get("error")
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
         else:
             # Éxito
             task_statuses[task_id]["status"] = "completed"
             task_statuses[task_id]["result"] = result
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
-            task_statuses[task_id]["completed_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
     
     except Exception as e:
         # Error inesperado
         task_statuses[task_id]["status"] = "error"
         task_statuses[task_id]["error"] = str(e)
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
 
 
 @app.post("/acciones/analisis_rendimiento/start")
@@ -627,8 +722,8 @@ async def analisis_rendimiento_start(
     task_statuses[task_id] = {
         "task_id": task_id,
         "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
     }
     
     # Agregar tarea en background
@@ -685,7 +780,7 @@ async def process_daily_weekly_summary_task(task_id: str, request: DailyWeeklySu
     try:
         # Actualizar estado a "processing"
         task_statuses[task_id]["status"] = "processing"
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
         
         # Generar resumen diario/semanal
         result = await chat_service.ejecutar_resumen_diario_semanal(request)
@@ -694,19 +789,19 @@ async def process_daily_weekly_summary_task(task_id: str, request: DailyWeeklySu
             # Error en la generación
             task_statuses[task_id]["status"] = "error"
             task_statuses[task_id]["error"] = result.get("detail") or result.get("error")
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
         else:
             # Éxito
             task_statuses[task_id]["status"] = "completed"
             task_statuses[task_id]["result"] = result
-            task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
-            task_statuses[task_id]["completed_at"] = datetime.now().isoformat()
+            task_statuses[task_id]["updated_at"] = now_iso_coarse()
+            task_statuses[task_id]["completed_at"] = now_iso_coarse()
     
     except Exception as e:
         # Error inesperado
         task_statuses[task_id]["status"] = "error"
         task_statuses[task_id]["error"] = str(e)
-        task_statuses[task_id]["updated_at"] = datetime.now().isoformat()
+        task_statuses[task_id]["updated_at"] = now_iso_coarse()
 
 
 @app.post("/acciones/resumen_diario_semanal/start")
@@ -736,8 +831,8 @@ async def resumen_diario_semanal_start(
     task_statuses[task_id] = {
         "task_id": task_id,
         "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
+        "created_at": now_iso_coarse(),
+        "updated_at": now_iso_coarse(),
     }
     
     # Agregar tarea en background
@@ -790,7 +885,7 @@ async def resumen_diario_semanal_status(task_id: str):
 async def create_session():
     """Crear nueva sesión de chat"""
     try:
-        session_id = chat_service.create_session()
+        session_id = await chat_service.create_session()
         return {"session_id": session_id, "status": "created"}
     except Exception as e:
         raise HTTPException(
@@ -799,10 +894,13 @@ async def create_session():
         )
 
 @app.get("/sessions", response_model=List[SessionInfo])
-async def list_sessions():
-    """Listar sesiones activas"""
+async def list_sessions(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """Listar sesiones activas (paginado)"""
     try:
-        sessions = chat_service.list_sessions()
+        sessions = await chat_service.list_sessions(offset=offset, limit=limit)
         return [SessionInfo(**session) for session in sessions]
     except Exception as e:
         raise HTTPException(
@@ -814,7 +912,7 @@ async def list_sessions():
 async def get_session(session_id: str):
     """Obtener información de una sesión específica"""
     try:
-        session_info = chat_service.get_session_info(session_id)
+        session_info = await chat_service.get_session_info(session_id)
         if not session_info:
             raise HTTPException(
                 status_code=404,
@@ -833,7 +931,7 @@ async def get_session(session_id: str):
 async def close_session(session_id: str):
     """Cerrar una sesión específica"""
     try:
-        success = chat_service.close_session(session_id)
+        success = await chat_service.close_session(session_id)
         if not success:
             raise HTTPException(
                 status_code=404,
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Almacenamiento de sesiones de chat.
+Por defecto en memoria del proceso; con REDIS_URL las sesiones se comparten entre workers
+(metadatos en un hash, mensajes serializados en MessagePack —msgspec o msgpack— en una lista acotada con TTL).
+"""
+import asyncio
+import heapq
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Protocol
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as aioredis
+    _has_redis = True
+except Exception:
+    _has_redis = False
+
+try:
+    import msgspec
+    _has_msgspec = True
+    _msgspec_encoder = msgspec.msgpack.Encoder(enc_hook=str)
+    _msgspec_decoder = msgspec.msgpack.Decoder()
+except Exception:
+    _has_msgspec = False
+
+try:
+    import msgpack
+    _has_msgpack = True
+except Exception:
+    _has_msgpack = False
+
+
+def _pack(message: Dict[str, Any]) -> bytes:
+    # msgspec y msgpack producen el mismo formato MessagePack (intercambiables entre workers)
+    if _has_msgspec:
+        return _msgspec_encoder.encode(message)
+    if _has_msgpack:
+        return msgpack.packb(message, use_bin_type=True, default=str)
+    return json.dumps(message, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def _unpack(raw: bytes) -> Dict[str, Any]:
+    if _has_msgspec:
+        return _msgspec_decoder.decode(raw)
+    if _has_msgpack:
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw)
+
+
+class SessionStore(Protocol):
+    """Operaciones de sesión usadas por ChatAgentService."""
+
+    async def create(self, session_id: str, model_used: str, now_iso: str) -> None: ...
+
+    async def exists(self, session_id: str) -> bool: ...
+
+    async def get_info(self, session_id: str) -> Optional[Dict[str, Any]]: ...
+
+    async def append_message(
+        self, session_id: str, message: Dict[str, Any], content: Any = None, **fields: Any
+    ) -> int: ...
+
+    async def update(self, session_id: str, **fields: Any) -> None: ...
+
+    async def get_fields(self, session_id: str, *names: str) -> Dict[str, Any]: ...
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]: ...
+
+    async def recent_contents(self, session_id: str, limit: int) -> Optional[List[Any]]: ...
+
+    async def delete(self, session_id: str) -> bool: ...
+
+    async def count(self) -> int: ...
+
+    async def list_info(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]: ...
+
+
+@dataclass(slots=True)
+class _Session:
+    """Sesión en memoria: atributos fijos con __slots__ (sin dict por instancia)."""
+
+    messages: deque
+    # types.Content ya construidos para el historial de Gemini (paralelo a `messages`)
+    contents: deque
+    id: str = ""
+    created_at: str = ""
+    model_used: str = ""
+    last_activity: str = ""
+    summary: Optional[str] = None
+    summarized_through: Optional[str] = None
+    # Reloj monotónico del último acceso (para el TTL de inactividad; last_activity queda para la API)
+    touched: float = 0.0
+
+    def reset(self) -> None:
+        self.messages.clear()
+        self.contents.clear()
+        self.summary = None
+        self.summarized_through = None
+
+
+class InMemorySessionStore:
+    """
+    Sesiones en el heap del proceso (un solo worker).
+    El mapa es un LRU (OrderedDict, menos reciente primero): las sesiones inactivas más de
+    `idle_ttl` segundos se desalojan y nunca se retienen más de `max_sessions`.
+    Las sesiones cerradas (con sus deques) se reciclan desde un pool acotado
+    para no reasignarlas en cargas con mucha rotación de sesiones.
+    """
+
+    _POOL_MAX = 256
+
+    def __init__(self, max_messages: int = 50, idle_ttl: int = 1800, max_sessions: int = 10_000):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._session_pool: List[_Session] = []
+
+    @property
+    def active_sessions(self) -> int:
+        """Derivado del mapa de sesiones: no hay contador que pueda desincronizarse."""
+        return len(self.sessions)
+
+    @staticmethod
+    def _info(session_id: str, session: _Session) -> Dict[str, Any]:
+        return {
+            "session_id": session_id,
+            "created_at": session.created_at,
+            "message_count": len(session.messages),
+            "model_used": session.model_used,
+            "last_activity": session.last_activity,
+        }
+
+    @staticmethod
+    def _apply(session: _Session, fields: Dict[str, Any]) -> None:
+        for name, value in fields.items():
+            setattr(session, name, value)
+
+    def _touch(self, session_id: str, session: _Session) -> None:
+        session.touched = time.monotonic()
+        self.sessions.move_to_end(session_id)
+
+    def _release(self, session: _Session) -> None:
+        if len(self._session_pool) < self._POOL_MAX:
+            # Se conservan las deques (vaciadas); el resto de atributos se reescribe en create()
+            session.reset()
+            self._session_pool.append(session)
+
+    def evict_expired(self) -> int:
+        """
+        Desaloja desde el frente del LRU las sesiones inactivas y el exceso sobre `max_sessions`.
+        El orden LRU coincide con `touched`, así que el recorrido se detiene en la primera sesión viva.
+        """
+        cutoff = time.monotonic() - self.idle_ttl
+        sessions = self.sessions
+        evicted = 0
+        while sessions:
+            session_id, session = next(iter(sessions.items()))
+            if session.touched > cutoff and len(sessions) <= self.max_sessions:
+                break
+            del sessions[session_id]
+            self._release(session)
+            evicted += 1
+        return evicted
+
+    async def gc_loop(self, interval: float = 60.0) -> None:
+        """Barrido periódico para liberar sesiones abandonadas aunque no lleguen peticiones nuevas."""
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_expired()
+            if evicted:
+                logger.info("🧹 %d sesiones inactivas desalojadas (%d activas)", evicted, len(self.sessions))
+
+    async def create(self, session_id: str, model_used: str, now_iso: str) -> None:
+        if self._session_pool:
+            session = self._session_pool.pop()
+        else:
+            session = _Session(deque(maxlen=self.max_messages), deque(maxlen=self.max_messages))
+        session.id = session_id
+        session.created_at = now_iso
+        session.model_used = model_used
+        session.last_activity = now_iso
+        session.touched = time.monotonic()
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        # Amortizado: solo recorre las sesiones que de verdad se desalojan
+        self.evict_expired()
+
+    async def exists(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    async def get_info(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session = self.sessions.get(session_id)
+        if not session:
+            return None
+        return self._info(session_id, session)
+
+    async def append_message(
+        self, session_id: str, message: Dict[str, Any], content: Any = None, **fields: Any
+    ) -> int:
+        session = self.sessions.get(session_id)
+        if session is None:
+            # Desalojada (TTL/LRU) mientras se esperaba al modelo: el turno no falla, el mensaje se descarta
+            logger.warning("⚠️ Sesión %s desalojada; no se guarda el mensaje", session_id)
+            return 0
+        self._touch(session_id, session)
+        session.messages.append(message)
+        session.contents.append(content)
+        self._apply(session, fields)
+        return len(session.messages)
+
+    async def update(self, session_id: str, **fields: Any) -> None:
+        session = self.sessions.get(session_id)
+        if session:
+            self._touch(session_id, session)
+            self._apply(session, fields)
+
+    async def get_fields(self, session_id: str, *names: str) -> Dict[str, Any]:
+        session = self.sessions.get(session_id)
+        return {name: getattr(session, name, None) for name in names}
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        session = self.sessions.get(session_id)
+        if not session:
+            return []
+        messages = session.messages
+        return list(islice(messages, max(0, len(messages) - limit), None))
+
+    async def recent_contents(self, session_id: str, limit: int) -> Optional[List[Any]]:
+        """Content precalculados; None si alguno falta (el llamador reconstruye desde los mensajes)."""
+        session = self.sessions.get(session_id)
+        if not session:
+            return None
+        contents = session.contents
+        recent = list(islice(contents, max(0, len(contents) - limit), None))
+        return None if any(item is None for item in recent) else recent
+
+    async def delete(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._release(session)
+        return True
+
+    async def count(self) -> int:
+        return len(self.sessions)
+
+    def iter_info(self, offset: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Recorre una página de sesiones ordenadas por id, como RedisSessionStore: el orden LRU
+        cambia con cada mensaje y paginar sobre él saltaría o repetiría sesiones entre páginas.
+        Con `limit` solo se ordenan los offset + limit ids más pequeños (heapq.nsmallest).
+        """
+        sessions = self.sessions
+        if limit is None:
+            page = sorted(sessions)[offset:]
+        else:
+            page = heapq.nsmallest(offset + limit, sessions)[offset:]
+        for session_id in page:
+            yield self._info(session_id, sessions[session_id])
+
+    async def list_info(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return list(self.iter_info(offset, limit))
+
+
+class RedisSessionStore:
+    """
+    Sesiones compartidas en Redis:
+    - session:{id}           hash con created_at / model_used / last_activity
+    - session:{id}:messages  lista (más reciente primero) acotada con LTRIM
+    - sessions:active        set con los ids vivos
+    Ambas claves de la sesión expiran tras `ttl` segundos sin actividad.
+    """
+
+    _INDEX_KEY = "sessions:active"
+
+    def __init__(self, url: str, max_messages: int = 50, ttl: int = 86400):
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._redis = aioredis.from_url(url)
+
+    @staticmethod
+    def _meta_key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    @staticmethod
+    def _messages_key(session_id: str) -> str:
+        return f"session:{session_id}:messages"
+
+    @staticmethod
+    def _decode_meta(raw: Dict[Any, Any]) -> Dict[str, str]:
+        return {
+            (k.decode("utf-8") if isinstance(k, bytes) else k): (v.decode("utf-8") if isinstance(v, bytes) else v)
+            for k, v in raw.items()
+        }
+
+    async def create(self, session_id: str, model_used: str, now_iso: str) -> None:
+        meta_key = self._meta_key(session_id)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hset(meta_key, mapping={"created_at": now_iso, "model_used": model_used, "last_activity": now_iso})
+        pipe.expire(meta_key, self.ttl)
+        pipe.sadd(self._INDEX_KEY, session_id)
+        await pipe.execute()
+
+    async def exists(self, session_id: str) -> bool:
+        return bool(await self._redis.exists(self._meta_key(session_id)))
+
+    async def get_info(self, session_id: str) -> Optional[Dict[str, Any]]:
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hgetall(self._meta_key(session_id))
+        pipe.llen(self._messages_key(session_id))
+        raw_meta, message_count = await pipe.execute()
+        if not raw_meta:
+            return None
+        meta = self._decode_meta(raw_meta)
+        return {
+            "session_id": session_id,
+            "created_at": meta.get("created_at"),
+            "message_count": int(message_count or 0),
+            "model_used": meta.get("model_used"),
+            "last_activity": meta.get("last_activity"),
+        }
+
+    async def append_message(
+        self, session_id: str, message: Dict[str, Any], content: Any = None, **fields: Any
+    ) -> int:
+        # `content` (objeto en memoria) no se persiste: el historial se reconstruye desde `message`
+        meta_key = self._meta_key(session_id)
+        messages_key = self._messages_key(session_id)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.lpush(messages_key, _pack(message))
+        pipe.ltrim(messages_key, 0, self.max_messages - 1)
+        pipe.expire(messages_key, self.ttl)
+        if fields:
+            pipe.hset(meta_key, mapping={k: str(v) for k, v in fields.items()})
+        pipe.expire(meta_key, self.ttl)
+        pipe.llen(messages_key)
+        results = await pipe.execute()
+        return int(results[-1] or 0)
+
+    async def update(self, session_id: str, **fields: Any) -> None:
+        if not fields:
+            return
+        meta_key = self._meta_key(session_id)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hset(meta_key, mapping={k: str(v) for k, v in fields.items()})
+        pipe.expire(meta_key, self.ttl)
+        await pipe.execute()
+
+    async def get_fields(self, session_id: str, *names: str) -> Dict[str, Any]:
+        if not names:
+            return {}
+        values = await self._redis.hmget(self._meta_key(session_id), list(names))
+        return {
+            name: value.decode("utf-8") if isinstance(value, bytes) else value
+            for name, value in zip(names, values)
+        }
+
+    async def recent_messages(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        if limit <= 0:
+            return []
+        raw = await self._redis.lrange(self._messages_key(session_id), 0, limit - 1)
+        return [_unpack(item) for item in reversed(raw)]
+
+    async def recent_contents(self, session_id: str, limit: int) -> Optional[List[Any]]:
+        return None
+
+    async def delete(self, session_id: str) -> bool:
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.delete(self._meta_key(session_id), self._messages_key(session_id))
+        pipe.srem(self._INDEX_KEY, session_id)
+        deleted, _ = await pipe.execute()
+        return bool(deleted)
+
+    async def count(self) -> int:
+        return int(await self._redis.scard(self._INDEX_KEY))
+
+    async def list_info(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Orden estable entre páginas: ids ordenados; solo se consultan los de la página pedida
+        session_ids = sorted(
+            sid.decode("utf-8") if isinstance(sid, bytes) else sid
+            for sid in await self._redis.smembers(self._INDEX_KEY)
+        )
+        stop = None if limit is None else offset + limit
+        session_ids = session_ids[offset:stop]
+        sessions: List[Dict[str, Any]] = []
+        expired: List[str] = []
+        for session_id in session_ids:
+            info = await self.get_info(session_id)
+            if info is None:
+                expired.append(session_id)
+            else:
+                sessions.append(info)
+        # Limpiar del índice las sesiones cuyo hash ya expiró
+        if expired:
+            await self._redis.srem(self._INDEX_KEY, *expired)
+        return sessions
+
+
+def build_session_store() -> SessionStore:
+    """Redis si hay REDIS_URL y el paquete está instalado; si no, memoria del proceso."""
+    if settings.redis_url and _has_redis:
+        return RedisSessionStore(
+            settings.redis_url,
+            max_messages=settings.session_max_messages,
+            ttl=settings.session_ttl_seconds,
+        )
+    if settings.redis_url:
+        logger.warning("⚠️ REDIS_URL configurada pero el paquete 'redis' no está instalado; sesiones en memoria")
+    return InMemorySessionStore(
+        max_messages=settings.session_max_messages,
+        idle_ttl=settings.session_idle_ttl_seconds,
+        max_sessions=settings.session_max_sessions,
+    )
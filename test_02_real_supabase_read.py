@@ -275,14 +275,14 @@ async def run_test():
         print(f"📊 CONTEXTO GENERADO:")
         print(f"   🪣 Bucket: {storage['bucket']}")
         print(f"   📁 Prefix: {storage['prefix']}")
-        print(f"   🖼️ Imágenes: {len(storage.get('images', []))}")
+        print(f"   🖼️ Imágenes: {len(storage.get('images', {}).get('paths', []))}")
         print(f"   📄 Docs JSON: {len(storage.get('json_docs', {}))}")
         print(f"   📝 Docs MD: {len(storage.get('markdown_docs', {}))}")
         
         # Mostrar referencias a imágenes
         print(f"\n🖼️ REFERENCIAS A IMÁGENES:")
-        for img in storage.get('images', []):
-            print(f"   📷 {img['path']}")
+        for path in storage.get('images', {}).get('paths', []):
+            print(f"   📷 {path}")
         
         # Calcular tamaño del contexto
         context_json_str = json.dumps(storage_ctx, ensure_ascii=False)
@@ -218,12 +218,12 @@ async def run_test():
     
     print(f"Bucket: {storage['bucket']}")
     print(f"Prefix: {storage['prefix']}")
-    print(f"Imágenes: {len(storage['images'])}")
+    print(f"Imágenes: {len(storage['images']['paths'])}")
     print(f"Documentos JSON: {len(storage['json_docs'])}")
     print(f"Documentos MD: {len(storage['markdown_docs'])}")
     
     # Verificar contenido de imágenes
-    image_paths = [img['path'] for img in storage['images']]
+    image_paths = storage['images']['paths']
     expected_images = ['Graficos/portfolio_growth.png', 'Graficos/drawdown_underwater.png', 'Graficos/sector_allocation.png']
     for expected in expected_images:
         assert expected in image_paths, f"Imagen esperada {expected} no encontrada"
@@ -259,7 +259,7 @@ async def run_test():
         storage_data = merged_ctx['storage']
         print(f"  - Archivos JSON en contexto: {list(storage_data.get('json_docs', {}).keys())}")
         print(f"  - Archivos MD en contexto: {list(storage_data.get('markdown_docs', {}).keys())}")
-        print(f"  - Imágenes en contexto: {len(storage_data.get('images', []))}")
+        print(f"  - Imágenes en contexto: {len(storage_data.get('images', {}).get('paths', []))}")
         
         # Verificar contenido específico
         json_docs = storage_data.get('json_docs', {})
@@ -91,12 +91,12 @@ async def execute_real_portfolio_report():
             storage = storage_ctx["storage"]
             print(f"📄 Archivos JSON: {len(storage.get('json_docs', {}))}")
             print(f"📝 Archivos MD: {len(storage.get('markdown_docs', {}))}")
-            print(f"🖼️ Imágenes PNG: {len(storage.get('images', []))}")
+            print(f"🖼️ Imágenes PNG: {len(storage.get('images', {}).get('paths', []))}")
             
             # Mostrar archivos disponibles
             json_files = list(storage.get('json_docs', {}).keys())
             md_files = list(storage.get('markdown_docs', {}).keys())
-            png_files = [img['path'].split('/')[-1] for img in storage.get('images', [])]
+            png_files = [path.split('/')[-1] for path in storage.get('images', {}).get('paths', [])]
             
             print(f"\n📋 ARCHIVOS DISPONIBLES:")
             print(f"   JSON: {json_files}")
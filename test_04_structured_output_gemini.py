@@ -207,14 +207,14 @@ async def test_with_real_context():
         print(f"✅ Contexto obtenido:")
         print(f"   JSON docs: {len(storage.get('json_docs', {}))}")
         print(f"   MD docs: {len(storage.get('markdown_docs', {}))}")
-        print(f"   Imágenes: {len(storage.get('images', []))}")
+        print(f"   Imágenes: {len(storage.get('images', {}).get('paths', []))}")
         
         # Preparar prompt con contexto real
         context_summary = {
             "json_files": list(storage.get('json_docs', {}).keys()),
             "md_files": list(storage.get('markdown_docs', {}).keys()),
-            "png_files": [img['path'].split('/')[-1] for img in storage.get('images', [])],
-            "total_files": len(storage.get('json_docs', {})) + len(storage.get('markdown_docs', {})) + len(storage.get('images', []))
+            "png_files": [path.split('/')[-1] for path in storage.get('images', {}).get('paths', [])],
+            "total_files": len(storage.get('json_docs', {})) + len(storage.get('markdown_docs', {})) + len(storage.get('images', {}).get('paths', []))
         }
         
         prompt = f"""
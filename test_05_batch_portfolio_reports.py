@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test de la generación de informes por lotes (Gemini Batch API) sin llamadas reales:
+un cliente falso de `client.aio.batches` devuelve las respuestas inline y se verifica que
+cada informe vuelve a su request (metadata "index"), que las respuestas faltantes se marcan
+como error y que el endpoint /acciones/generar_informe_portafolio/batch/start las expone.
+
+No requiere API keys ni backend.
+"""
+import asyncio
+import json
+import os
+import sys
+
+os.environ.setdefault("GEMINI_API_KEY", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from google.genai import types
+
+import agent_service
+from agent_service import ChatAgentService
+from models import PortfolioReportRequest
+
+agent_service.settings.batch_poll_interval_seconds = 0
+
+
+def _report(title: str) -> str:
+    return json.dumps({
+        "fileName": f"{title}.pdf",
+        "document": {"title": title},
+        "content": [{"type": "paragraph", "text": "hola"}],
+    })
+
+
+def _ok(title: str, metadata=None) -> types.InlinedResponse:
+    return types.InlinedResponse(
+        metadata=metadata,
+        response=types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part.from_text(text=_report(title))])
+        )]),
+    )
+
+
+class FakeBatches:
+    """Un job por modelo; `respond(src)` arma las respuestas inline a partir de las peticiones."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.jobs = {}
+
+    async def create(self, model, src, config=None):
+        self.jobs[model] = src
+        return types.BatchJob(name=f"batches/{model}", state="JOB_STATE_PENDING")
+
+    async def get(self, name):
+        src = self.jobs[name.split("/", 1)[1]]
+        return types.BatchJob(
+            name=name,
+            state="JOB_STATE_SUCCEEDED",
+            dest=types.BatchJobDestination(inlined_responses=self.respond(src)),
+        )
+
+
+class FakeClient:
+    def __init__(self, respond):
+        class Aio:
+            pass
+        self.aio = Aio()
+        self.aio.batches = FakeBatches(respond)
+
+
+def _service(respond) -> ChatAgentService:
+    service = ChatAgentService()
+    service.client = FakeClient(respond)
+
+    async def no_storage(user_id, auth_token):
+        return {}
+
+    service._gather_storage_context = no_storage
+    return service
+
+
+def _requests(n: int):
+    return [PortfolioReportRequest(user_id="u", context={"i": i}, model_preference="pro") for i in range(n)]
+
+
+def _titles(results):
+    return [r["report"]["document"]["title"] if "report" in r else r.get("detail") for r in results]
+
+
+def test_batch_reordered_responses_follow_metadata():
+    """Respuestas en orden inverso: cada una vuelve a su request por el metadata "index"."""
+    def respond(src):
+        return [_ok(f"r{req.metadata['index']}", req.metadata) for req in reversed(src)]
+
+    results = asyncio.run(_service(respond).generate_reports_batch(_requests(3)))
+    assert _titles(results) == ["r0", "r1", "r2"], results
+
+
+def test_batch_missing_responses_are_errors():
+    """Menos respuestas que peticiones y sin metadata: no se asignan por posición."""
+    def respond(src):
+        return [_ok("sin-indice") for _ in src[:-1]]
+
+    results = asyncio.run(_service(respond).generate_reports_batch(_requests(3)))
+    assert all(r.get("detail") == "sin respuesta en el batch" for r in results), results
+
+
+def test_batch_partial_failure():
+    """Una respuesta con error solo invalida su propio informe."""
+    def respond(src):
+        responses = [_ok(f"r{req.metadata['index']}", req.metadata) for req in src]
+        responses[1] = types.InlinedResponse(metadata=src[1].metadata, error=types.JobError(message="boom"))
+        return responses
+
+    results = asyncio.run(_service(respond).generate_reports_batch(_requests(3)))
+    assert "report" in results[0] and "report" in results[2], results
+    assert results[1].get("error") and "boom" in results[1]["detail"], results
+
+
+def test_batch_endpoint():
+    """El endpoint encola el lote y el status devuelve un resultado por request."""
+    from fastapi.testclient import TestClient
+    import main
+
+    def respond(src):
+        return [_ok(f"r{req.metadata['index']}", req.metadata) for req in src]
+
+    original = main.chat_service
+    main.chat_service = _service(respond)
+    try:
+        # Sin `with`: no se ejecuta el lifespan (scheduler) durante el test
+        client = TestClient(main.app)
+        payload = [r.model_dump() for r in _requests(2)]
+        started = client.post("/acciones/generar_informe_portafolio/batch/start", json=payload).json()
+        status = client.get(started["poll_url"]).json()
+        assert status["status"] == "completed", status
+        assert _titles(status["result"]["reports"]) == ["r0", "r1"], status
+        assert status["result"]["failed"] == 0
+        assert client.post("/acciones/generar_informe_portafolio/batch/start", json=[]).status_code == 400
+    finally:
+        main.chat_service = original
+
+
+if __name__ == "__main__":
+    for test in (
+        test_batch_reordered_responses_follow_metadata,
+        test_batch_missing_responses_are_errors,
+        test_batch_partial_failure,
+        test_batch_endpoint,
+    ):
+        test()
+        print(f"✅ {test.__name__}")
+    print("🎉 TODOS LOS TESTS PASARON!")
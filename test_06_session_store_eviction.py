@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test del almacén de sesiones en memoria: una sesión desalojada por el tope LRU mientras
+se esperaba al modelo no debe hacer fallar el registro de la respuesta.
+
+No requiere API keys.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from session_store import InMemorySessionStore
+
+
+def test_append_after_eviction():
+    """max_sessions=2: crear a, b, c desaloja a; agregar a `a` retorna 0 sin KeyError."""
+    async def run():
+        store = InMemorySessionStore(max_sessions=2)
+        for session_id in ("a", "b", "c"):
+            await store.create(session_id, "flash", "2025-01-01T00:00:00")
+        assert not await store.exists("a")
+        assert await store.append_message("a", {"role": "assistant", "content": "hola"}) == 0
+        assert not await store.exists("a")
+        assert await store.append_message("c", {"role": "user", "content": "hola"}) == 1
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_append_after_eviction()
+    print("✅ test_append_after_eviction")
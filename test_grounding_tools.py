@@ -177,7 +177,7 @@ async def test_health_status():
     print("="*60)
     
     try:
-        health = chat_service.get_health_status()
+        health = await chat_service.get_health_status()
         
         print("\n🏥 Estado del servicio:")
         print(json.dumps(health, indent=2, ensure_ascii=False))